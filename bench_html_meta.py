@@ -0,0 +1,164 @@
+"""
+Micro-benchmark: Facebook fallback HTML parsing, the previous
+BeautifulSoup code against services.html_meta.
+
+    python bench_html_meta.py [repeats]
+
+Prints parse time and peak allocations per fixture and checks both
+return the same result.
+"""
+import os
+import sys
+import glob
+import time
+import logging
+import tracemalloc
+from bs4 import BeautifulSoup
+from services.facebook import parse_og_tags, parse_mbasic
+
+
+# --- Previous implementation, kept as the baseline ---
+
+def legacy_parse_og_tags(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    found = {}
+    
+    # Extract basic metadata
+    og_title = soup.find("meta", property="og:title")
+    if og_title:
+        found['title'] = og_title.get('content')
+        
+    og_image = soup.find("meta", property="og:image")
+    if og_image:
+        found['image'] = og_image.get('content')
+        
+    og_video = soup.find("meta", property="og:video")
+    if og_video:
+        found['video'] = og_video.get('content')
+    return found
+
+def legacy_parse_mbasic(html_mb, info):
+    soup_mb = BeautifulSoup(html_mb, 'html.parser')
+    # Try to find finding image in mbasic (often in a div with data-ft or just an img inside a container)
+    # Or check for standard og:image again (mbasic pages also have headers)
+    og_image_mb = soup_mb.find("meta", property="og:image")
+    if og_image_mb:
+         info['image'] = og_image_mb.get('content')
+         logging.info(f"Found image on mbasic (meta): {info['image']}")
+
+    if not info['image']:
+        link_image = soup_mb.find("link", rel="image_src")
+        if link_image:
+            info['image'] = link_image.get('href')
+            logging.info(f"Found image on mbasic (link): {info['image']}")
+
+    if not info['image']:
+        # Try to find the first significant image
+        images = soup_mb.find_all("img")
+        for img in images:
+            src = img.get('src')
+            # Filter out small icons/emojis if possible (heuristic)
+            if src and "htt" in src and "static" not in src and "emoji" not in src:
+                info['image'] = src
+                logging.info(f"Found simplified image on mbasic (img tag): {info['image']}")
+                break
+
+    # Last resort: Regex for "k": or "m": (common in JSON blobs in script tags on mbasic/www)
+    if not info['image']:
+        import re
+        # Look for jpg urls in script tags or source
+        matches = re.findall(r'"(https?://[^"]+?\.jpg[^"]*?)"', html_mb)
+        if matches:
+            for m in matches:
+                if "static" not in m and "emoji" not in m:
+                    # decode unicode escapes if needed
+                    try:
+                        m = m.encode().decode('unicode-escape')
+                    except:
+                        pass
+                    info['image'] = m
+                    logging.info(f"Found image via regex match: {m}")
+                    break
+
+    # Try to find video on mbasic (link or a tag)
+    if not info['video']:
+         # sometimes link rel="video_src" exists? likely not on mbasic but checking
+         # more likely in a href to .mp4
+         import re
+         # Look for mp4 urls in source
+         matches_mp4 = re.findall(r'"(https?://[^"]+?\.mp4[^"]*?)"', html_mb)
+         ifMatches_mp4 = []
+         # Also check hrefs
+         a_tags = soup_mb.find_all("a", href=True)
+         for a in a_tags:
+             if ".mp4" in a['href']:
+                 matches_mp4.append(a['href'])
+
+         if matches_mp4:
+             for m in matches_mp4:
+                 # decode
+                 try:
+                     m = m.encode().decode('unicode-escape')
+                 except:
+                     pass
+                 # Basic filtering
+                 if "mp4" in m:
+                     info['video'] = m
+                     logging.info(f"Found video via regex/href: {m}")
+                     break
+
+
+
+# --- Benchmark ---
+
+def run_old(html):
+    info = {'image': None, 'video': None}
+    info.update(legacy_parse_og_tags(html))
+    legacy_parse_mbasic(html, info)
+    return info
+
+
+def run_new(html):
+    info = {'image': None, 'video': None}
+    info.update(parse_og_tags(html))
+    parse_mbasic(html, info)
+    return info
+
+
+def measure(fn, html, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(html)
+    elapsed = (time.perf_counter() - start) / repeats
+
+    tracemalloc.start()
+    fn(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    # The parsers log what they find; keep the output readable
+    logging.disable(logging.INFO)
+
+    print(f"{'fixture':<22}{'size':>9}{'old ms':>10}{'new ms':>10}{'old peak':>11}{'new peak':>11}  same")
+    for path in sorted(glob.glob("fixtures/facebook/*.html")):
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        old_time, old_peak = measure(run_old, html, repeats)
+        new_time, new_peak = measure(run_new, html, repeats)
+        same = run_old(html) == run_new(html)
+        name = os.path.basename(path)
+        print(
+            f"{name:<22}{len(html) // 1024:>7}KB{old_time * 1000:>10.2f}{new_time * 1000:>10.2f}"
+            f"{old_peak // 1024:>9}KB{new_peak // 1024:>9}KB  {'yes' if same else 'NO'}"
+        )
+        if not same:
+            print(f"  old: {run_old(html)}")
+            print(f"  new: {run_new(html)}")
+
+
+if __name__ == "__main__":
+    main()
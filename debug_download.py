@@ -19,7 +19,7 @@ async def test_download():
             print(f"- {m['type']}: {m['path']} (Group ID: {m.get('group_id')})")
             
             # Test cleanup
-            # downloader.cleanup(m['path'])
+            # downloader.release(m["group_id"])
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -0,0 +1,35 @@
+import os
+import sys
+import glob
+import time
+import json
+import asyncio
+import aiohttp
+from dotenv import load_dotenv
+
+# Replays recorded updates against a locally running webhook server:
+#   BOT_MODE=webhook WEBHOOK_SECRET=... python main.py
+#   python debug_webhook.py [update.json ...]
+load_dotenv()
+
+PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+URL = f"http://localhost:{PORT}{os.getenv('WEBHOOK_PATH', '/webhook')}"
+SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+
+async def post_updates(paths):
+    async with aiohttp.ClientSession() as session:
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                update = json.load(f)
+            start = time.perf_counter()
+            async with session.post(URL, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                body = await response.text()
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"{os.path.basename(path)}: {response.status} in {elapsed:.1f} ms {body}")
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or sorted(glob.glob("fixtures/updates/*.json"))
+    print(f"Posting {len(paths)} update(s) to {URL}")
+    asyncio.run(post_updates(paths))
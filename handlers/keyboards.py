@@ -30,6 +30,14 @@ def download_success_menu(file_id=None):
     ])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+def cancel_menu(cancel_id):
+    kb = [
+        [
+            InlineKeyboardButton(text="✖️ Cancel", callback_data=f"cancel:{cancel_id}")
+        ]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
 def language_menu():
     kb = [
         [
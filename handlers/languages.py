@@ -1,5 +1,6 @@
 from aiogram import Router, F, types
 from aiogram.types import CallbackQuery
+from aiogram.fsm.context import FSMContext
 from handlers import keyboards
 
 router = Router()
@@ -10,8 +11,10 @@ async def cb_language(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=keyboards.language_menu())
 
 @router.callback_query(F.data.startswith("lang_"))
-async def cb_set_language(callback: CallbackQuery):
+async def cb_set_language(callback: CallbackQuery, state: FSMContext):
     lang_code = callback.data.split("_")[1]
+    # Stored with the user's FSM data so it survives restarts and is seen by every replica
+    await state.update_data(language=lang_code)
     
     # Map code to name for confirmation message
     lang_names = {
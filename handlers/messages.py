@@ -3,9 +3,20 @@ from aiogram.filters import Command
 from aiogram.types import FSInputFile, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.exceptions import TelegramBadRequest
 from services.downloader import downloader, MediaType
+from services.cache import result_cache
+from services.scheduler import QueueFullError
+from services.formats import MediaTooLargeError
+from services.execution import DownloadCancelled
+from services.progress import Progress, StatusReporter, UPLOADING
+from services.uploads import pre_uploader
+from services.audio import audio_pipeline
+from services.thumbnails import thumbnails
+from services.memory import input_file
 from handlers import keyboards
 import os
+import uuid
 import logging
 import asyncio
 
@@ -15,14 +26,6 @@ router = Router()
 class SpotifySearch(StatesGroup):
     waiting_for_query = State()
 
-async def cleanup_later(files, delay=300):
-    """
-    Deletes files after a delay (default 5 minutes).
-    """
-    await asyncio.sleep(delay)
-    for path in files:
-        downloader.cleanup(path)
-
 @router.message(Command("start"))
 async def cmd_start(message: types.Message):
     text = (
@@ -124,6 +127,195 @@ async def cb_find_music_spotify(callback: CallbackQuery, state: FSMContext):
     await state.set_state(SpotifySearch.waiting_for_query)
     await callback.answer()
 
+VIA = "\nVia @DownloaderMikitabot"
+
+def _input_file(media):
+    # Cached items are re-sent by Telegram file_id, fresh ones are uploaded from memory or disk
+    return media['file_id'] if media.get('file_id') else input_file(media)
+
+def _thumb_file(media):
+    # Files sent by file_id already have their thumbnail on Telegram's side
+    if media.get('file_id'):
+        return None
+    thumb = media.get('thumb')
+    return FSInputFile(thumb) if thumb and os.path.exists(thumb) else None
+
+async def _prepare(bot, media):
+    """
+    Gets an item ready to send: a Telegram-sized thumbnail for videos and
+    audios, and a file_id from the storage chat when pre-uploading is on.
+    """
+    if media['type'] != MediaType.IMAGE and not media.get('file_id'):
+        media = {**media, 'thumb': await thumbnails.prepare(media)}
+    if media['type'] != MediaType.AUDIO and pre_uploader.enabled and not media.get('file_id'):
+        media = await pre_uploader.upload(bot, media)
+    return media
+
+def _sent_file_id(sent_msg, media_type):
+    # Telegram may store a video as an animation or document; those ids can't be
+    # re-sent with the same method, so they are not cached
+    if media_type == MediaType.VIDEO and sent_msg.video:
+        return sent_msg.video.file_id
+    if media_type == MediaType.IMAGE and sent_msg.photo:
+        return sent_msg.photo[-1].file_id
+    if media_type == MediaType.AUDIO and sent_msg.audio:
+        return sent_msg.audio.file_id
+    return None
+
+def _to_cache(sent_list):
+    items = []
+    for media in sent_list:
+        if not media.get('file_id'):
+            return None
+        items.append({
+            'type': media['type'].value,
+            'file_id': media['file_id'],
+            'title': media.get('title'),
+            'duration': media.get('duration'),
+            'width': media.get('width'),
+            'height': media.get('height'),
+            'group_id': media.get('group_id'),
+        })
+    return {'items': items}
+
+def _from_cache(entry):
+    return [{**item, 'type': MediaType(item['type'])} for item in entry['items']]
+
+async def _iterate(media_items):
+    # A plain list (cached results) or an async stream (downloader.stream_media)
+    if hasattr(media_items, '__aiter__'):
+        async for media in media_items:
+            yield media
+    else:
+        for media in media_items:
+            yield media
+
+def _album_media(media, caption):
+    if media['type'] == MediaType.VIDEO:
+        return types.InputMediaVideo(
+            media=_input_file(media),
+            caption=caption,
+            duration=media.get('duration'),
+            width=media.get('width'),
+            height=media.get('height'),
+            thumbnail=_thumb_file(media)
+        )
+    return types.InputMediaPhoto(
+        media=_input_file(media),
+        caption=caption
+    )
+
+async def _discard(items):
+    # Stops prepare tasks nobody will send (no more storage-chat uploads) and collects their errors
+    tasks = [item for item in items if asyncio.isfuture(item)]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _send_album(message: types.Message, chunk, first):
+    """
+    Sends up to 10 photos/videos; returns them with their file_ids.
+    Items may be pre-upload tasks, which are awaited first.
+    """
+    try:
+        chunk = [await media if asyncio.isfuture(media) else media for media in chunk]
+    except BaseException:
+        # The album won't go out; don't keep pushing the rest of it to the storage chat
+        await _discard(chunk)
+        raise
+    # For albums, we just append Via... to the first caption
+    caption = (chunk[0].get('title') or "") + VIA if first else None
+    if len(chunk) == 1:
+        # Telegram albums need at least 2 items
+        media = chunk[0]
+        if media['type'] == MediaType.VIDEO:
+            sent_msg = await message.answer_video(
+                video=_input_file(media),
+                caption=caption,
+                duration=media.get('duration'),
+                width=media.get('width'),
+                height=media.get('height'),
+                thumbnail=_thumb_file(media),
+                request_timeout=300
+            )
+        else:
+            sent_msg = await message.answer_photo(_input_file(media), caption=caption, request_timeout=300)
+        return [{**media, 'file_id': _sent_file_id(sent_msg, media['type'])}]
+
+    album_builder = [_album_media(media, caption if i == 0 else None) for i, media in enumerate(chunk)]
+    sent_msgs = await message.answer_media_group(media=album_builder, request_timeout=300)
+    return [{**media, 'file_id': _sent_file_id(sent_msg, media['type'])} for media, sent_msg in zip(chunk, sent_msgs)]
+
+async def _send_audio(message: types.Message, audio):
+    sent_msg = await message.answer_audio(
+        _input_file(audio),
+        caption=f"🎵 <b>{audio.get('title')}</b>{VIA}",
+        duration=audio.get('duration'),
+        thumbnail=_thumb_file(audio),
+        reply_markup=keyboards.download_success_menu(),
+        request_timeout=300
+    )
+    return {**audio, 'file_id': _sent_file_id(sent_msg, MediaType.AUDIO)}
+
+async def send_media(message: types.Message, media_items):
+    """
+    Sends media items to the chat as they arrive: videos/photos in albums
+    of 10, each album as soon as it fills up, and audios separately.
+    A post that turns out to be a single video is sent on its own with buttons.
+
+    media_items is a list or an async iterator of items, so a carousel can
+    be uploaded while the rest of it is still downloading.
+    Returns the items with the Telegram 'file_id' of each sent file filled in.
+    """
+    sent = []
+    # Telegram MediaGroup allows mixing photos and videos.
+    pending = []
+    albums_sent = 0
+
+    try:
+        async for media in _iterate(media_items):
+            # Audio must be sent separately.
+            if media['type'] == MediaType.AUDIO:
+                sent.append(await _send_audio(message, await _prepare(message.bot, media)))
+                continue
+            # Start preparing right away (thumbnail, pre-upload); the album waits for it
+            pending.append(asyncio.ensure_future(_prepare(message.bot, media)))
+            # Telegram limit is 10 items per album
+            if len(pending) == 10:
+                sent.extend(await _send_album(message, pending, first=not albums_sent))
+                pending = []
+                albums_sent += 1
+
+        # If there is only one item and it's a VIDEO, send it individually to attach buttons.
+        # If it's a group, we can't attach buttons to the media group easily in the same way.
+        if len(pending) == 1:
+            pending = [await pending[0]]
+        if not albums_sent and len(pending) == 1 and pending[0]['type'] == MediaType.VIDEO:
+            video = pending[0]
+            sent_msg = await message.answer_video(
+                video=_input_file(video),
+                caption=(video.get('title') or "") + VIA,
+                duration=video.get('duration'),
+                width=video.get('width'),
+                height=video.get('height'),
+                thumbnail=_thumb_file(video),
+                reply_markup=keyboards.download_success_menu(file_id=video.get('group_id')),
+                request_timeout=300
+            )
+            sent.append({**video, 'file_id': _sent_file_id(sent_msg, MediaType.VIDEO)})
+        elif pending or albums_sent:
+            if pending:
+                sent.extend(await _send_album(message, pending, first=not albums_sent))
+
+            # Send buttons separately for albums
+            # Convert button only makes sense for single video mostly.
+            await message.answer("✅ <b>Download Complete!</b>", reply_markup=keyboards.download_success_menu())
+    finally:
+        # A failed item, a cancel or a timeout must not leave uploads running
+        await _discard(pending)
+
+    return sent
+
 @router.message(F.text)
 async def handle_message(message: types.Message, state: FSMContext):
     url = message.text.strip()
@@ -136,151 +328,90 @@ async def handle_message(message: types.Message, state: FSMContext):
         # format as ytsearch if not a link
         if not url.startswith(("http://", "https://")):
              url = f"ytsearch1:{url}"
-        await state.clear()
+        # Leave the search state but keep per-user data such as the language
+        await state.set_state(None)
     
     if not is_search and not url.startswith(("http://", "https://")):
         await message.answer("⚠️ Please send a valid URL starting with <code>http://</code> or <code>https://</code>")
         return
 
-    status_msg = await message.answer("⏳ <b>Processing...</b>")
-
-    # Animation Loop
-    stop_animation = False
-    
-    async def run_animation():
-        frames = ["🌑", "🌒", "🌓", "🌔", "🌕", "🌖", "🌗", "🌘"]
-        idx = 0
-        while not stop_animation:
-            try:
-                if idx % 2 == 0:
-                     msg_text = "🔎 <b>Searching...</b>" if is_search else "<b>Downloading...</b>"
-                     await status_msg.edit_text(f"{frames[idx % len(frames)]} {msg_text}\n<i>Fetching content...</i>")
-                idx += 1
-                await asyncio.sleep(0.5)
-            except Exception:
-                break
-
-    animation_task = asyncio.create_task(run_animation())
+    # Searches are forced to audio, so they are cached separately from video links
+    mode = "audio" if is_search else "video"
 
-    try:
-        # Force audio if it was a search query
-        media_list = await downloader.download_media(url, force_audio=is_search)
-        
-        stop_animation = True
-        animation_task.cancel() # Ensure it stops
-        
-        if not media_list:
-            await status_msg.edit_text("❌ <b>Failed:</b> Could not download media.\nCheck the link or try again.")
+    # Repeat links are answered straight from Telegram file_ids
+    cached = await asyncio.to_thread(result_cache.get, url, mode)
+    if cached:
+        try:
+            await send_media(message, _from_cache(cached))
+            logging.info(f"Served {url} from result cache")
             return
+        except TelegramBadRequest as e:
+            logging.warning(f"Cached file_ids rejected, downloading again: {e}")
 
-        await status_msg.edit_text("📤 <b>Uploading...</b>")
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    # Lets the user stop this download from the status message
+    cancel_id = uuid.uuid4().hex[:12]
+    cancel_markup = keyboards.cancel_menu(cancel_id)
+    status_msg = await message.answer("⏳ <b>Processing...</b>", reply_markup=cancel_markup)
 
-        # Sort media: Videos first, then Images, then Audio
-        # Or just group them. Telegram MediaGroup allows mixing photos and videos.
-        # Audio must be sent separately.
-        
-        album_builder = []
-        audios = []
-        files_to_cleanup = []
+    # Status message follows the real download progress
+    progress = Progress()
+    reporter = StatusReporter(status_msg, progress, is_search=is_search, reply_markup=cancel_markup).start()
 
-        for media in media_list:
-            files_to_cleanup.append(media['path'])
-            media_file = FSInputFile(media['path'])
-            
-            if media['type'] == MediaType.AUDIO:
-                audios.append(media)
-            elif media['type'] in [MediaType.VIDEO, MediaType.IMAGE]:
-                # Prepare for album
-                if media['type'] == MediaType.VIDEO:
-                    video_thumb = FSInputFile(media['thumb']) if media.get('thumb') and os.path.exists(media['thumb']) else None
-                    album_builder.append(
-                        types.InputMediaVideo(
-                            media=media_file,
-                            caption=media['title'] if len(album_builder) == 0 else None,
-                            duration=media.get('duration'),
-                            width=media.get('width'),
-                            height=media.get('height'),
-                            thumbnail=video_thumb
-                        )
-                    )
-                else:
-                    album_builder.append(
-                        types.InputMediaPhoto(
-                            media=media_file,
-                            caption=media['title'] if len(album_builder) == 0 else None
-                        )
-                    )
-
-        # Send Album (Videos/Photos)
-        # If there is only one item and it's a VIDEO, send it individually to attach buttons.
-        # If it's a group, we can't attach buttons to the media group easily in the same way.
-        if len(album_builder) == 1 and isinstance(album_builder[0], types.InputMediaVideo):
-             single_video = album_builder[0]
-             caption = (single_video.caption or "") + "\nVia @DownloaderMikitabot"
-             
-             # Re-construct args for answer_video because InputMediaVideo object attributes are strict
-             # We need to access the underlying values
-             
-             # Locate the original media dict to get the raw thumb path again or reuse the InputFile?
-             # accessing private attributes of FSInputFile is messy. 
-             # Better to find the media item again or store it.
-             # Since it's index 0...
-             target_media = [m for m in media_list if m['type'] == MediaType.VIDEO][0]
-             thumb_path = target_media.get('thumb')
-             thumb_file = FSInputFile(thumb_path) if thumb_path and os.path.exists(thumb_path) else None
-
-             await message.answer_video(
-                 video=single_video.media,
-                 caption=caption,
-                 duration=single_video.duration,
-                 width=single_video.width,
-                 height=single_video.height,
-                 thumbnail=thumb_file,
-
-                 reply_markup=keyboards.download_success_menu(file_id=target_media.get('group_id')),
-                 request_timeout=300
-             )
-        elif album_builder:
-            # For albums, we just append Via... to the first caption if present
-            if album_builder[0].caption:
-                album_builder[0].caption += "\nVia @DownloaderMikitabot"
-            else:
-                 album_builder[0].caption = "Via @DownloaderMikitabot"
-            
-            # Telegram limit is 10 items per album
-            chunks = [album_builder[i:i + 10] for i in range(0, len(album_builder), 10)]
-            for chunk in chunks:
-                await message.answer_media_group(media=chunk, request_timeout=300)
-            
-            # Send buttons separately for albums
-            # Use group_id from first item if available
-            group_id =  album_builder[0].caption.split('\nVia')[0] if album_builder else None # Hacky way if we lost it? No, get it from original media list
-            # Actually for albums we probably don't want to convert all individual videos easily this way without more complex UI
-            # Just enable for single videos for now as per req?
-            # Or just pass the ID of the first one?
-            # Let's check media_list.
-            # Convert button only makes sense for single video mostly.
-            
-            await message.answer("✅ <b>Download Complete!</b>", reply_markup=keyboards.download_success_menu())
+    # Items handed to us by the downloader; their jobs are released when we are done
+    received = []
 
-        # Send Audios
-        for audio in audios:
-            media_file = FSInputFile(audio['path'])
-            caption = f"🎵 <b>{audio['title']}</b>\nVia @DownloaderMikitabot"
-            await message.answer_audio(
-                media_file, 
-                caption=caption,
-                duration=audio.get('duration'),
-                thumbnail=FSInputFile(audio['thumb']) if audio.get('thumb') and os.path.exists(audio['thumb']) else None,
-                reply_markup=keyboards.download_success_menu(),
-                request_timeout=300
-            )
+    async def items():
+        # Force audio if it was a search query
+        async for media in downloader.stream_media(
+            url,
+            force_audio=is_search,
+            user_id=user_id,
+            progress=progress,
+            cancel_id=cancel_id
+        ):
+            received.append(media)
+            yield media
+        progress.set_phase(UPLOADING)
 
+    try:
+        try:
+            # Uploads start with the first finished item, while the rest downloads
+            sent = await send_media(message, items())
+        except QueueFullError:
+            await reporter.stop()
+            await status_msg.edit_text("🚦 <b>The bot is busy right now.</b>\nPlease try again in a minute.")
+            return
+        except MediaTooLargeError as e:
+            await reporter.stop()
+            await status_msg.edit_text(f"❌ <b>Too large:</b> {e}.\nTelegram bots can't send files this big.")
+            return
+        except DownloadCancelled as e:
+            await reporter.stop()
+            if e.reason == 'cancelled':
+                await status_msg.edit_text("✖️ <b>Cancelled.</b>")
+            else:
+                await status_msg.edit_text("⌛ <b>Timed out:</b> the download took too long.\nPlease try again later.")
+            return
+        finally:
+            # The janitor keeps the files a while for the convert button, then removes them
+            for group_id in {media['group_id'] for media in received}:
+                downloader.release(group_id)
 
+        if not sent:
+            await reporter.stop()
+            await status_msg.edit_text("❌ <b>Failed:</b> Could not download media.\nCheck the link or try again.")
+            return
 
-        # Cleanup
-        asyncio.create_task(cleanup_later(files_to_cleanup))
+        payload = _to_cache(sent)
+        if payload:
+            await asyncio.to_thread(
+                result_cache.put, url, payload, mode,
+                extractor=sent[0].get('extractor'),
+                media_id=sent[0].get('media_id')
+            )
             
+        await reporter.stop()
         await status_msg.delete()
 
     except Exception as e:
@@ -288,8 +419,7 @@ async def handle_message(message: types.Message, state: FSMContext):
         error_trace = traceback.format_exc()
         logging.error(f"Handler error: {error_trace}")
         
-        stop_animation = True
-        animation_task.cancel()
+        await reporter.stop()
         
         error_msg = str(e)
         if "ffmpeg" in error_msg.lower():
@@ -309,39 +439,51 @@ async def cb_convert_mp3(callback: CallbackQuery):
         data = callback.data.split(":")
         file_id = data[1]
         
-        # Search for the video file with this ID in downloads
-        # We need to find the file that starts with this UUID
-        target_file = None
-        for file in os.listdir(downloader.download_path):
-            if file.startswith(file_id) and file.endswith(('.mp4', '.mkv', '.mov', '.webm')):
-                target_file = os.path.join(downloader.download_path, file)
-                break
+        # Look up the download job for this ID
+        job = downloader.jobs.get(file_id)
+        video = job.find(MediaType.VIDEO) if job else None
         
-        if not target_file or not os.path.exists(target_file):
+        # Keep the job's files around while we convert
+        if not video or not downloader.acquire(file_id):
             await callback.answer("❌ File expired or not found.", show_alert=True)
             return
-
-        status_msg = await callback.message.answer("⏳ <b>Converting to MP3...</b>")
-        
         try:
-            mp3_path = await downloader.convert_video_to_mp3(target_file)
-            
-            audio_file = FSInputFile(mp3_path)
-            await callback.message.answer_audio(
-                audio_file,
-                caption="🎵 <b>Converted to MP3</b>\nVia @DownloaderMikitabot"
-            )
-            
-            await status_msg.delete()
-            asyncio.create_task(cleanup_later([mp3_path]))
-            
-        except Exception as e:
-            await status_msg.edit_text(f"❌ <b>Conversion Failed:</b> {str(e)}")
+            target_file = video['path']
+            # ffmpeg needs the video on disk, even if it was only kept in memory
+            await asyncio.to_thread(job.materialize, video)
+
+            status_msg = await callback.message.answer("⏳ <b>Converting to MP3...</b>")
+            try:
+                audio = await audio_pipeline.extract(file_id, target_file)
+
+                # AAC tracks are copied as they are into an .m4a, which Telegram plays the same way
+                caption = "🎵 <b>Converted to MP3</b>" if audio['path'].endswith(".mp3") else "🎵 <b>Audio extracted</b>"
+                sent_msg = await callback.message.answer_audio(
+                    audio['file_id'] or FSInputFile(audio['path']),
+                    caption=caption + "\nVia @DownloaderMikitabot"
+                )
+                audio_pipeline.remember_file_id(file_id, sent_msg.audio.file_id if sent_msg.audio else None)
+
+                await status_msg.delete()
+
+            except Exception as e:
+                await status_msg.edit_text(f"❌ <b>Conversion Failed:</b> {str(e)}")
+        finally:
+            # The audio lives in the job directory and goes away with it
+            downloader.release(file_id)
             
     except Exception as e:
         logging.error(f"Conversion error: {e}")
         await callback.answer("❌ An error occurred.", show_alert=True)
 
+@router.callback_query(F.data.startswith("cancel:"))
+async def cb_cancel(callback: CallbackQuery):
+    cancel_id = callback.data.split(":", 1)[1]
+    if downloader.cancel(cancel_id, user_id=callback.from_user.id):
+        await callback.answer("✖️ Cancelling...")
+    else:
+        await callback.answer("Nothing to cancel.")
+
 @router.callback_query(F.data == "coming_soon")
 async def cb_coming_soon(callback: CallbackQuery):
     await callback.answer("🚧 This feature is coming soon!", show_alert=True)
@@ -16,17 +16,77 @@ logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 # Initialize Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Public base URL Telegram should call, e.g. https://bot.example.com.
+# Leave empty to run the webhook server without registering it (local testing).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token; must be the same on every replica
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+
+async def run_webhook(bot, dp):
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application()
+    # Answer Telegram right away and run the handlers in the background,
+    # so a slow download never holds up delivery of other updates
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+    ).register(app, path=WEBHOOK_PATH)
+    # For load balancer health checks
+    app.router.add_get("/health", lambda request: web.Response(text="ok"))
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Webhook registered at {WEBHOOK_URL}{WEBHOOK_PATH}")
+    else:
+        logging.warning("WEBHOOK_URL is not set; webhook not registered with Telegram.")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     if not BOT_TOKEN or BOT_TOKEN == "your_bot_token_here":
         logging.error("BOT_TOKEN is not set in .env file.")
         return
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        logging.error("WEBHOOK_SECRET must be set in webhook mode.")
+        return
+
+    # Resolve ffmpeg and build yt-dlp option templates once, before any download
+    from services.environment import get_environment
+    get_environment()
 
     # Initialize Bot and Dispatcher
     from aiogram.client.session.aiohttp import AiohttpSession
     session = AiohttpSession(timeout=300)
+    # Shape outgoing requests to Telegram's flood limits
+    from services.outbound import create_outbound_scheduler
+    session.middleware(create_outbound_scheduler())
     bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    from aiogram.fsm.storage.memory import MemoryStorage
-    dp = Dispatcher(storage=MemoryStorage())
+    # FSM state lives in memory, SQLite or Redis (FSM_STORAGE) so replicas can share it
+    from services.storage import create_storage
+    dp = Dispatcher(storage=create_storage())
 
     # Import and include routers (handlers)
     from handlers import messages, languages
@@ -35,8 +95,27 @@ async def main():
     
     # We will uncomment the above once we create the handlers
 
-    logging.info("Bot is starting...")
-    await dp.start_polling(bot)
+    # Clear leftovers of the previous run and start expiring finished downloads
+    from services.downloader import downloader
+    downloader.janitor.start()
+    # Counters and timings (formats chosen, transcodes, cache hits...) go to the log
+    from services.metrics import metrics
+    metrics.start()
+    # yt-dlp threads run segmented downloads on this loop's connection pool
+    from services.segmented import segmented
+    segmented.attach(asyncio.get_running_loop())
+
+    logging.info(f"Bot is starting ({BOT_MODE})...")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # A webhook left over from a webhook deployment blocks getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        from services.http import http_client
+        await http_client.close()
 
 if __name__ == "__main__":
     try:
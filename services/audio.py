@@ -0,0 +1,98 @@
+import os
+import asyncio
+import logging
+from services.ffmpeg import ffmpeg_pool, FFmpegError
+from services.metrics import metrics
+
+# Audio codecs Telegram's player takes as is (sendAudio wants MP3 or M4A),
+# mapped to the container they are copied into
+COPYABLE = {
+    'aac': 'm4a',
+    'mp3': 'mp3',
+}
+
+
+class AudioPipeline:
+    """
+    Extracts the audio track of downloaded videos ("Convert to MP3").
+
+    The source is probed first (with ffprobe, or ffmpeg's own listing of
+    the input where ffprobe isn't installed): AAC and MP3 tracks are
+    copied into an .m4a/.mp3 file without re-encoding; anything else
+    (Opus, Vorbis, ...) is encoded to MP3. Results are kept per group_id
+    for as long as the job's files exist, and presses while a conversion
+    runs share it.
+    """
+
+    def __init__(self, pool, max_entries=1000):
+        self.pool = pool
+        self.max_entries = max_entries
+        # group_id -> {'path', 'codec', 'copied', 'file_id'}
+        self._outputs = {}
+        self._running = {}
+
+    def get(self, group_id):
+        entry = self._outputs.get(group_id)
+        if entry and not os.path.exists(entry['path']):
+            # The janitor removed the job
+            del self._outputs[group_id]
+            return None
+        return entry
+
+    def remember_file_id(self, group_id, file_id):
+        """Stores the Telegram file_id of the sent audio so it is never uploaded twice."""
+        entry = self._outputs.get(group_id)
+        if entry and file_id:
+            entry['file_id'] = file_id
+
+    async def extract(self, group_id, video_path):
+        entry = self.get(group_id)
+        if entry:
+            metrics.incr('audio.cache_hits')
+            return entry
+
+        task = self._running.get(group_id)
+        if task is None:
+            task = asyncio.ensure_future(self._extract(video_path))
+            self._running[group_id] = task
+            task.add_done_callback(lambda t: self._finish(group_id, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, group_id, task):
+        self._running.pop(group_id, None)
+        if task.cancelled() or task.exception():
+            return
+        if len(self._outputs) >= self.max_entries:
+            for stale in [g for g, e in self._outputs.items() if not os.path.exists(e['path'])]:
+                del self._outputs[stale]
+        self._outputs[group_id] = task.result()
+
+    async def _extract(self, video_path):
+        if not os.path.exists(video_path):
+            raise FileNotFoundError("Video file not found.")
+
+        codec = await self.pool.audio_codec(video_path)
+        if codec is None:
+            raise FFmpegError("The video has no audio track.")
+
+        base_name = os.path.splitext(video_path)[0]
+        if codec in COPYABLE:
+            ext = COPYABLE[codec]
+            out_path = f"{base_name}.{ext}"
+            args = ["-i", video_path, "-map", "0:a:0", "-vn", "-c:a", "copy"]
+            if ext == 'm4a':
+                args += ["-movflags", "+faststart"]
+            metrics.incr('audio.copied')
+        else:
+            out_path = f"{base_name}.mp3"
+            args = ["-i", video_path, "-map", "0:a:0", "-vn", "-c:a", "libmp3lame", "-q:a", "2"]
+            metrics.incr('audio.transcoded')
+
+        logging.info(f"Extracting {codec} audio from {video_path} to {out_path}...")
+        await self.pool.run([*args, "-y", out_path])
+        if not os.path.exists(out_path):
+            raise FFmpegError("Output audio not created.")
+        return {'path': out_path, 'codec': codec, 'copied': codec in COPYABLE, 'file_id': None}
+
+
+audio_pipeline = AudioPipeline(ffmpeg_pool)
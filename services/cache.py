@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters that only describe where a link was shared from.
+# Stripping them lets reposts of the same post hit the same cache entry.
+TRACKING_PARAMS = {
+    'igsh', 'igshid', 'utm_source', 'utm_medium', 'utm_campaign', 'utm_term',
+    'utm_content', 'si', 'feature', 'is_from_webapp', 'sender_device',
+    'sender_web_id', 'share_app_id', 'share_link_id', 'mibextid', 'rdid',
+    'ref', 'ref_src', 's', 't', '_r', '_t', 'fbclid', 'gclid',
+}
+
+def normalize_url(url: str) -> str:
+    """
+    Returns a canonical form of the URL used for cache and dedup keys.
+    Search queries (ytsearch1:...) are returned unchanged.
+    """
+    url = url.strip()
+    if not url.startswith(("http://", "https://")):
+        return url
+
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m.", "mobile.", "web."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in TRACKING_PARAMS]
+    query.sort()
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+
+# yt-dlp extractors whose links keep pointing at changing content (a
+# user's current stories, a profile, a live stream); their id is the
+# user or channel, not a post. Their results are only cached briefly.
+VOLATILE_EXTRACTORS = {
+    'instagramstory', 'instagramuser', 'instagramtag',
+    'tiktokuser', 'tiktoklive', 'twitchstream',
+    'youtubetab', 'soundclouduser', 'vkwall',
+}
+
+
+def is_volatile(extractor):
+    return bool(extractor) and extractor.lower() in VOLATILE_EXTRACTORS
+
+
+class ResultCache:
+    """
+    Persistent cache of what we already sent to Telegram for a link.
+
+    Entries hold the Telegram file_ids of the uploaded media, so a repeat
+    link can be answered without downloading or uploading anything.
+    Entries are keyed by the yt-dlp extractor + id when known, and every
+    normalized URL that resolved to them is stored as an alias.
+    Results of VOLATILE_EXTRACTORS are keyed by their URL only and kept
+    for volatile_ttl seconds (0: not cached).
+
+    Calls block on SQLite; callers on the event loop use asyncio.to_thread().
+    """
+
+    def __init__(self, path, ttl=3 * 24 * 3600, max_entries=5000, volatile_ttl=600):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self.volatile_ttl = volatile_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        # Per-entry lifetime (NULL: the cache's ttl); older databases lack the column
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(results)")}
+        if 'ttl' not in columns:
+            try:
+                self._db.execute("ALTER TABLE results ADD COLUMN ttl REAL")
+            except sqlite3.OperationalError:
+                # Another process added it first
+                pass
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS aliases ("
+            " url_key TEXT PRIMARY KEY, key TEXT NOT NULL)"
+        )
+
+    @staticmethod
+    def _url_key(url, mode):
+        return f"url:{mode}:{normalize_url(url)}"
+
+    @staticmethod
+    def _media_key(extractor, media_id, mode):
+        return f"media:{mode}:{extractor.lower()}:{media_id}"
+
+    def _load(self, key):
+        row = self._db.execute("SELECT payload, created_at, ttl FROM results WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        payload, created_at, ttl = row
+        now = time.time()
+        if now - created_at > (ttl or self.ttl):
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            return None
+        self._db.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(payload)
+
+    def get(self, url, mode="video"):
+        url_key = self._url_key(url, mode)
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT key FROM aliases WHERE url_key = ?", (url_key,)).fetchone()
+                return self._load(row[0] if row else url_key)
+            except sqlite3.Error as e:
+                logging.error(f"Result cache read failed: {e}")
+                return None
+
+    def get_media(self, extractor, media_id, mode="video"):
+        if not extractor or not media_id:
+            return None
+        with self._lock:
+            try:
+                return self._load(self._media_key(extractor, media_id, mode))
+            except sqlite3.Error as e:
+                logging.error(f"Result cache read failed: {e}")
+                return None
+
+    def put(self, url, payload, mode="video", extractor=None, media_id=None):
+        url_key = self._url_key(url, mode)
+        ttl = None
+        if is_volatile(extractor):
+            if not self.volatile_ttl:
+                return
+            # The id names a user or channel, not this content
+            ttl, extractor = self.volatile_ttl, None
+        key = self._media_key(extractor, media_id, mode) if extractor and media_id else url_key
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, payload, created_at, last_used, ttl) VALUES (?, ?, ?, ?, ?)",
+                    (key, json.dumps(payload), now, now, ttl)
+                )
+                self._db.execute("INSERT OR REPLACE INTO aliases (url_key, key) VALUES (?, ?)", (url_key, key))
+                self._evict()
+            except sqlite3.Error as e:
+                logging.error(f"Result cache write failed: {e}")
+
+    def _evict(self):
+        # Drop expired entries, then the least recently used ones over the limit
+        now = time.time()
+        self._db.execute(
+            "DELETE FROM results WHERE created_at < ? OR (ttl IS NOT NULL AND created_at < ? - ttl)",
+            (now - self.ttl, now)
+        )
+        count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self._db.execute("DELETE FROM aliases WHERE key NOT IN (SELECT key FROM results)")
+
+
+result_cache = ResultCache(
+    os.getenv("RESULT_CACHE_PATH", "cache/results.db"),
+    ttl=int(os.getenv("RESULT_CACHE_TTL", str(3 * 24 * 3600))),
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", "5000")),
+    volatile_ttl=int(os.getenv("RESULT_CACHE_VOLATILE_TTL", "600")),
+)
@@ -1,117 +1,432 @@
 import os
-import shutil
+import copy
 import logging
 import yt_dlp
+from yt_dlp.postprocessor.common import PostProcessor
 import uuid
 import asyncio
-import requests
-from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor
+import aiofiles
 from enum import Enum
+from services.cache import normalize_url, result_cache
+from services.scheduler import scheduler, platform_of
+from services.environment import get_environment
+from services.jobs import JobIndex
+from services.progress import Progress, DOWNLOADING
+from services.janitor import DiskJanitor
+from services.formats import select_format, clear_selection, sendable_rank, SENDABLE, MediaTooLargeError
+from services.metrics import metrics
+from services.segmented import segmented, SegmentedYoutubeDL
+from services.http import http_client
+from services.memory import memory_budget
+from services.facebook import facebook_resolver
+from services.queue import get_job_queue
+from services.info_cache import info_cache
+from services.execution import Watchdog, DownloadCancelled, run_in_process
+from services.music import (
+    music_cache, track_key, fetch_search_query, spotify_query, apple_music_query, YOUTUBE_WATCH
+)
 
 class MediaType(Enum):
     VIDEO = 'video'
     AUDIO = 'audio'
     IMAGE = 'image'
 
+# Post-processors by the kind of work they do to the file
+PROCESSING_KINDS = {
+    'Merger': 'remux',
+    'VideoRemuxer': 'remux',
+    'FixupM3u8': 'remux',
+    'FixupM4a': 'remux',
+    'FixupStretched': 'remux',
+    'FixupDuplicateMoov': 'remux',
+    'FixupTimestamp': 'remux',
+    'FixupDuration': 'remux',
+    'VideoConvertor': 'transcode',
+    'ExtractAudio': 'audio',
+}
+
+# _download_sync() result for a post that was already sent under another link
+SENT_BEFORE = 'sent_before'
+# _download_sync() result for posts whose files are fetched straight into memory
+IN_MEMORY = 'in_memory'
+# Formats that are uploaded exactly as they are downloaded
+MEMORY_TYPES = {
+    'mp4': MediaType.VIDEO,
+    'jpg': MediaType.IMAGE,
+    'jpeg': MediaType.IMAGE,
+    'png': MediaType.IMAGE,
+    'webp': MediaType.IMAGE,
+}
+
+
+# Fields of a memory_item() that end up on the media item, per type
+MEDIA_FIELDS = {
+    MediaType.VIDEO.value: ('title', 'duration', 'width', 'height', 'entry_id'),
+    MediaType.IMAGE.value: ('title',),
+}
+
+
+def memory_item(info, max_bytes):
+    """
+    What to fetch for a processed (format-selected) entry if its file can
+    be kept in memory: a single plain-HTTP file, not known to be over
+    max_bytes, that is sent as is. None otherwise.
+    """
+    if info.get('requested_formats') or info.get('fragments') or info.get('cookies'):
+        return None
+    if info.get('protocol') not in ('http', 'https') or not info.get('url'):
+        return None
+    ext = (info.get('ext') or '').lower()
+    media_type = MEMORY_TYPES.get(ext)
+    if media_type is None:
+        return None
+    if media_type == MediaType.VIDEO and sendable_rank(info) != SENDABLE:
+        return None
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size and size > max_bytes:
+        return None
+    return {
+        'type': media_type.value,
+        'url': info['url'],
+        'headers': dict(info.get('http_headers') or {}),
+        'ext': ext,
+        'format_id': info.get('format_id'),
+        'vcodec': info.get('vcodec'),
+        'acodec': info.get('acodec'),
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'width': info.get('width'),
+        'height': info.get('height'),
+        'entry_id': info.get('id'),
+    }
+
+def processing_report(snapshot):
+    """Metrics log line on how many finished jobs needed a remux or a transcode."""
+    counters = snapshot['counters']
+    counts = {kind: counters.get(f'jobs.{kind}', 0) for kind in ('sent_as_is', 'remuxed', 'transcoded')}
+    total = sum(counts.values())
+    if not total:
+        return None
+    shares = ", ".join(f"{kind.replace('_', ' ')} {count / total:.0%}" for kind, count in counts.items())
+    return f"Post-processing: {total} jobs, {shares}"
+
+
+def media_to_json(media):
+    # Memory buffers don't cross processes; the front-end reads the file
+    item = {**media, 'type': media['type'].value}
+    item.pop('data', None)
+    return item
+
+
+def media_from_json(item):
+    return {**item, 'type': MediaType(item['type'])}
+
+
+class _EntryReady(PostProcessor):
+    # Runs after each entry's files are moved to their final place
+    def __init__(self, callback):
+        super().__init__()
+        self._callback = callback
+
+    def run(self, info):
+        try:
+            self._callback(info)
+        except Exception as e:
+            logging.error(f"Entry callback failed: {e}")
+        return [], info
+
+
+class MediaFeed:
+    """
+    Media items of one job in the order they became ready. Every reader
+    gets all of them from the start, so requests that join an in-flight
+    download see the items that were already sent to others.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self._paths = set()
+        self._event = asyncio.Event()
+
+    def put(self, media):
+        # Items answered from the result cache have a file_id instead of a file
+        key = media.get('path') or media.get('file_id')
+        if self.done or key in self._paths:
+            return
+        self._paths.add(key)
+        self.items.append(media)
+        self._wake()
+
+    def close(self):
+        self.done = True
+        self._wake()
+
+    def _wake(self):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def read(self, stop=None):
+        # stop() returning True ends this reader (it pressed Cancel)
+        index = 0
+        while True:
+            event = self._event
+            while index < len(self.items):
+                yield self.items[index]
+                index += 1
+            if self.done:
+                return
+            await event.wait()
+            if stop and stop():
+                raise DownloadCancelled('cancelled')
+
+
 class DownloaderService:
     def __init__(self, download_path="downloads"):
         # Ensure absolute path to avoid issues
         self.download_path = os.path.abspath(download_path)
         if not os.path.exists(self.download_path):
             os.makedirs(self.download_path)
+        self.jobs = JobIndex(self.download_path, budget=memory_budget)
+        # Bot API upload limit; formats are chosen to fit under it
+        self.max_upload_bytes = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+        # "inline" runs yt-dlp in this process, "queue" hands jobs to worker.py processes
+        self.backend = os.getenv("DOWNLOAD_BACKEND", "inline").lower()
+        # Removes finished jobs after DOWNLOAD_TTL and under disk pressure
+        self.janitor = DiskJanitor(
+            self.jobs,
+            ttl=int(os.getenv("DOWNLOAD_TTL", "300")),
+            max_bytes=int(os.getenv("DOWNLOADS_MAX_BYTES", "0")),
+            high_water=float(os.getenv("DISK_HIGH_WATER", "0.85")),
+            low_water=float(os.getenv("DISK_LOW_WATER", "0.70")),
+            # Workers write into the same folder; leave their running jobs alone
+            orphan_age=int(os.getenv("ORPHAN_AGE", "21600")) if self.backend == "queue" else 0,
+        )
+        # "thread" runs yt-dlp on the scheduler threads, "process" in a child
+        # process per job that can be killed when it hangs or is cancelled
+        self.executor = os.getenv("DOWNLOAD_EXECUTOR", "thread").lower()
+        # Wall-clock limit per job, and how long a transfer may go without bytes (0 = off)
+        self.timeout = int(os.getenv("DOWNLOAD_TIMEOUT", "900"))
+        self.stall_timeout = int(os.getenv("DOWNLOAD_STALL_TIMEOUT", "120"))
+        # Downloads currently running, keyed by (normalized url, mode).
+        # Concurrent requests for the same link wait on the same task.
+        self._inflight = {}
+        # cancel_id -> (watchdog, feed, user_id) of requests that can be cancelled
+        self._waiters = {}
+        # Number of requests still using each job's files
+        self._refs = {}
             
-    def _get_ffmpeg_path(self):
-        # Check if in PATH
-        if shutil.which("ffmpeg"):
-            return None # yt-dlp finds it automatically
-        
-        # Check well-known WinGet path (User-specific)
-        # Adapt this based on the specific version found earlier or search generic pattern
-        base_path = os.path.expandvars(r"%LOCALAPPDATA%\Microsoft\WinGet\Packages")
-        if os.path.exists(base_path):
-            for root, dirs, files in os.walk(base_path):
-                if "ffmpeg.exe" in files:
-                    return os.path.join(root, "ffmpeg.exe")
-        
-        return None
+    def _get_opts(self, outtmpl, is_audio=False, mode=None):
+        # Options come from the templates built once at startup
+        mode = mode or ('audio' if is_audio else 'video')
+        return get_environment().options(mode, outtmpl=outtmpl)
 
-    def _get_opts(self, filename_id, is_audio=False):
-        ffmpeg_location = self._get_ffmpeg_path()
-        if ffmpeg_location:
-            logging.info(f"Using FFmpeg at: {ffmpeg_location}")
-        else:
-            logging.warning("FFmpeg NOT found by auto-detection.")
-
-        opts = {
-            'outtmpl': f'{self.download_path}/{filename_id}_%(autonumber)s.%(ext)s', # Handling multiple files
-            'noplaylist': True, # We usually want single posts, but might be a carousel
-            'quiet': False, # Enable stdout for debug
-            'verbose': True, # Enable verbose for debug
-            'no_warnings': False,
-            'writethumbnail': True, # Ensure we get thumbnails
-            'nocache_dir': True, # Disable cache
-            'http_headers': {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'},
-        }
-        
-        if ffmpeg_location:
-            opts['ffmpeg_location'] = os.path.dirname(ffmpeg_location) # yt-dlp expects the directory, not the exe
-
-        # Check for cookies.txt
-        cookies_path = os.path.join(self.download_path, "..", "cookies.txt")
-        if os.path.exists(cookies_path):
-             opts['cookiefile'] = cookies_path
-
-        if is_audio:
-            opts.update({
-                'format': 'bestaudio/best',
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }],
-            })
-        else:
-            opts.update({
-                # Ensure we select video or audio or separate components
-                # For TikTok images it might download m4a audio and jpg images separately if not careful
-                'format': 'bestvideo+bestaudio/best', 
-                'merge_output_format': 'mp4', # Force MP4 container only for video
-            })
-        return opts
-
-    async def download_media(self, url: str, force_audio: bool = False):
+    async def download_media(self, url: str, force_audio: bool = False, user_id=None, progress=None, cancel_id=None):
         """
         Downloads media (Video, Audio, Images) from the given URL.
         Returns a LIST of dictionaries with 'type', 'path', 'title', etc.
+
+        If the same link is already being downloaded, waits for that job
+        instead of starting another one. Every caller gets its own copy of
+        the result and must call release() on its group_id when done with it.
+
+        progress (a Progress) is updated with the queue position and
+        yt-dlp's download/post-processing state.
+        cancel_id registers the request for cancel(); the job is stopped once
+        all of its cancellable requests were cancelled.
+        Raises QueueFullError when the download queue is full, and
+        DownloadCancelled when cancelled or past its time limits.
+        """
+        task, _ = self._start(url, force_audio, user_id, progress, cancel_id)
+
+        try:
+            # Shield so one waiter giving up does not cancel the job for the others
+            media_list = await asyncio.shield(task)
+        finally:
+            self._waiters.pop(cancel_id, None)
+
+        for group_id in {media['group_id'] for media in media_list}:
+            self.acquire(group_id)
+        return [dict(media) for media in media_list]
+
+    async def stream_media(self, url: str, force_audio: bool = False, user_id=None, progress=None, cancel_id=None):
+        """
+        Like download_media(), but yields each media item as soon as its
+        files are final, so carousels can be uploaded while the rest is
+        still downloading. Each yielded item's group_id is acquired before
+        it is yielded and must be released by the caller.
+        Raises the job's error after the items that did finish.
+        """
+        task, feed = self._start(url, force_audio, user_id, progress, cancel_id)
+        watchdog = self._waiters[cancel_id][0] if cancel_id else None
+        stop = (lambda: cancel_id in watchdog.dropped) if watchdog else None
+        acquired = set()
+        try:
+            async for media in feed.read(stop):
+                if media['group_id'] not in acquired and self.acquire(media['group_id']):
+                    acquired.add(media['group_id'])
+                yield dict(media)
+            await asyncio.shield(task)
+        finally:
+            self._waiters.pop(cancel_id, None)
+
+    def _start(self, url, force_audio, user_id, progress, cancel_id=None):
+        """Starts the download, or joins the one already running for this link."""
+        key = (normalize_url(url), 'audio' if force_audio else 'video')
+        entry = self._inflight.get(key)
+        if entry is None:
+            job_progress = progress or Progress()
+            feed = MediaFeed()
+            watchdog = Watchdog(self.timeout, self.stall_timeout)
+            if self.backend == "queue":
+                coro = self._download_remote(url, force_audio, user_id, job_progress, feed, watchdog)
+            else:
+                coro = self._download_media(url, force_audio, user_id, job_progress, feed, watchdog)
+            task = asyncio.ensure_future(coro)
+            self._inflight[key] = (task, job_progress, feed, watchdog)
+            task.add_done_callback(lambda t: self._finish_inflight(key, t))
+        else:
+            logging.info(f"Joining in-flight download for {url}")
+            task, job_progress, feed, watchdog = entry
+            if progress:
+                progress.follow(job_progress)
+        if cancel_id:
+            watchdog.waiters.add(cancel_id)
+            self._waiters[cancel_id] = (watchdog, feed, user_id)
+        return task, feed
+
+    def cancel(self, cancel_id, user_id=None):
+        """
+        Stops waiting for the request registered as cancel_id (only its own
+        user may cancel it). The download itself is stopped, and its process
+        killed in process mode, once no other request is waiting for it.
+        Returns False if there is nothing to cancel.
+        """
+        entry = self._waiters.get(cancel_id)
+        if entry is None:
+            return False
+        watchdog, feed, owner = entry
+        if owner is not None and user_id is not None and owner != user_id:
+            return False
+        del self._waiters[cancel_id]
+        logging.info(f"Request {cancel_id} cancelled")
+        watchdog.drop(cancel_id)
+        # Wake the reader so it notices
+        feed._wake()
+        return True
+
+    def _finish_inflight(self, key, task):
+        entry = self._inflight.get(key)
+        if entry and entry[0] is task:
+            del self._inflight[key]
+            feed = entry[2]
+            # Items the job ended up with that no hook reported (fallbacks, scans)
+            if not task.cancelled() and not task.exception():
+                for media in task.result():
+                    feed.put(media)
+            feed.close()
+        # Mark the exception as retrieved in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def acquire(self, group_id):
+        """Keeps a job's files on disk until the matching release()."""
+        if self.jobs.get(group_id) is None:
+            return False
+        self._refs[group_id] = self._refs.get(group_id, 0) + 1
+        self.janitor.revive(group_id)
+        return True
+
+    def release(self, group_id):
+        """
+        Drops a reference. Once the last user is done the job is handed to
+        the janitor, which keeps it for DOWNLOAD_TTL seconds, and its memory
+        buffers are returned to the budget.
+        """
+        refs = self._refs.get(group_id, 0) - 1
+        if refs > 0:
+            self._refs[group_id] = refs
+            return
+        self._refs.pop(group_id, None)
+        self.janitor.retire(group_id)
+        job = self.jobs.get(group_id)
+        if job is not None and job.buffers:
+            # Sent: give the memory back (videos are written out off the event loop)
+            asyncio.get_running_loop().run_in_executor(None, self.jobs.unbuffer, group_id, (MediaType.VIDEO,))
+
+    def hand_off(self, group_id):
+        """
+        Worker side: the job's files now belong to the front-end that
+        picked up the result, so forget about them without deleting.
+        """
+        self._refs.pop(group_id, None)
+        self.jobs.forget(group_id)
+
+    async def _download_remote(self, url, force_audio=False, user_id=None, progress=None, feed=None, watchdog=None):
         """
+        Queue backend: enqueues the link and waits for a worker to publish the
+        result. The worker enforces the time limits; a cancel here deletes the
+        job, which the worker notices on its next heartbeat.
+        """
+        queue = get_job_queue()
+        job_id = await asyncio.to_thread(queue.enqueue, url, force_audio=force_audio, user_id=user_id)
+        logging.info(f"Queued {url} as job {job_id}")
+        stop = watchdog.expired if watchdog else None
+        media_list = [media_from_json(item) for item in await queue.wait(job_id, progress, stop=stop)]
+
+        # Take ownership of the files so release() and the janitor manage them
+        for group_id in {media['group_id'] for media in media_list if media.get('path')}:
+            job = self.jobs.create(group_id, url=url)
+            job.media = [media for media in media_list if media['group_id'] == group_id]
+        return media_list
+
+    async def _download_media(self, url: str, force_audio: bool = False, user_id=None, progress=None, feed=None, watchdog=None):
         filename_id = str(uuid.uuid4())
         loop = asyncio.get_running_loop()
+        # Every job downloads into its own directory
+        job = self.jobs.create(filename_id, url=url)
+        outtmpl = os.path.join(job.directory, '%(autonumber)s.%(ext)s')
         
+        # Facebook fallback info in case yt-dlp fails
+        fb_fallback_info = None
+
         # Check for Music Platforms
         is_music_search = False
         search_query = None
+        # What to remember the chosen YouTube video under, once we have it
+        music_track = None
+        free_search = None
+        cached_video = None
         
-        if "spotify.com" in url:
-            search_query = self._get_spotify_metadata(url)
-            is_music_search = True
-        elif "music.apple.com" in url:
-            search_query = self._get_apple_music_metadata(url)
+        if "spotify.com" in url or "music.apple.com" in url:
             is_music_search = True
+            music_track = track_key(url)
+            # Popular tracks skip the page scrape and the YouTube search
+            search_query, cached_video = music_cache.get_track(music_track)
+            if not search_query:
+                if "spotify.com" in url:
+                    search_query = await self._get_spotify_metadata(url)
+                else:
+                    search_query = await self._get_apple_music_metadata(url)
+        elif url.startswith("ytsearch1:"):
+            free_search = url[len("ytsearch1:"):]
+            cached_video = music_cache.get_search(free_search)
             
         if is_music_search:
             if not search_query:
                 logging.error("Could not extract metadata for music link.")
+                self.jobs.remove(filename_id)
                 return []
-            target_url = f"ytsearch1:{search_query}"
-            opts = self._get_opts(filename_id, is_audio=True)
-            # Override outtmpl for single file search
-            opts['outtmpl'] = f'{self.download_path}/{filename_id}.%(ext)s'
+            target_url = YOUTUBE_WATCH.format(cached_video) if cached_video else f"ytsearch1:{search_query}"
+            opts = self._get_opts(outtmpl, mode='music_search')
+        elif cached_video:
+            logging.info(f"Search '{free_search}' answered from cache: {cached_video}")
+            target_url = YOUTUBE_WATCH.format(cached_video)
+            opts = self._get_opts(outtmpl, is_audio=True)
         elif "facebook.com/share/" in url or "fb.watch/" in url:
              # Handle Facebook Share Links specifically
              logging.info("Detected Facebook Share link. Attempting manual resolution...")
-             # Use default executor
-             resolved_info = await loop.run_in_executor(None, lambda: self._resolve_facebook_share(url))
+             resolved_info = await facebook_resolver.resolve(url)
              
              if resolved_info and resolved_info.get('resolved_url'):
                  target_url = resolved_info['resolved_url']
@@ -120,45 +435,64 @@ class DownloaderService:
                  target_url = url
                  
              is_soundcloud = False
-             opts = self._get_opts(filename_id, is_audio=False)
+             opts = self._get_opts(outtmpl, is_audio=False)
              
              # Store fallback info in case yt-dlp fails
-             self._fb_fallback_info = resolved_info
+             fb_fallback_info = resolved_info
         else:
             target_url = url
             is_soundcloud = "soundcloud.com" in url
             # If force_audio is True, treat as audio
-            opts = self._get_opts(filename_id, is_audio=is_soundcloud or force_audio)
+            opts = self._get_opts(outtmpl, is_audio=is_soundcloud or force_audio)
         
-        # loop defined above
+        # Result cache mode the handler stores this link's file_ids under
+        mode = 'audio' if force_audio else 'video'
+        memory_max = memory_budget.item_max if memory_budget.enabled else 0
+        # Report real progress from yt-dlp
+        watchdog = watchdog or Watchdog(self.timeout, self.stall_timeout)
+        opts['progress_hooks'] = [progress.ytdl_hook, watchdog.ytdl_hook]
+        opts['postprocessor_hooks'] = [progress.ytdl_pp_hook, self._processing_hook(job), watchdog.ytdl_pp_hook]
+        # Items go out one by one as their files are done
+        on_entry = self._entry_hook(job, feed, is_music_search) if feed else None
+
+        def work():
+            # The time limits count from when the job gets a worker
+            watchdog.start()
+            if self.executor == "process":
+                return run_in_process(target_url, opts, on_entry, watchdog, mode=mode, memory_max=memory_max)
+            return self._download_sync(target_url, opts, on_entry, mode=mode, memory_max=memory_max)
         
         try:
-            with ThreadPoolExecutor() as pool:
-                info_dict = await loop.run_in_executor(
-                    pool, 
-                    lambda: self._download_sync(target_url, opts)
-                )
+            # Runs on the shared worker pool, waiting in line if it is busy
+            info_dict = await scheduler.run(
+                work,
+                user_id=user_id,
+                platform=platform_of(target_url),
+                on_queued=progress.set_queued
+            )
             
             # Check for fallback if yt-dlp failed (info_dict is None) and we have fallback info
-            if info_dict is None and hasattr(self, '_fb_fallback_info') and self._fb_fallback_info:
+            if info_dict is None and fb_fallback_info:
                 logging.info("yt-dlp failed, using Facebook fallback info.")
-                fallback = self._fb_fallback_info
+                fallback = fb_fallback_info
                 
                 # Check for direct video first!
                 if fallback.get('video'):
                     video_url = fallback['video']
                     ext = 'mp4'
-                    video_path = os.path.join(self.download_path, f"{filename_id}.{ext}")
+                    video_path = os.path.join(job.directory, f"video.{ext}")
                     
                     logging.info("Fallback: Found video URL, downloading manually...")
-                    await loop.run_in_executor(None, lambda: self._download_file(video_url, video_path))
+                    await self._download_file(video_url, video_path, job)
                     
-                    return [{
+                    job.media = [{
                         'type': MediaType.VIDEO,
                         'path': video_path,
+                        'data': job.buffers.get(video_path),
                         'title': fallback.get('title', 'Facebook Video'),
                         'group_id': filename_id
                     }]
+                    return job.media
 
                 # Fallback to image if no video
                 if fallback.get('image'):
@@ -167,333 +501,331 @@ class DownloaderService:
                     ext = image_url.split('?')[0].split('.')[-1]
                     if len(ext) > 4 or '/' in ext: ext = 'jpg'
                     
-                    image_path = os.path.join(self.download_path, f"{filename_id}.{ext}")
+                    image_path = os.path.join(job.directory, f"image.{ext}")
                     
                     # Download image
-                    await loop.run_in_executor(None, lambda: self._download_file(image_url, image_path))
+                    await self._download_file(image_url, image_path, job)
                     
-                    return [{
+                    job.media = [{
                         'type': MediaType.IMAGE,
                         'path': image_path,
+                        'data': job.buffers.get(image_path),
                         'title': fallback.get('title', 'Facebook Image'),
                         'group_id': filename_id
                     }]
+                    return job.media
             
             if not info_dict:
                 return []
+
+            if info_dict.get('_type') == SENT_BEFORE:
+                logging.info(f"{url} is {info_dict['extractor']}:{info_dict['media_id']}, sent before; re-sending by file_id")
+                metrics.incr('result_cache.media_hits')
+                # Nothing was downloaded into this job
+                self.jobs.remove(filename_id)
+                return [
+                    {**item, 'type': MediaType(item['type']), 'extractor': info_dict['extractor'], 'media_id': info_dict['media_id']}
+                    for item in info_dict['items']
+                ]
             
+            if info_dict.get('_type') == IN_MEMORY:
+                progress.set_phase(DOWNLOADING)
+                job.media = await self._fetch_planned(info_dict, job)
+                self._record_metrics({'entries': info_dict['items']}, job)
+                return job.media
+
             # If search, unwrap entries
             if is_music_search and 'entries' in info_dict:
                 info_dict = info_dict['entries'][0]
+            self._remember_music(info_dict, music_track, search_query, free_search)
 
-            # Find all downloaded files matching this ID
-            downloaded_files = {}
-            for file in os.listdir(self.download_path):
-                if file.startswith(filename_id):
-                    full_path = os.path.join(self.download_path, file)
-                    # skip part files or temp files
-                    if file.endswith('.part') or file.endswith('.ytdl'):
-                        continue
-                    
-                    # Group by base name (without extension) to pair video+thumb
-                    # yt-dlp naming: ID_autonumber.ext
-                    base_name = os.path.splitext(file)[0]
-                    if base_name not in downloaded_files:
-                        downloaded_files[base_name] = {'files': []}
-                    downloaded_files[base_name]['files'].append(full_path)
-
-            if not downloaded_files:
-                return []
-
-            media_list = []
-            
-            # Map entries if available for better metadata
-            entries_map = {}
-            if 'entries' in info_dict:
-                # Try to map by index if possible, though autonumber is 1-based usually
-                for i, entry in enumerate(info_dict['entries']):
-                    entries_map[i] = entry
-            else:
-                entries_map[0] = info_dict
-
-            # Sort by autonumber index to match entries if possible
-            # Filenames: uuid_00001.mp4
-            sorted_base_names = sorted(downloaded_files.keys())
-
-            for idx, base_name in enumerate(sorted_base_names):
-                group = downloaded_files[base_name]
-                files = group['files']
-                
-                video_file = None
-                audio_file = None
-                image_file = None
-                thumb_file = None
-                
-                # Metadata source
-                meta = entries_map.get(idx, info_dict) 
-
-                for f in files:
-                    ext = f.split('.')[-1].lower()
-                    if ext in ['mp4', 'mkv', 'mov', 'webm']:
-                        video_file = f
-                    elif ext in ['mp3', 'm4a', 'wav', 'flac', 'ogg']:
-                        audio_file = f
-                    elif ext in ['jpg', 'jpeg', 'png', 'webp']:
-                        # Could be image or thumbnail
-                        # If we have a video in this group, treat as thumbnail
-                        image_file = f
-
-                if video_file:
-                    media_list.append({
-                        'type': MediaType.VIDEO,
-                        'path': video_file,
-                        'title': meta.get('title', 'Video'),
-                        'duration': meta.get('duration'),
-                        'thumb': image_file, # Local path to thumbnail
-                        'width': meta.get('width'),
-                        'height': meta.get('height'),
-                        'group_id': filename_id
-                    })
-                elif audio_file:
-                    media_list.append({
-                        'type': MediaType.AUDIO,
-                        'path': audio_file,
-                        'title': meta.get('title', 'Audio'),
-                        'duration': meta.get('duration'),
-                        'thumb': image_file, # Album art?
-                        'artist': meta.get('artist'),
-                        'group_id': filename_id
-                    })
-                elif image_file:
-                     media_list.append({
-                        'type': MediaType.IMAGE,
-                        'path': image_file,
-                        'title': meta.get('title', 'Image'),
-                        'group_id': filename_id
-                    })
-
-            return media_list
+            job.media = self._collect_media(info_dict, job)
+            self._record_metrics(info_dict, job)
+            return job.media
             
         except Exception as e:
             logging.error(f"Download failed: {e}")
             raise e
+        finally:
+            # Jobs that produced nothing have nobody to release them
+            if not job.media:
+                if self._refs.get(filename_id):
+                    # Failed halfway, but readers are already sending the finished items
+                    job.media = [media for media in (feed.items if feed else []) if media['group_id'] == filename_id]
+                else:
+                    self.jobs.remove(filename_id)
+
+    async def _get_spotify_metadata(self, url):
+        """YouTube search query ("Artist - Title") for a Spotify link."""
+        return await fetch_search_query(url, spotify_query)
+
+    async def _get_apple_music_metadata(self, url):
+        """YouTube search query ("Artist - Title") for an Apple Music link."""
+        return await fetch_search_query(url, apple_music_query)
+
+    def _remember_music(self, info_dict, music_track, search_query, free_search):
+        # Searches come back as a one-entry playlist
+        entries = [e for e in info_dict.get('entries') or [] if e] or [info_dict]
+        video_id = entries[0].get('id') if (entries[0].get('extractor_key') or '').startswith('Youtube') else None
+        if music_track:
+            music_cache.put_track(music_track, search_query, video_id)
+        elif free_search and video_id:
+            music_cache.put_search(free_search, video_id)
 
-    async def convert_video_to_mp3(self, video_path):
+    def _processing_hook(self, job):
         """
-        Converts a video file to MP3 using FFmpeg.
-        Returns the path to the new MP3 file.
+        yt-dlp postprocessor hook counting, per job, the post-processing
+        steps that only copy streams (remux) and the ones that re-encode.
         """
-        if not os.path.exists(video_path):
-            raise FileNotFoundError("Video file not found.")
+        def hook(d):
+            if d.get('status') != 'finished':
+                return
+            kind = PROCESSING_KINDS.get(d.get('postprocessor'))
+            if kind == 'audio':
+                # Extracting audio is a copy when the source codec already matches the output
+                info = d.get('info_dict') or {}
+                acodec = (info.get('acodec') or '').lower()
+                ext = (info.get('ext') or '').lower()
+                copied = (ext == 'm4a' and acodec.startswith(('mp4a', 'aac'))) or (ext == acodec)
+                kind = 'remux' if copied else 'transcode'
+            if kind:
+                job.metrics[kind] += 1
+        return hook
 
-        base_name = os.path.splitext(video_path)[0]
-        mp3_path = f"{base_name}.mp3"
-        
-        ffmpeg_cmd = [
-            "ffmpeg",
-            "-i", video_path,
-            "-vn", # Disable video recording
-            "-acodec", "libmp3lame",
-            "-q:a", "2", # High quality
-             "-y", # Overwrite output files
-            mp3_path
-        ]
-
-        # Use full path if found
-        ffmpeg_path = self._get_ffmpeg_path()
-        if ffmpeg_path:
-             ffmpeg_cmd[0] = ffmpeg_path
-
-        logging.info(f"Converting {video_path} to MP3...")
-        logging.info(f"FFmpeg Command: {ffmpeg_cmd}")
-        
-        process = await asyncio.create_subprocess_exec(
-            *ffmpeg_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+    def _record_metrics(self, info_dict, job):
+        entries = [e for e in info_dict.get('entries') or [] if e] or [info_dict]
+        job.metrics.update(
+            format=entries[0].get('format_id'),
+            vcodec=entries[0].get('vcodec'),
+            acodec=entries[0].get('acodec'),
         )
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            logging.error(f"FFmpeg Error: {stderr.decode()}")
-            raise Exception("Conversion failed.")
-            
-        if not os.path.exists(mp3_path):
-             raise Exception("Output MP3 not created.")
-             
-        return mp3_path
+        if job.metrics['transcode']:
+            metrics.incr('jobs.transcoded')
+        elif job.metrics['remux']:
+            metrics.incr('jobs.remuxed')
+        else:
+            metrics.incr('jobs.sent_as_is')
+        logging.info(f"Job {job.group_id} metrics: {job.metrics}")
+
+    def _collect_media(self, info_dict, job):
+        """
+        Builds the media list from the files yt-dlp reports in
+        requested_downloads, pairing each with its written thumbnail.
+        """
+        # Identity of the post for result caching (shared by all items)
+        source = {
+            'extractor': info_dict.get('extractor_key') or info_dict.get('extractor'),
+            'media_id': info_dict.get('id'),
+        }
+
+        if 'entries' in info_dict:
+            entries = [entry for entry in info_dict['entries'] if entry]
+        else:
+            entries = [info_dict]
+
+        groups = []
+        for meta in entries:
+            files = [d.get('filepath') for d in meta.get('requested_downloads') or []]
+            files = [f for f in files if f and os.path.exists(f)]
+            thumbs = [t.get('filepath') for t in meta.get('thumbnails') or []]
+            thumbs = [t for t in thumbs if t and os.path.exists(t)]
+            if files:
+                groups.append((files, thumbs[-1] if thumbs else None, meta))
+
+        if not groups:
+            # Extractor didn't report paths; the job directory only holds this job's files
+            groups = self._scan_job_dir(job, entries, info_dict)
 
-    def _download_file(self, url, path):
+        media_list = []
+        for files, thumb_file, meta in groups:
+            media = self._media_item(files, thumb_file, meta, job, source)
+            if media:
+                media_list.append(media)
+
+        return media_list
+
+    def _media_item(self, files, thumb_file, meta, job, source):
+        """Media item for one entry's files, or None if none of them is usable."""
+        video_file = None
+        audio_file = None
+        image_file = None
+
+        for f in files:
+            ext = f.split('.')[-1].lower()
+            if ext in ['mp4', 'mkv', 'mov', 'webm']:
+                video_file = f
+            elif ext in ['mp3', 'm4a', 'wav', 'flac', 'ogg']:
+                audio_file = f
+            elif ext in ['jpg', 'jpeg', 'png', 'webp']:
+                image_file = f
+
+        if video_file:
+            return {
+                'type': MediaType.VIDEO,
+                'path': video_file,
+                'title': meta.get('title', 'Video'),
+                'duration': meta.get('duration'),
+                'thumb': thumb_file, # Local path to thumbnail
+                'width': meta.get('width'),
+                'height': meta.get('height'),
+                'entry_id': meta.get('id'),
+                'group_id': job.group_id,
+                **source
+            }
+        if audio_file:
+            return {
+                'type': MediaType.AUDIO,
+                'path': audio_file,
+                'title': meta.get('title', 'Audio'),
+                'duration': meta.get('duration'),
+                'thumb': thumb_file, # Album art?
+                'artist': meta.get('artist'),
+                'entry_id': meta.get('id'),
+                'group_id': job.group_id,
+                **source
+            }
+        if image_file or thumb_file:
+            return {
+                'type': MediaType.IMAGE,
+                'path': image_file or thumb_file,
+                'title': meta.get('title', 'Image'),
+                'group_id': job.group_id,
+                **source
+            }
+        return None
+
+    def _entry_hook(self, job, feed, is_music_search):
+        """
+        Called on the worker thread once each entry's files are final
+        (after yt-dlp moved them into place); hands the item to the feed.
+        """
+        loop = asyncio.get_running_loop()
+
+        def on_entry(info):
+            # Carousel items share the post's identity; a search hit is its own
+            post_id = None if is_music_search else info.get('playlist_id')
+            source = {
+                'extractor': info.get('extractor_key') or info.get('extractor'),
+                'media_id': post_id or info.get('id'),
+            }
+            files = [info['filepath']] if info.get('filepath') and os.path.exists(info['filepath']) else []
+            thumbs = [t.get('filepath') for t in info.get('thumbnails') or []]
+            thumbs = [t for t in thumbs if t and os.path.exists(t)]
+            media = self._media_item(files, thumbs[-1] if thumbs else None, info, job, source) if files else None
+            if media:
+                loop.call_soon_threadsafe(feed.put, media)
+        return on_entry
+
+    def _scan_job_dir(self, job, entries, info_dict):
+        # Group by base name (without extension) to pair video+thumb
+        # yt-dlp naming: autonumber.ext
+        downloaded_files = {}
+        for file in sorted(os.listdir(job.directory)):
+            # skip part files or temp files
+            if file.endswith('.part') or file.endswith('.ytdl'):
+                continue
+            base_name = os.path.splitext(file)[0]
+            downloaded_files.setdefault(base_name, []).append(os.path.join(job.directory, file))
+
+        groups = []
+        for idx, base_name in enumerate(sorted(downloaded_files)):
+            meta = entries[idx] if idx < len(entries) else info_dict
+            files = downloaded_files[base_name]
+            media_files = [f for f in files if not f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))]
+            thumbs = [f for f in files if f not in media_files]
+            # A group of only images is an image post, not a thumbnail
+            groups.append((media_files or thumbs, thumbs[-1] if media_files and thumbs else None, meta))
+        return groups
+
+    async def _download_file(self, url, path, job=None, headers=None):
         try:
-            response = requests.get(url, stream=True)
-            if response.status_code == 200:
-                with open(path, 'wb') as f:
-                    for chunk in response.iter_content(1024):
-                        f.write(chunk)
-            else:
-                logging.error(f"Failed to download file: {response.status_code}")
+            # Small files stay in memory and never touch the downloads volume
+            if job is not None and memory_budget.enabled:
+                data = await http_client.fetch_bytes(url, memory_budget.item_max, headers=headers)
+                if data is not None:
+                    if memory_budget.reserve(len(data)):
+                        job.buffers[path] = data
+                    else:
+                        # Over budget: spill to disk
+                        async with aiofiles.open(path, 'wb') as f:
+                            await f.write(data)
+                    return
+            # Big files (fbcdn videos) come down over several connections
+            await segmented.download(url, path, headers=headers)
         except Exception as e:
             logging.error(f"Error downloading file manually: {e}")
 
-    def _resolve_facebook_share(self, url):
-        logging.info(f"Resolving URL: {url}")
-        try:
-            session = requests.Session()
-            # Use a crawler UA to potentially see the content without login
-            headers = {
-                'User-Agent': 'facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
-                'Sec-Fetch-Dest': 'document',
-                'Sec-Fetch-Mode': 'navigate',
-                'Sec-Fetch-Site': 'none',
-                'Upgrade-Insecure-Requests': '1',
-            }
-            session.headers.update(headers)
-            
-            response = session.get(url, allow_redirects=True, timeout=10)
-            
-            final_url = response.url
-            # Check if we got redirected to login
-            if "facebook.com/login" in final_url:
-                logging.warning("Redirected to Facebook login page. Attempting to parse 'next' parameter.")
-                from urllib.parse import urlparse, parse_qs, unquote
-                parsed = urlparse(final_url)
-                params = parse_qs(parsed.query)
-                if 'next' in params:
-                    next_url = unquote(params['next'][0])
-                    logging.info(f"Extracted original URL from login redirect: {next_url}")
-                    final_url = next_url
-                    
-                    # We must refetch the actual content page to get metadata!
-                    # The current response.text is the login page.
-                    try:
-                        logging.info(f"Refetching content from: {final_url}")
-                        response = session.get(final_url, allow_redirects=True, timeout=10)
-                    except Exception as e:
-                        logging.error(f"Failed to refetch content: {e}")
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            info = {
-                'resolved_url': final_url,
-                'title': "Facebook Post",
-                'image': None,
-                'video': None
+    async def _fetch_planned(self, planned, job):
+        """
+        Downloads the files of an IN_MEMORY result, into memory buffers
+        while the budget allows (to disk otherwise), and returns their items.
+        """
+        async def fetch(index, item):
+            path = os.path.join(job.directory, f"{index:05d}.{item['ext']}")
+            await self._download_file(item['url'], path, job, headers=item['headers'])
+            if path not in job.buffers and not os.path.exists(path):
+                return None
+            media = {key: item[key] for key in MEDIA_FIELDS[item['type']] if key in item}
+            return {
+                **media,
+                'type': MediaType(item['type']),
+                'path': path,
+                'data': job.buffers.get(path),
+                'group_id': job.group_id,
+                'extractor': planned['extractor'],
+                'media_id': planned['media_id'],
             }
-            
-            # Extract basic metadata
-            og_title = soup.find("meta", property="og:title")
-            if og_title:
-                info['title'] = og_title.get('content')
-                
-            og_image = soup.find("meta", property="og:image")
-            if og_image:
-                info['image'] = og_image.get('content')
-                
-            og_video = soup.find("meta", property="og:video")
-            if og_video:
-                info['video'] = og_video.get('content')
-            
-            # Fallback: If no image found, try mbasic.facebook.com
-            if not info['image']:
-                logging.warning("No og:image found. Trying mbasic fallback...")
-                try:
-                    mbasic_url = final_url.replace("www.facebook.com", "mbasic.facebook.com").replace("web.facebook.com", "mbasic.facebook.com")
-                    if "mbasic.facebook.com" not in mbasic_url:
-                        # Handle case where URL might be just facebook.com
-                        mbasic_url = mbasic_url.replace("facebook.com", "mbasic.facebook.com")
-                    
-                    logging.info(f"Fetching mbasic URL: {mbasic_url}")
-                    # mbasic often works better with standard browser UA
-                    mbasic_headers = {
-                        'User-Agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36',
-                         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
-                    }
-                    response_mb = session.get(mbasic_url, headers=mbasic_headers, timeout=10)
-                    soup_mb = BeautifulSoup(response_mb.text, 'html.parser')
-                    
-                    # Try to find finding image in mbasic (often in a div with data-ft or just an img inside a container)
-                    # Or check for standard og:image again (mbasic pages also have headers)
-                    og_image_mb = soup_mb.find("meta", property="og:image")
-                    if og_image_mb:
-                         info['image'] = og_image_mb.get('content')
-                         logging.info(f"Found image on mbasic (meta): {info['image']}")
-                    
-                    if not info['image']:
-                        link_image = soup_mb.find("link", rel="image_src")
-                        if link_image:
-                            info['image'] = link_image.get('href')
-                            logging.info(f"Found image on mbasic (link): {info['image']}")
-
-                    if not info['image']:
-                        # Try to find the first significant image
-                        images = soup_mb.find_all("img")
-                        for img in images:
-                            src = img.get('src')
-                            # Filter out small icons/emojis if possible (heuristic)
-                            if src and "htt" in src and "static" not in src and "emoji" not in src:
-                                info['image'] = src
-                                logging.info(f"Found simplified image on mbasic (img tag): {info['image']}")
-                                break
-                    
-                    # Last resort: Regex for "k": or "m": (common in JSON blobs in script tags on mbasic/www)
-                    if not info['image']:
-                        import re
-                        # Look for jpg urls in script tags or source
-                        matches = re.findall(r'"(https?://[^"]+?\.jpg[^"]*?)"', response_mb.text)
-                        if matches:
-                            for m in matches:
-                                if "static" not in m and "emoji" not in m:
-                                    # decode unicode escapes if needed
-                                    try:
-                                        m = m.encode().decode('unicode-escape')
-                                    except:
-                                        pass
-                                    info['image'] = m
-                                    logging.info(f"Found image via regex match: {m}")
-                                    break
-                    
-                    # Try to find video on mbasic (link or a tag)
-                    if not info['video']:
-                         # sometimes link rel="video_src" exists? likely not on mbasic but checking
-                         # more likely in a href to .mp4
-                         import re
-                         # Look for mp4 urls in source
-                         matches_mp4 = re.findall(r'"(https?://[^"]+?\.mp4[^"]*?)"', response_mb.text)
-                         ifMatches_mp4 = []
-                         # Also check hrefs
-                         a_tags = soup_mb.find_all("a", href=True)
-                         for a in a_tags:
-                             if ".mp4" in a['href']:
-                                 matches_mp4.append(a['href'])
-                         
-                         if matches_mp4:
-                             for m in matches_mp4:
-                                 # decode
-                                 try:
-                                     m = m.encode().decode('unicode-escape')
-                                 except:
-                                     pass
-                                 # Basic filtering
-                                 if "mp4" in m:
-                                     info['video'] = m
-                                     logging.info(f"Found video via regex/href: {m}")
-                                     break
-
-                except Exception as e:
-                    logging.error(f"mbasic fallback failed: {e}")
-
-            return info
-        except Exception as e:
-            logging.error(f"Error resolving Facebook share: {e}")
-            return None
 
-    def _download_sync(self, url, opts):
+        fetched = await asyncio.gather(*(fetch(i, item) for i, item in enumerate(planned['items'], 1)))
+        metrics.incr('memory.planned_jobs')
+        return [media for media in fetched if media]
+
+    def _download_sync(self, url, opts, on_entry=None, cache=None, mode=None, memory_max=0):
+        # cache: where extracted info is looked up and stored (the parent's, in a download process)
+        # memory_max: files up to this size may be fetched into memory by the caller (0: never)
+        cache = cache or info_cache
         try:
-            with yt_dlp.YoutubeDL(opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                return info
+            # Phase 1: extract only, so formats can be picked before downloading anything.
+            # Recently extracted links skip it and start from the cached info.
+            info = cache.get(url)
+            cached = info is not None
+            if not cached:
+                info = self._extract_sync(url, opts, cache)
+                if info is None:
+                    return None
+            else:
+                logging.info(f"Using cached info for {url}")
+
+            # A new link to a post we already sent (share links, other URL forms):
+            # Telegram still has the files, nothing needs downloading
+            sent = self._sent_before(info, mode) if mode else None
+            if sent:
+                return sent
+
+            # Photos and small clips that are sent as they are skip yt-dlp's
+            # download and the downloads volume; the caller fetches them
+            planned = self._memory_plan(info, opts, memory_max) if memory_max else None
+            if planned:
+                return planned
+
+            # Phase 2: download the chosen formats from the extracted info
+            delivered = []
+            try:
+                return self._process_sync(info, opts, on_entry, delivered)
+            except yt_dlp.utils.DownloadError as e:
+                # Signed URLs can be revoked before they expire; extract again once,
+                # unless items already went out (they would be sent twice)
+                if not cached or delivered:
+                    raise
+                logging.info(f"Cached info for {url} failed ({e}), extracting again...")
+                metrics.incr('info_cache.stale')
+                cache.invalidate(url)
+                info = self._extract_sync(url, opts, cache)
+                if info is None:
+                    return None
+                return self._process_sync(info, opts, on_entry, delivered)
+        except (MediaTooLargeError, DownloadCancelled):
+            raise
         except Exception as e:
             error_msg = str(e)
             # Identify if it's the specific format error OR Unsupported URL (bad redirect) OR Login required
@@ -505,20 +837,76 @@ class DownloaderService:
             logging.error(f"yt-dlp error: {e}")
             raise e
 
-    def cleanup(self, filepath):
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-                # Also try to cleanup associated thumbnail if it exists
-                # This is a bit tricky since we passed the path separately.
-                # But typically the handler calls cleanup on the main media path.
-                # If we want to be clean, we should delete the thumb file too if it was distinct.
-                base = os.path.splitext(filepath)[0]
-                for ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                    thumb = base + ext
-                    if os.path.exists(thumb) and thumb != filepath:
-                        os.remove(thumb)
-            except Exception as e:
-                logging.error(f"Error cleaning up file {filepath}: {e}")
+    def _sent_before(self, info, mode):
+        """
+        SENT_BEFORE result with the cached file_ids of the post info
+        describes (for searches, of the hit), or None.
+        """
+        entries = [e for e in info.get('entries') or [] if e]
+        candidates = [info] + entries[:1]
+        for item in candidates:
+            extractor = item.get('extractor_key') or item.get('extractor')
+            entry = result_cache.get_media(extractor, item.get('id'), mode)
+            if entry:
+                return {'_type': SENT_BEFORE, 'extractor': extractor, 'media_id': item['id'], 'items': entry['items']}
+        return None
+
+    def _memory_plan(self, info, opts, max_bytes):
+        """
+        IN_MEMORY result listing the files to fetch, if every item of the
+        post is a memory_item(), or None (yt-dlp downloads it then).
+        """
+        # Post-processed downloads (audio extraction) need their files
+        if opts.get('postprocessors') or opts.get('proxy'):
+            return None
+        try:
+            with yt_dlp.YoutubeDL(dict(self._fit_format(info, opts), quiet=True, verbose=False)) as ydl:
+                processed = ydl.process_ie_result(copy.deepcopy(info), download=False)
+        except yt_dlp.utils.DownloadError:
+            return None
+        if 'entries' in processed:
+            entries = [entry for entry in processed['entries'] if entry]
+        else:
+            entries = [processed]
+        items = [memory_item(entry, max_bytes) for entry in entries]
+        if not items or None in items:
+            return None
+        return {
+            '_type': IN_MEMORY,
+            'extractor': processed.get('extractor_key') or processed.get('extractor'),
+            'media_id': processed.get('id'),
+            'items': items,
+        }
+
+    def _extract_sync(self, url, opts, cache):
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+        # Phase 2 selects its own format; drop the one the template picked here
+        info = clear_selection(yt_dlp.YoutubeDL.sanitize_info(info))
+        cache.put(url, info)
+        return info
+
+    def _process_sync(self, info, opts, on_entry, delivered):
+        # Big plain-HTTP formats come down over several connections (services/segmented.py)
+        with SegmentedYoutubeDL(self._fit_format(info, opts)) as ydl:
+            if on_entry:
+                def report(entry_info):
+                    delivered.append(entry_info)
+                    on_entry(entry_info)
+                ydl.add_post_processor(_EntryReady(report), when='after_move')
+            return ydl.process_ie_result(info, download=True)
+
+    def _fit_format(self, info, opts):
+        """
+        Narrows the format selection to the best quality whose size fits
+        the Telegram upload limit.
+        """
+        # Carousels and searches keep the template's selection
+        if info.get('_type') == 'playlist' or 'entries' in info:
+            return opts
+        audio_only = opts.get('format', '').startswith('bestaudio')
+        spec = select_format(info, self.max_upload_bytes, audio_only=audio_only)
+        return dict(opts, format=spec) if spec else opts
 
 downloader = DownloaderService()
+metrics.add_report(processing_report)
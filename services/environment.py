@@ -0,0 +1,209 @@
+import os
+import copy
+import shutil
+import logging
+import subprocess
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Encoders we rely on; missing ones are reported by the diagnostic
+REQUIRED_ENCODERS = ('libmp3lame', 'aac', 'mjpeg')
+
+
+@dataclass(frozen=True)
+class Environment:
+    """
+    Result of the startup probe: where ffmpeg/ffprobe live, what they
+    support, and the yt-dlp option templates for each download mode.
+    """
+    ffmpeg: str = None
+    ffprobe: str = None
+    ffmpeg_version: str = None
+    ffprobe_version: str = None
+    encoders: frozenset = frozenset()
+    cookiefile: str = None
+    templates: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+
+    @property
+    def ffmpeg_cmd(self):
+        # Executable to put in argv[0] of ffmpeg subprocesses
+        return self.ffmpeg or "ffmpeg"
+
+    @property
+    def ffprobe_cmd(self):
+        return self.ffprobe or "ffprobe"
+
+    def has_encoder(self, name):
+        return name in self.encoders
+
+    def options(self, mode, **overrides):
+        """
+        Returns a fresh yt-dlp options dict for mode ('video', 'audio'
+        or 'music_search') with the per-job overrides applied.
+        """
+        opts = copy.deepcopy(dict(self.templates[mode]))
+        opts.update(overrides)
+        return opts
+
+    def report(self):
+        lines = [
+            f"ffmpeg:   {self.ffmpeg or 'NOT FOUND'}",
+            f"          {self.ffmpeg_version or '-'}",
+            f"ffprobe:  {self.ffprobe or 'NOT FOUND'}",
+            f"          {self.ffprobe_version or '-'}",
+            f"cookies:  {self.cookiefile or 'none'}",
+        ]
+        for name in REQUIRED_ENCODERS:
+            lines.append(f"encoder {name}: {'yes' if self.has_encoder(name) else 'MISSING'}")
+        lines.append(f"templates: {', '.join(self.templates)}")
+        return "\n".join(lines)
+
+
+def _find_executable(name):
+    # Check if in PATH
+    found = shutil.which(name)
+    if found:
+        return found
+
+    # Static build downloaded by build.sh
+    local = os.path.abspath(os.path.join("bin", name))
+    if os.path.isfile(local):
+        return local
+
+    # Check well-known WinGet path (User-specific)
+    base_path = os.path.expandvars(r"%LOCALAPPDATA%\Microsoft\WinGet\Packages")
+    if os.path.exists(base_path):
+        for root, dirs, files in os.walk(base_path):
+            if f"{name}.exe" in files:
+                return os.path.join(root, f"{name}.exe")
+
+    return None
+
+
+def _run(cmd):
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+        return result.stdout if result.returncode == 0 else None
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.warning(f"Could not run {cmd[0]}: {e}")
+        return None
+
+
+def _version(executable):
+    if not executable:
+        return None
+    output = _run([executable, "-version"])
+    return output.splitlines()[0].strip() if output else None
+
+
+def _encoders(ffmpeg):
+    if not ffmpeg:
+        return frozenset()
+    output = _run([ffmpeg, "-hide_banner", "-encoders"]) or ""
+    names = set()
+    for line in output.splitlines():
+        # Lines look like " V....D libx264    libx264 H.264 ..."
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in "VAS":
+            names.add(parts[1])
+    return frozenset(names)
+
+
+def _build_templates(ffmpeg, cookiefile):
+    base = {
+        'noplaylist': True, # We usually want single posts, but might be a carousel
+        'quiet': False, # Enable stdout for debug
+        'verbose': True, # Enable verbose for debug
+        'no_warnings': False,
+        'writethumbnail': True, # Ensure we get thumbnails
+        'nocache_dir': True, # Disable cache
+        'http_headers': {'User-Agent': USER_AGENT},
+    }
+    if ffmpeg:
+        base['ffmpeg_location'] = os.path.dirname(ffmpeg) # yt-dlp expects the directory, not the exe
+    if cookiefile:
+        base['cookiefile'] = cookiefile
+
+    audio = dict(base, **{
+        # AAC first: Telegram plays it as is, so it only needs a container copy
+        'format': 'bestaudio[acodec^=mp4a]/bestaudio[ext=mp3]/bestaudio/best',
+        'postprocessors': [{
+            'key': 'FFmpegExtractAudio',
+            # Keep M4A/MP3 (AAC is copied into .m4a), encode anything else to MP3
+            'preferredcodec': 'm4a>m4a/mp3>mp3/aac>m4a/mp3',
+            'preferredquality': '192',
+        }],
+    })
+    video = dict(base, **{
+        # Ensure we select video or audio or separate components
+        # For TikTok images it might download m4a audio and jpg images separately if not careful
+        # H.264 + AAC first: Telegram streams it inline and merging is a plain stream copy
+        'format': 'bestvideo[vcodec^=avc1]+bestaudio[acodec^=mp4a]/best[vcodec^=avc1]/bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4', # Force MP4 container only for video
+        # Merges are stream copies; put the index up front so playback starts before the upload finishes
+        'postprocessor_args': {'merger+ffmpeg_o': ['-movflags', '+faststart']},
+    })
+    # ytsearch1: results, only ever the first hit
+    music_search = dict(audio, playlist_items='1')
+
+    return MappingProxyType({
+        'video': MappingProxyType(video),
+        'audio': MappingProxyType(audio),
+        'music_search': MappingProxyType(music_search),
+    })
+
+
+def probe_environment():
+    """
+    Resolves ffmpeg/ffprobe, their versions and encoders, and builds the
+    yt-dlp option templates. Meant to run once at startup.
+    """
+    ffmpeg = _find_executable("ffmpeg")
+    ffprobe = _find_executable("ffprobe")
+    if not ffprobe and ffmpeg:
+        # Static builds usually ship both side by side
+        sibling = os.path.join(os.path.dirname(ffmpeg), os.path.basename(ffmpeg).replace("ffmpeg", "ffprobe"))
+        ffprobe = sibling if os.path.isfile(sibling) else None
+
+    cookiefile = os.path.abspath(os.getenv("COOKIES_FILE", "cookies.txt"))
+    if not os.path.exists(cookiefile):
+        cookiefile = None
+
+    env = Environment(
+        ffmpeg=ffmpeg,
+        ffprobe=ffprobe,
+        ffmpeg_version=_version(ffmpeg),
+        ffprobe_version=_version(ffprobe),
+        encoders=_encoders(ffmpeg),
+        cookiefile=cookiefile,
+        templates=_build_templates(ffmpeg, cookiefile),
+    )
+
+    if ffmpeg:
+        logging.info(f"Using FFmpeg at: {ffmpeg} ({env.ffmpeg_version})")
+    else:
+        logging.warning("FFmpeg NOT found by auto-detection.")
+    for name in REQUIRED_ENCODERS:
+        if ffmpeg and not env.has_encoder(name):
+            logging.warning(f"FFmpeg encoder {name} is not available.")
+    return env
+
+
+_environment = None
+
+def get_environment():
+    """Returns the probed environment, probing on first use."""
+    global _environment
+    if _environment is None:
+        _environment = probe_environment()
+    return _environment
+
+
+if __name__ == "__main__":
+    # Diagnostic: python -m services.environment
+    logging.basicConfig(level=logging.INFO)
+    print("--- Diagnostic Start ---")
+    print(get_environment().report())
+    print("--- Diagnostic End ---")
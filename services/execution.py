@@ -0,0 +1,283 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+import yt_dlp
+from yt_dlp.utils import DownloadCancelled as YtdlCancelled
+from services.formats import MediaTooLargeError
+from services.info_cache import info_cache
+
+# How often the parent checks on a download process
+POLL_INTERVAL = 0.5
+# Progress events are forwarded at most this often (plus every status change)
+PROGRESS_INTERVAL = 0.2
+
+# Fields of yt-dlp's hook dicts that our hooks read (Progress, processing metrics)
+HOOK_FIELDS = ('status', 'postprocessor', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'eta')
+HOOK_INFO_FIELDS = ('playlist_index', 'n_entries', 'playlist_count', 'acodec', 'ext')
+# Bulky info_dict keys nobody reads after the download
+SLIM_DROP = ('formats', 'automatic_captions', 'subtitles', 'heatmap', 'http_headers', '__postprocessors')
+
+
+class DownloadCancelled(YtdlCancelled):
+    """
+    The download was stopped: reason is 'cancelled' (the user pressed
+    Cancel), 'timeout' (ran past the wall-clock limit) or 'stalled' (no
+    bytes for too long). Subclasses yt-dlp's own so raising it from a
+    hook stops yt-dlp too.
+    """
+
+    def __init__(self, reason='cancelled'):
+        self.reason = reason
+        super().__init__(f"Download {reason}")
+
+
+class Watchdog:
+    """
+    Limits of one download job: a wall-clock timeout counted from when it
+    got a worker, and a stall timeout for when bytes stop coming while a
+    transfer is running, counted from the moment it started (extraction
+    and post-processing have only the wall clock). Also where a cancel
+    request is recorded.
+
+    Requests that joined the job register as waiters; the job itself is
+    only cancelled once every waiter gave up.
+    """
+
+    def __init__(self, timeout=0, stall_timeout=0):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.reason = None
+        self.waiters = set()
+        self.dropped = set()
+        self.started_at = None
+        self.last_activity = None
+        self.transferring = False
+
+    def start(self):
+        self.started_at = self.last_activity = time.monotonic()
+
+    def cancel(self, reason='cancelled'):
+        if self.reason is None:
+            self.reason = reason
+
+    def drop(self, waiter):
+        """Removes one waiter; cancels the job if it was the last one."""
+        self.waiters.discard(waiter)
+        self.dropped.add(waiter)
+        if not self.waiters:
+            self.cancel('cancelled')
+
+    def expired(self):
+        """The reason the job has to stop now, or None."""
+        if self.reason or self.started_at is None:
+            return self.reason
+        now = time.monotonic()
+        if self.timeout and now - self.started_at > self.timeout:
+            self.cancel('timeout')
+        elif self.stall_timeout and self.transferring and now - self.last_activity > self.stall_timeout:
+            self.cancel('stalled')
+        return self.reason
+
+    def check(self):
+        reason = self.expired()
+        if reason:
+            raise DownloadCancelled(reason)
+
+    def ytdl_hook(self, d):
+        # progress_hooks entry; raising here is how a download thread is stopped
+        status = d.get('status')
+        if status == 'started':
+            # A download is about to connect; no bytes from here on is a stall
+            self.last_activity = time.monotonic()
+            self.transferring = True
+        elif status == 'downloading':
+            if not self.transferring or d.get('downloaded_bytes'):
+                self.last_activity = time.monotonic()
+            self.transferring = True
+        else:
+            self.transferring = False
+        self.check()
+
+    def ytdl_pp_hook(self, d):
+        # Post-processing moves no bytes; only the wall clock applies
+        self.transferring = False
+        self.last_activity = time.monotonic()
+        self.check()
+
+
+def _trim_hook(d):
+    trimmed = {key: d.get(key) for key in HOOK_FIELDS}
+    info = d.get('info_dict') or {}
+    trimmed['info_dict'] = {key: info.get(key) for key in HOOK_INFO_FIELDS}
+    return trimmed
+
+
+def slim_info(info):
+    """JSON-safe copy of an info_dict without the parts that are only needed to download."""
+    if info is None:
+        return None
+    info = yt_dlp.YoutubeDL.sanitize_info(info)
+
+    def strip(item):
+        for key in SLIM_DROP:
+            item.pop(key, None)
+        for entry in item.get('entries') or []:
+            if entry:
+                strip(entry)
+        return item
+    return strip(info)
+
+
+class _ParentCache:
+    """
+    The info cache as a download process sees it: the parent looked the
+    link up before starting the process, and stores what the child
+    extracts, so the cache works without a shared SQLite tier.
+    """
+
+    def __init__(self, conn, info):
+        self._conn = conn
+        self._info = info
+
+    def get(self, url):
+        info, self._info = self._info, None
+        return info
+
+    def put(self, url, info):
+        self._conn.send(('cache_put', info))
+
+    def invalidate(self, url):
+        self._conn.send(('cache_invalidate', None))
+
+
+def _child_main(conn, url, opts, with_entries, cached_info=None, mode=None, memory_max=0):
+    """Download process: runs _download_sync and reports everything through conn."""
+    if hasattr(os, 'setsid'):
+        # Own process group, so ffmpeg children die with us
+        os.setsid()
+    from services.downloader import downloader
+
+    last_sent = [0.0, None]
+
+    def progress(d):
+        now = time.monotonic()
+        status = d.get('status')
+        if status == 'downloading' and status == last_sent[1] and now - last_sent[0] < PROGRESS_INTERVAL:
+            return
+        last_sent[0], last_sent[1] = now, status
+        conn.send(('progress', _trim_hook(d)))
+
+    opts = dict(
+        opts,
+        progress_hooks=[progress],
+        postprocessor_hooks=[lambda d: conn.send(('pp', _trim_hook(d)))],
+    )
+    on_entry = (lambda info: conn.send(('entry', slim_info(info)))) if with_entries else None
+    try:
+        info = downloader._download_sync(url, opts, on_entry, cache=_ParentCache(conn, cached_info), mode=mode, memory_max=memory_max)
+        conn.send(('done', slim_info(info)))
+    except MediaTooLargeError as e:
+        conn.send(('too_large', str(e)))
+    except BaseException as e:
+        conn.send(('error', str(e) or type(e).__name__))
+    finally:
+        conn.close()
+
+
+def _context():
+    # forkserver forks from a clean single-threaded process; yt-dlp is
+    # imported there once so jobs don't pay for it
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['yt_dlp'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+_ctx = None
+
+
+def run_in_process(url, opts, on_entry=None, watchdog=None, mode=None, memory_max=0):
+    """
+    Runs DownloaderService._download_sync(url, opts, on_entry, mode, memory_max) in a child
+    process and returns its (slimmed) info_dict. Meant to be called on a
+    scheduler thread: the hooks in opts and on_entry are called on it as
+    the child reports progress, like in thread mode.
+
+    The child is killed, with everything it started, when the watchdog
+    says so; DownloadCancelled is raised then. The partial files stay in
+    the job directory, which the caller cleans up.
+    """
+    global _ctx
+    if _ctx is None:
+        _ctx = _context()
+    progress_hooks = opts.get('progress_hooks') or []
+    pp_hooks = opts.get('postprocessor_hooks') or []
+    child_opts = {k: v for k, v in opts.items() if k not in ('progress_hooks', 'postprocessor_hooks')}
+
+    receiver, sender = _ctx.Pipe(duplex=False)
+    args = (sender, url, child_opts, on_entry is not None, info_cache.get(url), mode, memory_max)
+    process = _ctx.Process(target=_child_main, args=args, daemon=True)
+    process.start()
+    sender.close()
+    logging.info(f"Download process {process.pid} started for {url}")
+
+    try:
+        while True:
+            reason = watchdog.expired() if watchdog else None
+            if reason:
+                logging.warning(f"Killing download process {process.pid} ({reason}) for {url}")
+                raise DownloadCancelled(reason)
+            if not receiver.poll(POLL_INTERVAL):
+                if not process.is_alive():
+                    raise RuntimeError(f"Download process died (exit code {process.exitcode})")
+                continue
+            try:
+                kind, payload = receiver.recv()
+            except EOFError:
+                process.join(5)
+                raise RuntimeError(f"Download process died (exit code {process.exitcode})")
+
+            if kind == 'progress':
+                for hook in progress_hooks:
+                    _call_hook(hook, payload)
+            elif kind == 'pp':
+                for hook in pp_hooks:
+                    _call_hook(hook, payload)
+            elif kind == 'entry':
+                on_entry(payload)
+            elif kind == 'cache_put':
+                info_cache.put(url, payload)
+            elif kind == 'cache_invalidate':
+                info_cache.invalidate(url)
+            elif kind == 'done':
+                return payload
+            elif kind == 'too_large':
+                raise MediaTooLargeError(payload)
+            else:
+                raise RuntimeError(payload)
+    finally:
+        receiver.close()
+        _kill(process)
+
+
+def _call_hook(hook, d):
+    try:
+        hook(d)
+    except DownloadCancelled:
+        # The watchdog's own hook; the loop kills the child on the next check
+        pass
+
+
+def _kill(process):
+    if process.is_alive():
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+    process.join(10)
@@ -0,0 +1,198 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, unquote
+from services.http import http_client
+from services.html_meta import extract, decode_escapes
+from services.info_cache import url_expiry
+
+# Use a crawler UA to potentially see the content without login
+CRAWLER_HEADERS = {
+    'User-Agent': 'facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+# mbasic often works better with standard browser UA
+MBASIC_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+}
+
+
+def to_mbasic(url):
+    mbasic_url = url.replace("www.facebook.com", "mbasic.facebook.com").replace("web.facebook.com", "mbasic.facebook.com")
+    if "mbasic.facebook.com" not in mbasic_url:
+        # Handle case where URL might be just facebook.com
+        mbasic_url = mbasic_url.replace("facebook.com", "mbasic.facebook.com")
+    return mbasic_url
+
+
+def media_expiry(info):
+    """
+    Earliest expiry of the signed fbcdn URLs in info (their 'oe' query
+    parameter is a hex unix timestamp), or None.
+    """
+    expiries = [url_expiry(info[key]) for key in ('image', 'video') if info.get(key)]
+    expiries = [e for e in expiries if e]
+    return min(expiries) if expiries else None
+
+
+class FacebookResolver:
+    """
+    Resolves Facebook share links (facebook.com/share/..., fb.watch) to the
+    post URL plus a direct image/video for when yt-dlp can't handle it.
+
+    The crawler page and the mbasic page are fetched at the same time and
+    the first one that yields an og:video/og:image wins; the other request
+    is cancelled. Results are cached for `ttl` seconds, or until the signed
+    media URLs expire if that is sooner.
+    """
+
+    def __init__(self, ttl=3600, max_entries=2000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    def _cached(self, url):
+        entry = self._cache.get(url)
+        if not entry:
+            return None
+        expires_at, info = entry
+        if expires_at <= time.time():
+            del self._cache[url]
+            return None
+        self._cache.move_to_end(url)
+        return dict(info)
+
+    def _store(self, url, info):
+        expires_at = time.time() + self.ttl
+        media_expires = media_expiry(info)
+        if media_expires:
+            # Leave a few minutes to actually download it
+            expires_at = min(expires_at, media_expires - 300)
+        if expires_at <= time.time():
+            return
+        self._cache[url] = (expires_at, dict(info))
+        self._cache.move_to_end(url)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def resolve(self, url):
+        logging.info(f"Resolving URL: {url}")
+        cached = self._cached(url)
+        if cached:
+            logging.info(f"Facebook resolution cache hit for {url}")
+            return cached
+
+        tasks = [
+            asyncio.create_task(self._from_crawler_page(url)),
+            asyncio.create_task(self._from_mbasic(url)),
+        ]
+        results = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    info = await next_done
+                except Exception as e:
+                    logging.error(f"Error resolving Facebook share: {e}")
+                    continue
+                if not info:
+                    continue
+                results.append(info)
+                if info.get('video') or info.get('image'):
+                    break
+        finally:
+            # First usable answer wins
+            for task in tasks:
+                task.cancel()
+
+        if not results:
+            return None
+
+        info = {
+            'resolved_url': url,
+            'title': "Facebook Post",
+            'image': None,
+            'video': None
+        }
+        # Merge what we got, the winning (last) result taking precedence
+        for result in results:
+            info.update({k: v for k, v in result.items() if v})
+        if info.get('video') or info.get('image'):
+            self._store(url, info)
+        return info
+
+    async def _from_crawler_page(self, url):
+        loop = asyncio.get_running_loop()
+        final_url, html = await http_client.get_text(url, headers=CRAWLER_HEADERS)
+        
+        # Check if we got redirected to login
+        if "facebook.com/login" in final_url:
+            logging.warning("Redirected to Facebook login page. Attempting to parse 'next' parameter.")
+            parsed = urlparse(final_url)
+            params = parse_qs(parsed.query)
+            if 'next' in params:
+                next_url = unquote(params['next'][0])
+                logging.info(f"Extracted original URL from login redirect: {next_url}")
+                final_url = next_url
+                
+                # We must refetch the actual content page to get metadata!
+                # The current page is the login page.
+                try:
+                    logging.info(f"Refetching content from: {final_url}")
+                    _, html = await http_client.get_text(final_url, headers=CRAWLER_HEADERS)
+                except Exception as e:
+                    logging.error(f"Failed to refetch content: {e}")
+
+        # Parsing big pages is CPU work; keep it off the event loop
+        found = await loop.run_in_executor(None, lambda: parse_og_tags(html))
+        found['resolved_url'] = final_url
+        return found
+
+    async def _from_mbasic(self, url):
+        loop = asyncio.get_running_loop()
+        mbasic_url = to_mbasic(url)
+        logging.info(f"Fetching mbasic URL: {mbasic_url}")
+        final_url, html_mb = await http_client.get_text(mbasic_url, headers=MBASIC_HEADERS)
+
+        found = {'image': None, 'video': None}
+        await loop.run_in_executor(None, lambda: parse_mbasic(html_mb, found))
+        if "facebook.com/login" not in final_url:
+            # yt-dlp wants the regular site URL
+            found['resolved_url'] = final_url.replace("mbasic.facebook.com", "www.facebook.com")
+        return found
+
+
+def parse_og_tags(html):
+    meta = extract(html)
+    return {key: meta[key] for key in ('title', 'image', 'video') if meta[key] is not None}
+
+
+def parse_mbasic(html_mb, info):
+    meta = extract(html_mb)
+    # Standard og:image first (mbasic pages also have headers), then
+    # link rel=image_src, the first significant <img>, and as a last
+    # resort a .jpg URL from the JSON blobs in script tags
+    for key, how in (('image', 'meta'), ('image_src', 'link'), ('img', 'img tag'), ('jpg', 'regex match')):
+        if meta[key]:
+            info['image'] = meta[key]
+            logging.info(f"Found image on mbasic ({how}): {info['image']}")
+            break
+
+    # Video: an .mp4 URL anywhere in the source, else an <a href> to one
+    if not info['video']:
+        video = meta['mp4'] or (meta['mp4_href'] and decode_escapes(meta['mp4_href']))
+        if video:
+            info['video'] = video
+            logging.info(f"Found video via regex/href: {video}")
+
+
+facebook_resolver = FacebookResolver(
+    ttl=int(os.getenv("FB_RESOLVE_TTL", "3600")),
+)
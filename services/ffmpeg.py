@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from services.environment import get_environment
+from services.metrics import metrics
+
+
+class FFmpegError(Exception):
+    """ffmpeg/ffprobe exited with an error."""
+
+
+# "Stream #0:1(und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, ..." in ffmpeg's input listing
+AUDIO_STREAM_RE = re.compile(r'^\s*Stream #\d+:\d+\S*: Audio: (\w+)', re.MULTILINE)
+
+
+def audio_codec_from_listing(listing):
+    """
+    Codec of the first audio stream in what `ffmpeg -i FILE` prints, or
+    None if the input has no audio. Raises FFmpegError if ffmpeg could
+    not read the input at all.
+    """
+    if 'Input #0' not in listing:
+        lines = listing.strip().splitlines()
+        raise FFmpegError(lines[-1] if lines else "ffmpeg could not read the file")
+    match = AUDIO_STREAM_RE.search(listing)
+    return match.group(1) if match else None
+
+
+class FFmpegPool:
+    """
+    Runs our own ffmpeg/ffprobe processes, at most `size` at a time.
+    Callers past the limit wait their turn; the wait and the run time are
+    recorded in metrics (ffmpeg.queue_wait, ffmpeg.run) and summed up by
+    report() in the periodic metrics log.
+
+    yt-dlp's own post-processing runs on the download threads and is
+    bounded by the number of download workers instead.
+    """
+
+    def __init__(self, size=2, timeout=600, slow_wait=5.0):
+        self.size = size
+        # Average queue wait (seconds) past which the pool is reported as too small
+        self.slow_wait = slow_wait
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(size)
+        self.waiting = 0
+
+    async def _exec(self, cmd, timeout=None, check=True):
+        # check=False: the exit code doesn't matter, stderr is returned instead of stdout
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            started_at = time.monotonic()
+            metrics.observe('ffmpeg.queue_wait', started_at - queued_at)
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise FFmpegError(f"{os.path.basename(cmd[0])} timed out")
+            finally:
+                metrics.observe('ffmpeg.run', time.monotonic() - started_at)
+        finally:
+            self._slots.release()
+
+        if not check:
+            return stderr.decode(errors='replace')
+        if process.returncode != 0:
+            error = stderr.decode(errors='replace').strip()
+            logging.error(f"FFmpeg Error: {error[-2000:]}")
+            raise FFmpegError(error.splitlines()[-1] if error else f"exit code {process.returncode}")
+        return stdout
+
+    async def run(self, args, timeout=None):
+        """Runs ffmpeg with args (without the executable). Returns stdout."""
+        metrics.incr('ffmpeg.runs')
+        cmd = [get_environment().ffmpeg_cmd, "-hide_banner", "-loglevel", "error", *args]
+        logging.info(f"FFmpeg Command: {cmd}")
+        return await self._exec(cmd, timeout)
+
+    async def audio_codec(self, path):
+        """
+        Codec name of the first audio stream of a file (ffprobe's names,
+        'aac', 'mp3', 'opus'...), or None if it has no audio.
+        """
+        if get_environment().ffprobe:
+            info = await self.probe(path)
+            audio = next((s for s in info.get('streams') or [] if s.get('codec_type') == 'audio'), None)
+            return audio.get('codec_name') if audio else None
+        # Deploys may ship only the static ffmpeg: read its listing of the
+        # input instead (it exits with an error, as no output is given)
+        metrics.incr('ffmpeg.probes')
+        cmd = [get_environment().ffmpeg_cmd, "-hide_banner", "-i", path]
+        return audio_codec_from_listing(await self._exec(cmd, timeout=30, check=False))
+
+    def report(self, snapshot):
+        """Metrics log line on how long ffmpeg work waited for a slot."""
+        wait = snapshot['timings'].get('ffmpeg.queue_wait')
+        if not wait:
+            return None
+        run = snapshot['timings'].get('ffmpeg.run') or {'avg': 0.0}
+        line = (
+            f"FFmpeg pool: {wait['count']} runs on {self.size} slot(s), "
+            f"queue wait avg {wait['avg']:.1f}s max {wait['max']:.1f}s, run avg {run['avg']:.1f}s"
+        )
+        if wait['avg'] > self.slow_wait:
+            line += " - saturated, consider raising FFMPEG_WORKERS"
+        return line
+
+    async def probe(self, path):
+        """ffprobe's streams and format of a file, as a dict."""
+        metrics.incr('ffmpeg.probes')
+        cmd = [
+            get_environment().ffprobe_cmd,
+            "-v", "error",
+            "-print_format", "json",
+            "-show_streams", "-show_format",
+            path
+        ]
+        return json.loads(await self._exec(cmd, timeout=30) or b'{}')
+
+
+ffmpeg_pool = FFmpegPool(
+    size=int(os.getenv("FFMPEG_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))),
+)
+metrics.add_report(ffmpeg_pool.report)
@@ -0,0 +1,176 @@
+import logging
+from services.metrics import metrics
+
+
+class MediaTooLargeError(Exception):
+    """Raised when no available format fits the upload size limit."""
+
+
+# Estimated sizes (filesize_approx, bitrate * duration) get some headroom
+APPROX_MARGIN = 1.1
+
+# Keys process_ie_result adds for the formats it selected and downloaded
+SELECTION_KEYS = (
+    'requested_formats', 'requested_downloads', 'requested_subtitles',
+    'format', 'filepath', '_filename', 'filename',
+)
+# Video-level fields that some formats repeat; they stay when the selection is cleared
+VIDEO_KEYS = ('id', 'title', 'duration', 'language')
+
+
+def clear_selection(info):
+    """
+    Removes the format yt-dlp selected from an extracted (processed)
+    info_dict, in place, and returns it. extract_info() copies the chosen
+    format's fields (url, format_id, requested_formats...) onto the info,
+    and process_ie_result() would download those again whatever format
+    it is asked for, so the info has to be cleared before selecting anew.
+    """
+    if info is None:
+        return None
+    for key in [key for key in info if key.startswith('__')]:
+        del info[key]
+    for key in SELECTION_KEYS:
+        info.pop(key, None)
+    formats = info.get('formats') or []
+    if formats:
+        for key in set().union(*formats).difference(VIDEO_KEYS):
+            info.pop(key, None)
+    for entry in info.get('entries') or []:
+        if entry:
+            clear_selection(entry)
+    return info
+
+
+def _has_video(fmt):
+    return fmt.get('vcodec') not in (None, 'none')
+
+
+def _has_audio(fmt):
+    return fmt.get('acodec') not in (None, 'none')
+
+
+def estimate_size(fmt, duration=None):
+    """
+    Best guess of a format's size in bytes, or None if unknown.
+    Exact sizes are returned as is, estimates include APPROX_MARGIN.
+    """
+    if fmt.get('filesize'):
+        return fmt['filesize']
+    if fmt.get('filesize_approx'):
+        return int(fmt['filesize_approx'] * APPROX_MARGIN)
+    if fmt.get('tbr') and duration:
+        # tbr is in kbit/s
+        return int(fmt['tbr'] * 1000 / 8 * duration * APPROX_MARGIN)
+    return None
+
+
+def _quality(fmt):
+    return (fmt.get('height') or 0, fmt.get('tbr') or 0)
+
+
+def _is_h264(fmt):
+    vcodec = (fmt.get('vcodec') or '').lower()
+    return vcodec.startswith('avc') or 'h264' in vcodec
+
+
+def _is_aac(fmt):
+    acodec = (fmt.get('acodec') or '').lower()
+    return acodec.startswith('mp4a') or 'aac' in acodec
+
+
+# How much work a download needs before Telegram can stream it inline
+SENDABLE = 0    # MP4 with H.264 + AAC, upload as is
+REMUX = 1       # right codecs, but streams need to be merged (stream copy)
+INCOMPATIBLE = 2  # VP9/AV1/HEVC/Opus: plays only after download, or needs a transcode
+RANK_NAMES = {SENDABLE: 'sendable', REMUX: 'remux', INCOMPATIBLE: 'incompatible'}
+
+
+def sendable_rank(video, audio=None):
+    if audio is None:
+        if _is_h264(video) and _is_aac(video):
+            return SENDABLE if video.get('ext') == 'mp4' else REMUX
+        return INCOMPATIBLE
+    return REMUX if _is_h264(video) and _is_aac(audio) else INCOMPATIBLE
+
+
+def audio_rank(fmt):
+    # Telegram's player takes MP3 and M4A (AAC) as is
+    acodec = (fmt.get('acodec') or '').lower()
+    return SENDABLE if _is_aac(fmt) or acodec == 'mp3' else REMUX
+
+
+# Formats at least this tall (or as tall as the best fitting one, if that
+# is lower) are good enough: among them the one needing the least
+# processing wins, and only then the higher quality
+GOOD_ENOUGH_HEIGHT = 480
+
+
+def candidates(info, audio_only=False):
+    """
+    Yields (format_spec, estimated_size, quality, rank) for every format
+    or video+audio pair that could be downloaded for this info_dict.
+    """
+    formats = [f for f in info.get('formats') or [] if f.get('format_id')]
+    duration = info.get('duration')
+    audios = [f for f in formats if _has_audio(f) and not _has_video(f)]
+
+    if audio_only:
+        for fmt in audios:
+            yield fmt['format_id'], estimate_size(fmt, duration), (fmt.get('abr') or fmt.get('tbr') or 0,), audio_rank(fmt)
+        return
+
+    for fmt in formats:
+        if _has_video(fmt) and _has_audio(fmt):
+            yield fmt['format_id'], estimate_size(fmt, duration), _quality(fmt), sendable_rank(fmt)
+
+    # Pair each video-only stream with the best audio that has a known size,
+    # the smallest one, and the best AAC one (merges without re-encoding)
+    sized_audios = [(estimate_size(a, duration), a) for a in audios]
+    sized_audios = [(size, a) for size, a in sized_audios if size is not None]
+    abr = lambda sa: sa[1].get('abr') or sa[1].get('tbr') or 0
+    best_audio = max(sized_audios, key=abr, default=None)
+    smallest_audio = min(sized_audios, key=lambda sa: sa[0], default=None)
+    best_aac = max((sa for sa in sized_audios if _is_aac(sa[1])), key=abr, default=None)
+    pair_audios = {id(a): a for a in (best_audio, smallest_audio, best_aac) if a}.values()
+    for fmt in formats:
+        if _has_video(fmt) and not _has_audio(fmt):
+            video_size = estimate_size(fmt, duration)
+            for audio_size, audio in pair_audios:
+                size = video_size + audio_size if video_size is not None else None
+                yield f"{fmt['format_id']}+{audio['format_id']}", size, _quality(fmt), sendable_rank(fmt, audio)
+
+
+def select_format(info, max_bytes, audio_only=False):
+    """
+    Returns the format spec of the download whose estimated size fits
+    max_bytes, preferring ones Telegram can stream without processing
+    (the best of those that are GOOD_ENOUGH_HEIGHT), or None if sizes are
+    unknown (the default selection is used then). Raises
+    MediaTooLargeError if every format has a known size and none of them
+    fits.
+    """
+    options = list(candidates(info, audio_only=audio_only))
+    if not options:
+        return None
+
+    sized = [o for o in options if o[1] is not None]
+    fitting = [o for o in sized if o[1] <= max_bytes]
+    if fitting:
+        # Prefer what Telegram can stream without processing, as long as it
+        # isn't below GOOD_ENOUGH_HEIGHT: VP9 1080p loses to H.264 720p
+        good = fitting
+        if not audio_only:
+            floor = min(GOOD_ENOUGH_HEIGHT, max(o[2][0] for o in fitting))
+            good = [o for o in fitting if o[2][0] >= floor]
+        spec, size, _, rank = min(good, key=lambda o: (o[3], tuple(-q for q in o[2])))
+        logging.info(f"Selected format {spec} (~{size / 1024 / 1024:.1f} MB, rank {rank}) for {info.get('id')}")
+        metrics.incr(f"formats.{RANK_NAMES[rank]}")
+        return spec
+
+    if sized and len(sized) == len(options):
+        smallest = min(o[1] for o in sized)
+        raise MediaTooLargeError(
+            f"Smallest format is ~{smallest / 1024 / 1024:.0f} MB, over the {max_bytes / 1024 / 1024:.0f} MB upload limit"
+        )
+    return None
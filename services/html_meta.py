@@ -0,0 +1,85 @@
+import re
+import html as htmllib
+
+# One scanner for everything we want from a page: the tags we care about
+# (meta, link, img, a) and quoted .jpg/.mp4 URLs in inline scripts/JSON.
+# Everything else is skipped without building a tree.
+SCAN_RE = re.compile(
+    r'<(?P<tag>meta|link|img|a)\s(?P<attrs>[^>]*)>'
+    r'|"(?P<url>https?://[^"]+?\.(?P<ext>jpg|mp4)[^"]*?)"',
+    re.IGNORECASE,
+)
+ATTR_RE = re.compile(r'''([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+QUOTED_URL_RE = re.compile(r'"(https?://[^"]+?\.(jpg|mp4)[^"]*?)"', re.IGNORECASE)
+
+OG_KEYS = {'og:title': 'title', 'og:description': 'description', 'og:image': 'image', 'og:video': 'video'}
+
+
+def _attrs(text):
+    attrs = {}
+    for name, double, single, bare in ATTR_RE.findall(text):
+        name = name.lower()
+        if name not in attrs:
+            attrs[name] = htmllib.unescape(double or single or bare)
+    return attrs
+
+
+def decode_escapes(url):
+    # URLs inside JSON blobs come with \uXXXX escapes
+    try:
+        return url.encode().decode('unicode-escape')
+    except Exception:
+        return url
+
+
+def _usable_image(src):
+    return "static" not in src and "emoji" not in src
+
+
+def extract(html):
+    """
+    Scans a page once and returns what the Facebook fallback looks at:
+    og:title/og:description/og:image/og:video (first of each), link rel=image_src, the
+    first usable <img>, and the first .jpg/.mp4 URLs found in the source.
+    Missing values are None.
+    """
+    found = {
+        'title': None, 'description': None, 'image': None, 'video': None,
+        'image_src': None, 'img': None, 'jpg': None, 'mp4': None, 'mp4_href': None,
+    }
+
+    for match in SCAN_RE.finditer(html):
+        url = match.group('url')
+        if url:
+            key = match.group('ext').lower()
+            if not found[key] and (key == 'mp4' or _usable_image(url)):
+                found[key] = decode_escapes(url)
+            continue
+
+        tag = match.group('tag').lower()
+        raw = match.group('attrs')
+        # Quoted URLs inside the tag count as "in the source" too
+        if not (found['jpg'] and found['mp4']) and 'http' in raw:
+            for url, ext in QUOTED_URL_RE.findall(raw):
+                key = ext.lower()
+                if not found[key] and (key == 'mp4' or _usable_image(url)):
+                    found[key] = decode_escapes(url)
+
+        attrs = _attrs(raw)
+        if tag == 'meta':
+            key = OG_KEYS.get(attrs.get('property'))
+            if key and found[key] is None and 'content' in attrs:
+                found[key] = attrs['content']
+        elif tag == 'link':
+            if not found['image_src'] and 'image_src' in attrs.get('rel', '').split():
+                found['image_src'] = attrs.get('href')
+        elif tag == 'img':
+            src = attrs.get('src')
+            if not found['img'] and src and "htt" in src and _usable_image(src):
+                found['img'] = src
+        else:
+            href = attrs.get('href')
+            if not found['mp4_href'] and href and ".mp4" in href:
+                found['mp4_href'] = href
+
+    return found
@@ -0,0 +1,98 @@
+import os
+import asyncio
+import logging
+import aiohttp
+import aiofiles
+
+# Big chunks keep per-chunk Python overhead negligible on large files
+CHUNK_SIZE = 1024 * 1024
+
+
+class HttpClient:
+    """
+    Shared aiohttp session for our own HTTP requests (Facebook resolution,
+    fallback downloads). Connections are kept alive and pooled, DNS
+    lookups are cached, and every request has a timeout.
+
+    Cookies are not kept between requests: the session is shared by all
+    users.
+    """
+
+    def __init__(self, limit=100, limit_per_host=10, dns_ttl=300, page_timeout=10, read_timeout=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.page_timeout = aiohttp.ClientTimeout(total=page_timeout)
+        # Downloads can take long; only stalls are timed out
+        self.download_timeout = aiohttp.ClientTimeout(total=None, sock_connect=page_timeout, sock_read=read_timeout)
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+        return self._session
+
+    async def get_text(self, url, headers=None, timeout=None):
+        """
+        Fetches a page following redirects.
+        Returns (final_url, text); raises aiohttp.ClientError / asyncio.TimeoutError.
+        """
+        async with self.session().get(url, headers=headers, timeout=timeout or self.page_timeout, allow_redirects=True) as response:
+            text = await response.text(errors='replace')
+            return str(response.url), text
+
+    async def download(self, url, path, headers=None, chunk_size=CHUNK_SIZE, on_chunk=None, proxy=None):
+        """
+        Streams url into path. Returns False on a non-200 response.
+        A partially written file is removed on failure.
+        on_chunk(size) is called for every chunk written.
+        """
+        try:
+            async with self.session().get(url, headers=headers, proxy=proxy, timeout=self.download_timeout) as response:
+                if response.status != 200:
+                    logging.error(f"Failed to download file: {response.status}")
+                    return False
+                async with aiofiles.open(path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await f.write(chunk)
+                        if on_chunk:
+                            on_chunk(len(chunk))
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+    async def fetch_bytes(self, url, max_bytes, headers=None):
+        """
+        Downloads url into memory. Returns None on a non-200 response or
+        if the body turns out larger than max_bytes.
+        """
+        async with self.session().get(url, headers=headers, timeout=self.download_timeout) as response:
+            if response.status != 200:
+                logging.error(f"Failed to download file: {response.status}")
+                return None
+            if response.content_length and response.content_length > max_bytes:
+                return None
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                data += chunk
+                if len(data) > max_bytes:
+                    return None
+            return bytes(data)
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+http_client = HttpClient(
+    limit=int(os.getenv("HTTP_POOL_SIZE", "100")),
+    limit_per_host=int(os.getenv("HTTP_POOL_PER_HOST", "10")),
+)
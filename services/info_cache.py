@@ -0,0 +1,200 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+import yt_dlp
+from yt_dlp.extractor import gen_extractor_classes
+from services.cache import normalize_url
+from services.metrics import metrics
+
+# Signed media URLs carry their expiry: YouTube 'expire' (also as a path
+# segment in HLS manifests), TikTok 'x-expires', CloudFront 'Expires' are
+# unix seconds; Facebook/Instagram 'oe' is hex
+EXPIRY_PARAMS = ('expire', 'expires', 'x-expires')
+EXPIRY_PATH_RE = re.compile(r'/expire/(\d+)/')
+# Cached info is dropped this long before its URLs stop working
+EXPIRY_MARGIN = 300
+
+_extractors = None
+
+
+def extractor_id(url):
+    """'Extractor:id' of a URL without any network request, or None."""
+    global _extractors
+    if _extractors is None:
+        _extractors = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+    for ie in _extractors:
+        if ie.suitable(url):
+            media_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{media_id}" if media_id else None
+    return None
+
+
+def url_expiry(url):
+    """Unix time a signed media URL stops working, or None."""
+    if not url:
+        return None
+    parts = urlsplit(url)
+    query = {k.lower(): v for k, v in parse_qs(parts.query).items()}
+    try:
+        if query.get('oe'):
+            return int(query['oe'][0], 16)
+        for key in EXPIRY_PARAMS:
+            if query.get(key):
+                return int(query[key][0])
+    except ValueError:
+        return None
+    match = EXPIRY_PATH_RE.search(parts.path)
+    return int(match.group(1)) if match else None
+
+
+def info_expiry(info):
+    """Earliest expiry of the format URLs in an info_dict (and its entries), or None."""
+    expiries = []
+    for fmt in [info, *(info.get('formats') or [])]:
+        for key in ('url', 'manifest_url'):
+            value = url_expiry(fmt.get(key))
+            if value:
+                expiries.append(value)
+    for entry in info.get('entries') or []:
+        if entry:
+            value = info_expiry(entry)
+            if value:
+                expiries.append(value)
+    return min(expiries) if expiries else None
+
+
+class InfoCache:
+    """
+    Cache of yt-dlp's extracted info_dicts, so a retry, a "Convert to MP3"
+    re-download or a repeat link goes straight to downloading the formats
+    instead of redoing the extractor's page and API requests.
+
+    Entries are keyed by extractor + media id when the URL alone tells us
+    (youtu.be/x and youtube.com/watch?v=x are one entry), else by the
+    normalized URL. They live for `ttl` seconds or until the signed format
+    URLs expire, whichever is sooner. The memory tier is per process
+    (download processes go through their parent's); the optional SQLite
+    tier at `path` is shared with queue workers and survives restarts.
+
+    Stored infos have their format selection cleared, so each download
+    selects its own format from them.
+    """
+
+    def __init__(self, ttl=1800, max_entries=200, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, info as JSON)
+        self._memory = OrderedDict()
+        self._db = None
+        if path:
+            path = os.path.abspath(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS infos ("
+                " key TEXT PRIMARY KEY, payload TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def key(url):
+        if not url.startswith(("http://", "https://")):
+            # ytsearch1:... queries
+            return url
+        return extractor_id(url) or normalize_url(url)
+
+    def get(self, url):
+        """A fresh copy of the cached info_dict for url, or None."""
+        if not self.ttl:
+            return None
+        key = self.key(url)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and entry[0] <= now:
+                del self._memory[key]
+                entry = None
+            if entry:
+                self._memory.move_to_end(key)
+            elif self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT expires_at, payload FROM infos WHERE key = ? AND expires_at > ?", (key, now)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    logging.error(f"Info cache read failed: {e}")
+                    row = None
+                if row:
+                    entry = tuple(row)
+                    self._remember(key, entry)
+        if not entry:
+            metrics.incr('info_cache.misses')
+            return None
+        metrics.incr('info_cache.hits')
+        # process_ie_result changes the dict it is given; every caller gets its own
+        return json.loads(entry[1])
+
+    def put(self, url, info):
+        if not self.ttl or not info or info.get('is_live'):
+            return
+        expires_at = time.time() + self.ttl
+        signed_expiry = info_expiry(info)
+        if signed_expiry:
+            expires_at = min(expires_at, signed_expiry - EXPIRY_MARGIN)
+        if expires_at <= time.time():
+            return
+        try:
+            payload = json.dumps(yt_dlp.YoutubeDL.sanitize_info(info))
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Could not cache info for {url}: {e}")
+            return
+
+        keys = {self.key(url)}
+        # Also findable by the id it resolved to (share links, search results)
+        if info.get('extractor_key') and info.get('id') and info.get('_type', 'video') == 'video':
+            keys.add(f"{info['extractor_key']}:{info['id']}")
+        with self._lock:
+            for key in keys:
+                self._remember(key, (expires_at, payload))
+                if self._db is not None:
+                    try:
+                        self._db.execute(
+                            "INSERT OR REPLACE INTO infos (key, payload, expires_at) VALUES (?, ?, ?)",
+                            (key, payload, expires_at),
+                        )
+                    except sqlite3.Error as e:
+                        logging.error(f"Info cache write failed: {e}")
+            if self._db is not None:
+                self._db.execute("DELETE FROM infos WHERE expires_at < ?", (time.time(),))
+
+    def invalidate(self, url):
+        """Drops the entry for url, e.g. after its format URLs were refused."""
+        key = self.key(url)
+        with self._lock:
+            self._memory.pop(key, None)
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM infos WHERE key = ?", (key,))
+                except sqlite3.Error as e:
+                    logging.error(f"Info cache write failed: {e}")
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+info_cache = InfoCache(
+    ttl=int(os.getenv("INFO_CACHE_TTL", "1800")),
+    max_entries=int(os.getenv("INFO_CACHE_SIZE", "200")),
+    # Empty keeps the cache in memory only
+    path=os.getenv("INFO_CACHE_PATH") or None,
+)
@@ -0,0 +1,205 @@
+import os
+import re
+import time
+import heapq
+import shutil
+import asyncio
+import logging
+
+# Names yt-dlp and older versions of the bot leave in downloads/
+ORPHAN_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\.(part|ytdl)$')
+
+
+def dir_size(path):
+    total = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += dir_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+class DiskJanitor:
+    """
+    Single background task that owns the lifetime of finished jobs.
+
+    A job nobody is using any more is retired: it lingers for `ttl`
+    seconds (so buttons like "Convert to MP3" keep working) and is then
+    removed. When the volume passes `high_water` (fraction used), or the
+    downloads folder passes `high_water` of `max_bytes`, lingering jobs are
+    evicted least recently used first until usage is back under `low_water`.
+    Jobs still in use are never evicted.
+
+    With orphan_age set, leftovers of other processes (worker jobs
+    nobody picked up) are swept periodically once they are that old.
+    """
+
+    def __init__(self, jobs, ttl=300, max_bytes=0, high_water=0.85, low_water=0.70, interval=15, orphan_age=0):
+        self.jobs = jobs
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.high_water = high_water
+        self.low_water = low_water
+        self.interval = interval
+        self.orphan_age = orphan_age
+        # group_id -> [expires_at, last_used, size]
+        self._lingering = {}
+        self._heap = []
+        self._task = None
+
+    def retire(self, group_id):
+        """Called when the last user of a job released it."""
+        if self.jobs.get(group_id) is None:
+            return
+        now = time.time()
+        expires_at = now + self.ttl
+        # The size is measured by the next sweep, off the event loop
+        self._lingering[group_id] = [expires_at, now, None]
+        heapq.heappush(self._heap, (expires_at, group_id))
+
+    def revive(self, group_id):
+        """Called when a lingering job is used again."""
+        self._lingering.pop(group_id, None)
+
+    async def _remove(self, group_id):
+        self._lingering.pop(group_id, None)
+        # Out of the index right away, so nobody acquires it while it is deleted
+        job = self.jobs.forget(group_id)
+        await asyncio.to_thread(self.jobs.delete, group_id, job)
+
+    async def expire(self, now=None):
+        now = now or time.time()
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, group_id = heapq.heappop(self._heap)
+            entry = self._lingering.get(group_id)
+            # Stale heap entries (revived or retired again later) are skipped
+            if entry and entry[0] == expires_at:
+                await self._remove(group_id)
+
+    def _measure(self, directories):
+        # Runs in a thread: the slow part of usage()
+        sizes = {group_id: dir_size(directory) for group_id, directory in directories.items()}
+        return sizes, shutil.disk_usage(self.jobs.root)
+
+    async def usage(self):
+        """
+        Current disk usage of the downloads folder and its volume. Jobs in
+        use are measured on every call, lingering ones once; the scanning
+        runs in a thread.
+        """
+        directories = {
+            job.group_id: job.directory for job in self.jobs
+            if self._lingering.get(job.group_id, [None, None, None])[2] is None
+        }
+        sizes, volume = await asyncio.to_thread(self._measure, directories)
+        for group_id, size in sizes.items():
+            entry = self._lingering.get(group_id)
+            if entry is not None and entry[2] is None:
+                entry[2] = size
+        lingering_bytes = sum(entry[2] or 0 for entry in self._lingering.values())
+        active_bytes = sum(size for group_id, size in sizes.items() if group_id not in self._lingering)
+        return {
+            'downloads_bytes': lingering_bytes + active_bytes,
+            'lingering_bytes': lingering_bytes,
+            'jobs': len(self.jobs),
+            'lingering_jobs': len(self._lingering),
+            'volume_used': volume.used,
+            'volume_total': volume.total,
+        }
+
+    def _over(self, usage, mark):
+        if usage['volume_used'] > usage['volume_total'] * mark:
+            return True
+        return bool(self.max_bytes) and usage['downloads_bytes'] > self.max_bytes * mark
+
+    async def enforce_budget(self):
+        """
+        Evicts lingering jobs if usage is over the high-water mark, until it
+        is under the low-water mark. Returns the usage, minus what was evicted.
+        """
+        usage = await self.usage()
+        if not self._over(usage, self.high_water):
+            return usage
+
+        logging.warning(
+            f"Disk high-water mark reached ({usage['downloads_bytes']} bytes in downloads, "
+            f"volume {usage['volume_used']}/{usage['volume_total']}), evicting jobs"
+        )
+        for group_id, (_, _, size) in sorted(self._lingering.items(), key=lambda item: item[1][1]):
+            if group_id not in self._lingering:
+                # Revived while an earlier eviction was deleting
+                continue
+            await self._remove(group_id)
+            size = size or 0
+            usage['downloads_bytes'] -= size
+            usage['lingering_bytes'] -= size
+            usage['volume_used'] -= size
+            usage['jobs'] -= 1
+            usage['lingering_jobs'] -= 1
+            if not self._over(usage, self.low_water):
+                break
+        return usage
+
+    def sweep_orphans(self, min_age=0):
+        """
+        Removes leftovers of earlier runs: job directories, uuid-named
+        files and yt-dlp temp files the index knows nothing about.
+        Entries modified in the last min_age seconds are kept.
+        """
+        removed = 0
+        cutoff = time.time() - min_age
+        for name in os.listdir(self.jobs.root):
+            if self.jobs.get(name) or not ORPHAN_RE.search(name):
+                continue
+            path = os.path.join(self.jobs.root, name)
+            try:
+                if min_age and os.path.getmtime(path) > cutoff:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as e:
+                logging.error(f"Could not remove orphan {path}: {e}")
+        if removed:
+            logging.info(f"Removed {removed} orphaned download(s)")
+
+    def _log_usage(self, usage):
+        mb = 1024 * 1024
+        logging.info(
+            f"Downloads: {usage['downloads_bytes'] / mb:.1f} MB in {usage['jobs']} job(s), "
+            f"{usage['lingering_bytes'] / mb:.1f} MB in {usage['lingering_jobs']} lingering; "
+            f"volume {usage['volume_used'] / usage['volume_total']:.0%} used"
+        )
+
+    async def _run(self):
+        logged = None
+        while True:
+            try:
+                await self.expire()
+                usage = await self.enforce_budget()
+                # Logged on the sweeps where the downloads folder changed, not every interval
+                key = (usage['downloads_bytes'], usage['jobs'], usage['lingering_jobs'])
+                if key != logged:
+                    self._log_usage(usage)
+                    logged = key
+                if self.orphan_age:
+                    await asyncio.to_thread(self.sweep_orphans, self.orphan_age)
+            except Exception as e:
+                logging.error(f"Janitor pass failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """Sweeps orphans and starts the background task. Call once at startup."""
+        self.sweep_orphans(min_age=self.orphan_age)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import logging
+
+
+class Job:
+    """
+    A finished or running download: its working directory and the media
+    items it produced. Small items may also (or only) live in memory, in
+    buffers keyed by their path.
+    """
+
+    def __init__(self, group_id, directory, url=None):
+        self.group_id = group_id
+        self.directory = directory
+        self.url = url
+        self.media = []
+        self.buffers = {}
+        self.created_at = time.time()
+        # Chosen format and how much post-processing it needed
+        self.metrics = {'remux': 0, 'transcode': 0}
+
+    @property
+    def buffered(self):
+        return sum(len(data) for data in self.buffers.values())
+
+    def paths(self):
+        """All files belonging to this job (media and thumbnails)."""
+        paths = []
+        for media in self.media:
+            paths.append(media['path'])
+            if media.get('thumb'):
+                paths.append(media['thumb'])
+        return paths
+
+    def find(self, media_type):
+        """Returns the first media item of the given type, or None."""
+        for media in self.media:
+            if media['type'] == media_type and (media['path'] in self.buffers or os.path.exists(media['path'])):
+                return media
+        return None
+
+    def materialize(self, media):
+        """Writes an in-memory item to its path, for tools that need a file (ffmpeg)."""
+        data = self.buffers.get(media['path'])
+        if data is not None and not os.path.exists(media['path']):
+            with open(media['path'], 'wb') as f:
+                f.write(data)
+
+
+class JobIndex:
+    """
+    In-memory index of download jobs by group_id.
+    Each job gets its own directory under the download path, so lookups
+    and cleanup never need to scan the shared downloads folder.
+    """
+
+    def __init__(self, root, budget=None):
+        self.root = root
+        # MemoryBudget the jobs' buffers are reserved from
+        self.budget = budget
+        self._jobs = {}
+
+    def create(self, group_id, url=None):
+        directory = os.path.join(self.root, group_id)
+        os.makedirs(directory, exist_ok=True)
+        job = Job(group_id, directory, url=url)
+        self._jobs[group_id] = job
+        return job
+
+    def get(self, group_id):
+        return self._jobs.get(group_id)
+
+    def forget(self, group_id):
+        """Drops a job from the index, leaving its files on disk."""
+        job = self._jobs.pop(group_id, None)
+        self._release(job)
+        return job
+
+    def remove(self, group_id):
+        self.delete(group_id, self.forget(group_id))
+
+    def delete(self, group_id, job=None):
+        """
+        Deletes the directory of a job that is no longer indexed (job is
+        what forget() returned). Blocks on the downloads volume; the
+        janitor calls it from a thread.
+        """
+        directory = job.directory if job else os.path.join(self.root, group_id)
+        try:
+            shutil.rmtree(directory, ignore_errors=False)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Error cleaning up job {group_id}: {e}")
+
+    def unbuffer(self, group_id, keep_types=()):
+        """
+        Returns a sent job's memory buffers to the budget. Items of
+        keep_types that only lived in memory are written to the job
+        directory first (videos, so the "Convert to MP3" button still finds
+        them while the job lingers); the rest never touch the disk.
+        """
+        job = self._jobs.get(group_id)
+        if job is None or not job.buffers:
+            return
+        for media in job.media:
+            if media['type'] in keep_types:
+                try:
+                    job.materialize(media)
+                except OSError as e:
+                    logging.error(f"Could not write {media['path']} of job {group_id}: {e}")
+            media.pop('data', None)
+        self._release(job)
+
+    def _release(self, job):
+        if job and job.buffers and self.budget:
+            self.budget.release(job.buffered)
+            job.buffers = {}
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __iter__(self):
+        return iter(list(self._jobs.values()))
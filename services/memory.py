@@ -0,0 +1,65 @@
+import os
+import threading
+from aiogram.types import BufferedInputFile, FSInputFile
+from services.metrics import metrics
+
+
+class MemoryBudget:
+    """
+    Process-wide cap on the bytes of media kept in memory buffers.
+
+    Files up to item_max bytes may be kept in memory and uploaded from
+    there instead of going through the (slow) downloads volume: photos and
+    clips that yt-dlp would download as a single file and that are sent as
+    is (fetched directly, see DownloaderService._memory_plan), and the
+    Facebook fallback's direct downloads. Anything yt-dlp has to merge or
+    post-process is written to disk by yt-dlp. Every buffer is reserved
+    against `limit`; when that is used up, items go to disk (spill). A
+    job's bytes are given back once it was sent (videos are written out
+    for the convert button then), or when it is removed.
+    """
+
+    def __init__(self, limit=256 * 1024 * 1024, item_max=0):
+        self.limit = limit
+        self.item_max = item_max
+        self.used = 0
+        # Reserved from download threads and the event loop
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.item_max > 0 and self.limit > 0
+
+    def fits(self, size):
+        return self.enabled and size is not None and size <= self.item_max
+
+    def reserve(self, size):
+        """Takes size bytes of the budget; False (spill to disk) if they are not available."""
+        if not self.fits(size):
+            return False
+        with self._lock:
+            if self.used + size > self.limit:
+                metrics.incr('memory.spilled')
+                return False
+            self.used += size
+        metrics.incr('memory.buffered')
+        return True
+
+    def release(self, size):
+        if size:
+            with self._lock:
+                self.used = max(0, self.used - size)
+
+
+def input_file(media):
+    """aiogram upload for a media item: from its memory buffer if it has one, else from disk."""
+    if media.get('data') is not None:
+        return BufferedInputFile(media['data'], filename=os.path.basename(media['path']))
+    return FSInputFile(media['path'])
+
+
+memory_budget = MemoryBudget(
+    limit=int(os.getenv("MEMORY_BUDGET", str(256 * 1024 * 1024))),
+    # 0 keeps everything on disk
+    item_max=int(os.getenv("MEMORY_ITEM_MAX", "0")),
+)
@@ -0,0 +1,75 @@
+import os
+import json
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+
+class Metrics:
+    """
+    Process-wide counters and timings. Cheap enough to update from worker
+    threads; read with snapshot() for logs and diagnostics. Once start()ed,
+    a snapshot is logged every log_interval seconds while anything changes,
+    followed by the readable lines of the reports registered with add_report().
+    """
+
+    def __init__(self, log_interval=300):
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._counters = Counter()
+        # name -> [count, total seconds, max seconds]
+        self._timings = {}
+        self._reports = []
+        self._task = None
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {
+                name: {'count': count, 'avg': total / count if count else 0.0, 'max': peak}
+                for name, (count, total, peak) in self._timings.items()
+            }
+            return {'counters': dict(self._counters), 'timings': timings}
+
+    def add_report(self, report):
+        """Registers report(snapshot), returning a line to log or None."""
+        self._reports.append(report)
+
+    async def _run(self):
+        last = None
+        while True:
+            await asyncio.sleep(self.log_interval)
+            snapshot = self.snapshot()
+            if snapshot != last and (snapshot['counters'] or snapshot['timings']):
+                logging.info(f"Metrics: {json.dumps(snapshot, sort_keys=True, default=str)}")
+                for report in self._reports:
+                    try:
+                        line = report(snapshot)
+                    except Exception as e:
+                        logging.error(f"Metrics report failed: {e}")
+                        continue
+                    if line:
+                        logging.info(line)
+            last = snapshot
+
+    def start(self):
+        """Starts logging snapshots in the background. Call once at startup."""
+        if self.log_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+
+metrics = Metrics(
+    # 0 turns the periodic log off
+    log_interval=int(os.getenv("METRICS_LOG_INTERVAL", "300")),
+)
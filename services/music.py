@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+from services.http import http_client
+from services.html_meta import extract
+
+# Spotify and Apple Music serve og tags to plain browsers without login
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+
+SPOTIFY_TRACK_RE = re.compile(r'spotify\.com/(?:intl-[\w-]+/)?(track|album|playlist|episode)/([A-Za-z0-9]+)')
+APPLE_SONG_RE = re.compile(r'music\.apple\.com/.*?/song/(?:[^/?#]+/)?(\d+)')
+APPLE_TRACK_PARAM_RE = re.compile(r'[?&]i=(\d+)')
+APPLE_ALBUM_RE = re.compile(r'music\.apple\.com/.*?/album/(?:[^/?#]+/)?(\d+)')
+# "Title by Artist on Apple Music", "Title - Song by Artist - Apple Music"
+APPLE_TITLE_RE = re.compile(r'^(?P<title>.+?)(?: [-–] (?:Song|Single|EP|Album))? by (?P<artist>.+?)(?: on Apple Music| [-–] Apple Music)?$')
+YOUTUBE_WATCH = "https://www.youtube.com/watch?v={}"
+
+
+def track_key(url):
+    """Stable id of a Spotify/Apple Music link ('spotify:track:<id>'), or None."""
+    match = SPOTIFY_TRACK_RE.search(url)
+    if match:
+        return f"spotify:{match.group(1)}:{match.group(2)}"
+    match = APPLE_SONG_RE.search(url) or (APPLE_ALBUM_RE.search(url) and APPLE_TRACK_PARAM_RE.search(url))
+    if match:
+        return f"apple:track:{match.group(1)}"
+    match = APPLE_ALBUM_RE.search(url)
+    if match:
+        return f"apple:album:{match.group(1)}"
+    return None
+
+
+def search_key(query):
+    # Free-text searches differing only in case/spacing are the same search
+    return " ".join(query.lower().split())
+
+
+def _clean(text):
+    # Apple Music titles start with an invisible left-to-right mark
+    return (text or "").replace("\u200e", "").strip()
+
+
+def spotify_query(meta):
+    title = _clean(meta.get('title'))
+    if not title:
+        return None
+    # og:description is "Artist · Album · Song · 2020" for tracks
+    description = _clean(meta.get('description'))
+    artist = description.split(" · ")[0] if " · " in description else None
+    return f"{artist} - {title}" if artist else title
+
+
+def apple_music_query(meta):
+    title = _clean(meta.get('title'))
+    if not title:
+        return None
+    match = APPLE_TITLE_RE.match(title)
+    if match:
+        return f"{match.group('artist')} - {match.group('title')}"
+    return re.sub(r'\s*(on|[-–])\s*Apple Music$', '', title)
+
+
+async def fetch_search_query(url, build_query):
+    """Scrapes the page's og tags and builds a YouTube search query from them."""
+    try:
+        _, html = await http_client.get_text(url, headers=HEADERS)
+    except Exception as e:
+        logging.error(f"Could not fetch music page {url}: {e}")
+        return None
+    query = build_query(extract(html))
+    logging.info(f"Music link {url} -> search '{query}'")
+    return query
+
+
+class MusicCache:
+    """
+    Persistent memory of music lookups, so popular songs skip both the
+    metadata scrape and the YouTube search:
+      tracks:   Spotify/Apple track id -> search query -> YouTube video id
+      searches: free-text query -> YouTube video id
+    """
+
+    def __init__(self, path, ttl=30 * 24 * 3600):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            " key TEXT PRIMARY KEY, query TEXT, video_id TEXT, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS searches ("
+            " query TEXT PRIMARY KEY, video_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def get_track(self, key):
+        """Returns (query, video_id) for a track key; either may be None."""
+        if not key:
+            return None, None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT query, video_id FROM tracks WHERE key = ? AND updated_at > ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return row if row else (None, None)
+
+    def put_track(self, key, query, video_id=None):
+        if not key:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO tracks (key, query, video_id, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET query = excluded.query,"
+                " video_id = COALESCE(excluded.video_id, tracks.video_id), updated_at = excluded.updated_at",
+                (key, query, video_id, time.time()),
+            )
+
+    def get_search(self, query):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT video_id FROM searches WHERE query = ? AND updated_at > ?",
+                (search_key(query), time.time() - self.ttl),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_search(self, query, video_id):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO searches (query, video_id, updated_at) VALUES (?, ?, ?)",
+                (search_key(query), video_id, time.time()),
+            )
+
+
+music_cache = MusicCache(
+    os.getenv("MUSIC_CACHE_PATH", os.path.join("cache", "music.db")),
+    ttl=int(os.getenv("MUSIC_CACHE_TTL", str(30 * 24 * 3600))),
+)
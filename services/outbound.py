@@ -0,0 +1,215 @@
+import os
+import time
+import asyncio
+import itertools
+import logging
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    EditMessageCaption, EditMessageReplyMarkup, EditMessageText,
+    SendAnimation, SendAudio, SendDocument, SendMediaGroup, SendPhoto, SendVideo, SendVoice,
+)
+
+# Lower value = sent first
+PRIORITY_UPLOAD = 0
+PRIORITY_NORMAL = 1
+PRIORITY_STATUS = 2
+
+UPLOAD_METHODS = (SendVideo, SendMediaGroup, SendAudio, SendPhoto, SendDocument, SendAnimation, SendVoice)
+EDIT_METHODS = (EditMessageText, EditMessageCaption, EditMessageReplyMarkup)
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds):
+        # Telegram told us to back off (retry_after)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Session middleware that shapes outgoing Bot API traffic to stay under
+    Telegram's flood limits: a global bucket, one bucket per private chat
+    and a slower one per group. Uploads go before normal messages, which go
+    before status edits; an edit that a newer edit of the same message
+    replaced before it was sent is dropped. 429 retry_after responses
+    block the affected bucket and the request is retried.
+
+    Only methods addressed to a chat are shaped; getUpdates, callback
+    answers etc. pass straight through.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, group_per_minute=20, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._pending = []
+        self._seq = itertools.count()
+        self._latest_edit = {}
+        self._wakeup = None
+        self._dispatcher = None
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._prune_buckets()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            if is_group:
+                bucket = TokenBucket(self.group_per_minute / 60, 5)
+            else:
+                bucket = TokenBucket(self.chat_rate, 3)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        # Idle chats have full buckets; forgetting them changes nothing
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if bucket.delay(now) <= 0 and bucket.tokens >= bucket.capacity:
+                del self._chat_buckets[chat_id]
+
+    @staticmethod
+    def _priority(method):
+        if isinstance(method, UPLOAD_METHODS):
+            return PRIORITY_UPLOAD
+        if isinstance(method, EDIT_METHODS):
+            return PRIORITY_STATUS
+        return PRIORITY_NORMAL
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            next_delay = None
+            blocked_chats = set()
+            chosen = None
+
+            # Highest priority first; a waiting request holds back lower
+            # priority ones for the same chat so they can't eat its budget
+            for entry in sorted(self._pending, key=lambda e: (e[0], e[1])):
+                priority, seq, chat_id, future, is_stale = entry
+                if future.done() or chat_id in blocked_chats:
+                    continue
+                if is_stale and is_stale():
+                    # Superseded before its turn: let it go without spending a token
+                    future.set_result(False)
+                    continue
+                delay = max(self.global_bucket.delay(now), self._bucket(chat_id).delay(now))
+                if delay <= 0:
+                    chosen = entry
+                    break
+                blocked_chats.add(chat_id)
+                next_delay = delay if next_delay is None else min(next_delay, delay)
+
+            if chosen:
+                self._pending.remove(chosen)
+                self.global_bucket.take(now)
+                self._bucket(chosen[2]).take(now)
+                chosen[3].set_result(True)
+                continue
+
+            # Drop requests whose callers went away
+            self._pending = [entry for entry in self._pending if not entry[3].done()]
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), next_delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _acquire(self, chat_id, priority, is_stale=None):
+        """
+        Waits for this request's turn. Returns False if is_stale() became
+        true while waiting and the request should not be sent.
+        """
+        self._ensure_dispatcher()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((priority, next(self._seq), chat_id, future, is_stale))
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            if not future.done():
+                future.cancel()
+            self._wakeup.set()
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await self._send(make_request, bot, method, self.global_bucket)
+
+        edit_key = None
+        edit_seq = None
+        is_stale = None
+        if isinstance(method, EDIT_METHODS):
+            edit_key = (chat_id, getattr(method, 'message_id', None))
+            edit_seq = next(self._seq)
+            self._latest_edit[edit_key] = edit_seq
+            # A newer edit of this message is queued; this one would be overwritten anyway
+            is_stale = lambda: self._latest_edit.get(edit_key) != edit_seq
+
+        try:
+            for attempt in range(self.max_retries + 1):
+                if not await self._acquire(chat_id, self._priority(method), is_stale):
+                    return True
+
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    logging.warning(f"Flood control on {type(method).__name__} in chat {chat_id}, retrying in {e.retry_after}s")
+                    self._bucket(chat_id).block(e.retry_after)
+        finally:
+            if edit_key and self._latest_edit.get(edit_key) == edit_seq:
+                del self._latest_edit[edit_key]
+
+    async def _send(self, make_request, bot, method, bucket):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                logging.warning(f"Flood control on {type(method).__name__}, retrying in {e.retry_after}s")
+                bucket.block(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+
+def create_outbound_scheduler():
+    return OutboundScheduler(
+        global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+        chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+        group_per_minute=float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20")),
+        max_retries=int(os.getenv("OUTBOUND_MAX_RETRIES", "3")),
+    )
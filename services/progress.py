@@ -0,0 +1,201 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# Phases in the order a job normally goes through them
+QUEUED = 'queued'
+EXTRACTING = 'extracting'
+DOWNLOADING = 'downloading'
+MERGING = 'merging'
+CONVERTING = 'converting'
+UPLOADING = 'uploading'
+
+# yt-dlp post-processors worth telling the user about
+POSTPROCESSOR_PHASES = {
+    'Merger': MERGING,
+    'FFmpegMerger': MERGING,
+    'ExtractAudio': CONVERTING,
+    'FFmpegExtractAudio': CONVERTING,
+    'VideoConvertor': CONVERTING,
+    'FFmpegVideoConvertor': CONVERTING,
+}
+
+
+def _format_bytes(size):
+    if size is None:
+        return "?"
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+class Progress:
+    """
+    State of one download job, updated from yt-dlp hooks on the worker
+    thread and read by StatusReporter on the event loop.
+
+    Requests that joined an in-flight download follow() the progress of
+    the job they are waiting on until they move on to their own upload.
+    """
+
+    def __init__(self):
+        self.phase = EXTRACTING
+        self.queue_position = 0
+        self.downloaded = 0
+        self.total = None
+        self.speed = None
+        self.eta = None
+        self.item = None
+        self.items = None
+        self._leader = None
+
+    def follow(self, other):
+        if other is not self:
+            self._leader = other
+
+    def state(self):
+        return self._leader.state() if self._leader else self
+
+    # Fields passed between processes (worker -> front-end)
+    SNAPSHOT_FIELDS = ('phase', 'queue_position', 'downloaded', 'total', 'speed', 'eta', 'item', 'items')
+
+    def snapshot(self):
+        state = self.state()
+        return {name: getattr(state, name) for name in self.SNAPSHOT_FIELDS}
+
+    def load(self, snapshot):
+        for name in self.SNAPSHOT_FIELDS:
+            if name in snapshot:
+                setattr(self, name, snapshot[name])
+
+    def set_phase(self, phase):
+        # A follower that starts its own phase no longer mirrors the leader
+        self._leader = None
+        self.phase = phase
+
+    def set_queued(self, position):
+        # Scheduler callback: position 0 means the job got a worker
+        self.queue_position = position
+        self.phase = QUEUED if position else EXTRACTING
+
+    def ytdl_hook(self, d):
+        # yt-dlp progress_hooks entry, called on the worker thread
+        if d.get('status') != 'downloading':
+            return
+        info = d.get('info_dict') or {}
+        self.phase = DOWNLOADING
+        self.downloaded = d.get('downloaded_bytes') or 0
+        self.total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        self.speed = d.get('speed')
+        self.eta = d.get('eta')
+        self.item = info.get('playlist_index')
+        self.items = info.get('n_entries') or info.get('playlist_count')
+
+    def ytdl_pp_hook(self, d):
+        # yt-dlp postprocessor_hooks entry, called on the worker thread
+        phase = POSTPROCESSOR_PHASES.get(d.get('postprocessor'))
+        if phase and d.get('status') == 'started':
+            self.phase = phase
+
+    def percent(self):
+        if not self.total:
+            return None
+        return min(100, int(self.downloaded * 100 / self.total))
+
+    def key(self):
+        """
+        Coarse summary of the state. The status message is only edited
+        when this changes, not on every byte.
+        """
+        percent = self.percent()
+        return (self.phase, self.queue_position, self.item, percent // 5 if percent is not None else None)
+
+    def render(self, is_search=False):
+        if self.phase == QUEUED:
+            return f"⏳ <b>Queued (#{self.queue_position})</b>\n<i>Waiting for a free slot...</i>"
+        if self.phase == EXTRACTING:
+            return "🔎 <b>Searching...</b>" if is_search else "🔗 <b>Fetching info...</b>"
+        if self.phase == DOWNLOADING:
+            percent = self.percent()
+            header = "⬇️ <b>Downloading...</b>"
+            if percent is not None:
+                header += f" {percent}%"
+            if self.item and self.items and self.items > 1:
+                header += f" ({self.item}/{self.items})"
+            details = f"{_format_bytes(self.downloaded)} / {_format_bytes(self.total)}"
+            if self.speed:
+                details += f" · {_format_bytes(self.speed)}/s"
+            if self.eta is not None:
+                details += f" · ETA {_format_eta(self.eta)}"
+            return f"{header}\n<i>{details}</i>"
+        if self.phase == MERGING:
+            return "🎞 <b>Merging video and audio...</b>"
+        if self.phase == CONVERTING:
+            return "🎵 <b>Converting...</b>"
+        if self.phase == UPLOADING:
+            return "📤 <b>Uploading...</b>"
+        return "⏳ <b>Processing...</b>"
+
+
+class StatusReporter:
+    """
+    Mirrors a Progress into a status message. Edits are only sent when the
+    visible state changes, and never more often than min_interval seconds.
+    reply_markup (the Cancel button) is kept on the message until the upload starts.
+    """
+
+    def __init__(self, message, progress, is_search=False, min_interval=None, poll_interval=0.5, reply_markup=None):
+        self.message = message
+        self.progress = progress
+        self.is_search = is_search
+        self.reply_markup = reply_markup
+        self.min_interval = min_interval if min_interval is not None else float(os.getenv("STATUS_EDIT_INTERVAL", "3"))
+        self.poll_interval = poll_interval
+        self._task = None
+        self._last_key = None
+        self._last_edit = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            state = self.progress.state()
+            key = state.key()
+            if key != self._last_key and time.monotonic() - self._last_edit >= self.min_interval:
+                self._last_key = key
+                self._last_edit = time.monotonic()
+                try:
+                    await self.message.edit_text(
+                        state.render(self.is_search),
+                        reply_markup=self.reply_markup if state.phase != UPLOADING else None
+                    )
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except TelegramBadRequest:
+                    # "message is not modified" or the message is gone
+                    pass
+                except Exception as e:
+                    logging.warning(f"Status update failed: {e}")
+                    return
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import threading
+from services.scheduler import QueueFullError, platform_of
+from services.formats import MediaTooLargeError
+from services.execution import DownloadCancelled
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# How a failed job is reported back to the front-end
+ERROR_KINDS = {
+    'too_large': MediaTooLargeError,
+    'busy': QueueFullError,
+    # The worker stopped it; the error text is the reason ('timeout', 'stalled')
+    'cancelled': DownloadCancelled,
+}
+
+
+class JobFailedError(Exception):
+    """A worker gave up on the job; the message comes from the worker."""
+
+
+class JobQueue:
+    """
+    Durable download queue shared by the bot front-end and worker
+    processes through a SQLite file.
+
+    The front-end enqueue()s a link and polls the row for progress and the
+    result. Every call blocks on SQLite (up to its busy timeout while
+    another process writes), so callers on an event loop run them with
+    asyncio.to_thread(), like wait() does. Workers claim() the oldest queued job with a lease, extend it
+    with heartbeat() while they work, and publish the outcome with
+    complete() or fail(). A job whose lease runs out (worker crashed or
+    hung) is handed to the next worker, up to max_attempts times.
+
+    Downloaded files stay in the downloads folder, which must be the same
+    path for the front-end and every worker.
+    """
+
+    def __init__(self, path, lease=60, max_queue=200, max_attempts=3):
+        self.path = os.path.abspath(path)
+        self.lease = lease
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, url TEXT NOT NULL, force_audio INTEGER NOT NULL,"
+            " user_id INTEGER, platform TEXT, status TEXT NOT NULL,"
+            " worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " progress TEXT, result TEXT, error_kind TEXT, error TEXT,"
+            " created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created_at)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    # --- Front-end side ---
+
+    def enqueue(self, url, force_audio=False, user_id=None):
+        """Adds a job and returns its id. Raises QueueFullError when the queue is full."""
+        queued = self._execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+        if queued >= self.max_queue:
+            raise QueueFullError(f"Download queue is full ({queued} waiting)")
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, url, force_audio, user_id, platform, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, url, int(force_audio), user_id, platform_of(url), QUEUED, now, now),
+        )
+        return job_id
+
+    def get(self, job_id):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def position(self, job_id, created_at):
+        """1-based place of a queued job in the queue."""
+        ahead = self._execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?", (QUEUED, created_at)
+        ).fetchone()[0]
+        return ahead + 1
+
+    def remove(self, job_id):
+        self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    async def wait(self, job_id, progress=None, poll_interval=0.5, stop=None):
+        """
+        Polls the job until a worker finishes it, mirroring its state into
+        progress. Returns the published media list, or raises the error the
+        worker reported. If stop() returns a reason, the job is deleted (a
+        worker running it gives up on its next heartbeat) and
+        DownloadCancelled is raised.
+        """
+        try:
+            while True:
+                reason = stop() if stop else None
+                if reason:
+                    await asyncio.to_thread(self.remove, job_id)
+                    raise DownloadCancelled(reason)
+                job = await asyncio.to_thread(self.get, job_id)
+                if job is None:
+                    raise JobFailedError("Job disappeared from the queue")
+                if job['status'] == DONE:
+                    return json.loads(job['result'] or '[]')
+                if job['status'] == FAILED:
+                    error = ERROR_KINDS.get(job['error_kind'], JobFailedError)
+                    raise error(job['error'] or "Download failed")
+                if progress is not None:
+                    if job['status'] == QUEUED:
+                        progress.set_queued(await asyncio.to_thread(self.position, job_id, job['created_at']))
+                    elif job['progress']:
+                        progress.load(json.loads(job['progress']))
+                await asyncio.sleep(poll_interval)
+        finally:
+            # Finished rows are not needed once read; a cancelled waiter
+            # leaves a running job to finish (the janitor reclaims its files)
+            job = await asyncio.to_thread(self.get, job_id)
+            if job and job['status'] in (DONE, FAILED, QUEUED):
+                await asyncio.to_thread(self.remove, job_id)
+
+    # --- Worker side ---
+
+    def claim(self, worker_id):
+        """
+        Takes the oldest queued job, or one whose lease ran out, and
+        returns its row as claimed (running, with this worker's lease and
+        the attempt counted). Returns None when there is nothing to do.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs that keep killing their workers are not retried forever
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, error_kind = 'error', error = 'Worker lost', updated_at = ?"
+                    " WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                    (FAILED, now, RUNNING, now, self.max_attempts),
+                )
+                row = self._db.execute(
+                    "SELECT * FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?)"
+                    " ORDER BY created_at LIMIT 1",
+                    (QUEUED, RUNNING, now),
+                ).fetchone()
+                if row is None:
+                    self._db.execute("COMMIT")
+                    return None
+                if row['status'] == RUNNING:
+                    logging.warning(f"Lease of job {row['id']} held by {row['worker']} expired, taking it over")
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?"
+                    " WHERE id = ?",
+                    (RUNNING, worker_id, now + self.lease, now, row['id']),
+                )
+                row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone()
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return dict(row)
+
+    def heartbeat(self, job_id, worker_id, progress=None):
+        """
+        Extends the lease and stores the progress snapshot.
+        Returns False if the job is no longer ours.
+        """
+        now = time.time()
+        cursor = self._execute(
+            "UPDATE jobs SET lease_until = ?, progress = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+            (now + self.lease, json.dumps(progress) if progress else None, now, job_id, worker_id, RUNNING),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        cursor = self._execute(
+            "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+            (DONE, json.dumps(result), time.time(), job_id, worker_id, RUNNING),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker_id, kind, message):
+        cursor = self._execute(
+            "UPDATE jobs SET status = ?, error_kind = ?, error = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+            (FAILED, kind, message, time.time(), job_id, worker_id, RUNNING),
+        )
+        return cursor.rowcount == 1
+
+    def purge(self, older_than=3600):
+        """Drops finished jobs nobody picked up (their front-end went away)."""
+        self._execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (DONE, FAILED, time.time() - older_than),
+        )
+
+
+job_queue = None
+
+def get_job_queue():
+    """Returns the shared queue, opening it on first use."""
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(
+            os.getenv("JOB_QUEUE_PATH", os.path.join("cache", "jobs.db")),
+            lease=int(os.getenv("JOB_LEASE", "60")),
+            max_queue=int(os.getenv("DOWNLOAD_QUEUE_SIZE", "200")),
+            max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+        )
+    return job_queue
@@ -0,0 +1,149 @@
+import os
+import asyncio
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+class QueueFullError(Exception):
+    """Raised when the download queue is at capacity."""
+
+
+def platform_of(url: str) -> str:
+    """
+    Returns a short platform name for per-platform limits,
+    e.g. 'tiktok' for https://vm.tiktok.com/...
+    """
+    if url.startswith("ytsearch"):
+        return "youtube"
+    host = urlsplit(url).netloc.lower().split(':')[0]
+    labels = [l for l in host.split('.') if l]
+    if len(labels) >= 2:
+        return labels[-2]
+    return host or "unknown"
+
+
+class _Job:
+    __slots__ = ('user_id', 'platform', 'on_queued', 'ready', 'position')
+
+    def __init__(self, user_id, platform, on_queued, ready):
+        self.user_id = user_id
+        self.platform = platform
+        self.on_queued = on_queued
+        self.ready = ready
+        self.position = None
+
+
+class DownloadScheduler:
+    """
+    Process-wide scheduler for blocking download work (yt-dlp, ffmpeg merges).
+
+    Jobs wait in a bounded FIFO queue and run on a shared thread pool.
+    A job only starts when a worker is free and its user and platform are
+    below their concurrency caps; jobs that can't start yet don't block
+    the ones behind them.
+    """
+
+    def __init__(self, workers=4, max_queue=100, per_user=2, per_platform=3):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_user = per_user
+        self.per_platform = per_platform
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self._pending = []
+        self._running = 0
+        self._user_running = Counter()
+        self._platform_running = Counter()
+
+    @property
+    def queued(self):
+        return len(self._pending)
+
+    @property
+    def running(self):
+        return self._running
+
+    def _can_start(self, job):
+        if self._running >= self.workers:
+            return False
+        if job.user_id is not None and self._user_running[job.user_id] >= self.per_user:
+            return False
+        return self._platform_running[job.platform] < self.per_platform
+
+    def _dispatch(self):
+        still_pending = []
+        for job in self._pending:
+            if not job.ready.done() and self._can_start(job):
+                self._running += 1
+                self._user_running[job.user_id] += 1
+                self._platform_running[job.platform] += 1
+                job.ready.set_result(None)
+                if job.position and job.on_queued:
+                    # Left the queue
+                    self._notify(job, 0)
+            elif not job.ready.done():
+                still_pending.append(job)
+        self._pending = still_pending
+
+        # Tell waiting jobs where they are in the line
+        for position, job in enumerate(self._pending, start=1):
+            if job.position != position:
+                job.position = position
+                if job.on_queued:
+                    self._notify(job, position)
+
+    def _notify(self, job, position):
+        try:
+            job.on_queued(position)
+        except Exception as e:
+            logging.error(f"Queue position callback failed: {e}")
+
+    def _release(self, job):
+        self._running -= 1
+        self._user_running[job.user_id] -= 1
+        if self._user_running[job.user_id] <= 0:
+            del self._user_running[job.user_id]
+        self._platform_running[job.platform] -= 1
+        if self._platform_running[job.platform] <= 0:
+            del self._platform_running[job.platform]
+        self._dispatch()
+
+    async def run(self, fn, user_id=None, platform="unknown", on_queued=None):
+        """
+        Runs fn() on the worker pool once limits allow it.
+        on_queued(position) is called whenever the job's queue position changes,
+        and with 0 once a job that had to wait is started.
+        Raises QueueFullError if too many jobs are already waiting.
+        """
+        if len(self._pending) >= self.max_queue:
+            raise QueueFullError("Download queue is full")
+
+        loop = asyncio.get_running_loop()
+        job = _Job(user_id, platform, on_queued, loop.create_future())
+        self._pending.append(job)
+        self._dispatch()
+
+        try:
+            await job.ready
+        except asyncio.CancelledError:
+            if job in self._pending:
+                self._pending.remove(job)
+                self._dispatch()
+            elif job.ready.done() and not job.ready.cancelled():
+                # Got a slot in the same tick we were cancelled
+                self._release(job)
+            raise
+
+        try:
+            return await loop.run_in_executor(self._executor, fn)
+        finally:
+            self._release(job)
+
+
+scheduler = DownloadScheduler(
+    workers=int(os.getenv("DOWNLOAD_WORKERS", "4")),
+    max_queue=int(os.getenv("DOWNLOAD_QUEUE_SIZE", "100")),
+    per_user=int(os.getenv("DOWNLOAD_PER_USER", "2")),
+    per_platform=int(os.getenv("DOWNLOAD_PER_PLATFORM", "3")),
+)
@@ -0,0 +1,370 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import concurrent.futures
+import aiohttp
+import aiofiles
+import yt_dlp
+from yt_dlp.downloader.common import FileDownloader
+from yt_dlp.utils import determine_protocol
+from services.http import http_client, HttpClient, CHUNK_SIZE
+from services.metrics import metrics
+
+# How often the resume sidecar is rewritten while segments run
+STATE_INTERVAL = 1.0
+CONTENT_RANGE_PREFIX = 'bytes 0-0/'
+
+
+class RangeNotSupported(Exception):
+    """The server ignored a Range request."""
+
+
+class SegmentedDownloader:
+    """
+    Downloads large direct files over several HTTP connections at once.
+    CDNs throttle per connection, so N parallel Range requests into a
+    preallocated file get close to N times the bandwidth.
+
+    A file is split into at most `per_job` segments (none smaller than
+    min_segment) and all jobs share `total` segment slots. What each
+    segment has written is kept in a '<path>.segments' sidecar, so a
+    retried segment or a new call for the same path continues where it
+    stopped. Servers without Range support, and files under min_size,
+    are fetched as a single stream.
+    """
+
+    def __init__(self, client, per_job=4, total=16, min_size=8 * 1024 * 1024, min_segment=2 * 1024 * 1024, retries=3):
+        self.client = client
+        self.per_job = per_job
+        self.min_size = min_size
+        self.min_segment = min_segment
+        self.retries = retries
+        self._slots = asyncio.Semaphore(total)
+        # Event loop the shared client lives on, for calls from yt-dlp threads
+        self.loop = None
+
+    def attach(self, loop):
+        """Lets yt-dlp download threads use this instance through loop."""
+        self.loop = loop
+
+    async def download(self, url, path, headers=None, on_progress=None, proxy=None, retries=None):
+        """
+        Downloads url into path. on_progress(downloaded, total) is called
+        as bytes arrive (total may be None). Returns the size written.
+        proxy is an http(s):// proxy URL; retries overrides the attempts per
+        segment. Raises aiohttp.ClientError / asyncio.TimeoutError / OSError;
+        segment state is kept for a later call with the same path.
+        """
+        # Ranges are byte offsets of the stored file; no transparent gzip
+        headers = {**(headers or {}), 'Accept-Encoding': 'identity'}
+        retries = retries or self.retries
+        size, final_url = await self._probe(url, headers, proxy)
+        if size is None or size < self.min_size:
+            metrics.incr('segmented.single')
+            return await self._single(url, path, headers, on_progress, size, proxy)
+
+        segments = self._load_state(path, size) or self._plan(size)
+        self._preallocate(path, size)
+        job_slots = asyncio.Semaphore(self.per_job)
+        start = time.monotonic()
+        written = [sum(done for _, _, done in segments)]
+        resumed = written[0]
+        logging.info(f"Segmented download of {size} bytes in {len(segments)} segment(s): {path}")
+
+        def report(count):
+            written[0] += count
+            if on_progress:
+                on_progress(written[0], size)
+
+        saver = asyncio.ensure_future(self._save_periodically(path, size, segments))
+        tasks = [
+            asyncio.ensure_future(self._fetch(final_url, headers, path, segment, job_slots, report, proxy, retries))
+            for segment in segments if segment[2] < segment[1] - segment[0] + 1
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException as e:
+            # One segment failed for good (or we were cancelled): stop the others
+            saver.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if not isinstance(e, RangeNotSupported):
+                self._save_state(path, size, segments)
+                raise
+            # Some CDN nodes behind the same name don't do ranges
+            logging.warning(f"Range requests refused mid-download, falling back to one stream: {url}")
+            self._remove_state(path)
+            metrics.incr('segmented.single')
+            return await self._single(url, path, headers, on_progress, size, proxy)
+        saver.cancel()
+        self._remove_state(path)
+        metrics.incr('segmented.downloads')
+        metrics.observe('segmented.seconds', time.monotonic() - start)
+        if resumed:
+            logging.info(f"Resumed {path} from {resumed} bytes")
+        return size
+
+    async def _probe(self, url, headers, proxy=None):
+        """(total size, final url) when the server honours ranges, else (None, url)."""
+        probe_headers = {**headers, 'Range': 'bytes=0-0'}
+        async with self.client.session().get(
+            url, headers=probe_headers, proxy=proxy, timeout=self.client.page_timeout, allow_redirects=True
+        ) as response:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status == 206 and content_range.startswith(CONTENT_RANGE_PREFIX):
+                total = content_range[len(CONTENT_RANGE_PREFIX):]
+                if total.isdigit():
+                    return int(total), str(response.url)
+            return None, url
+
+    def _plan(self, size):
+        count = max(1, min(self.per_job, size // self.min_segment))
+        step = -(-size // count)
+        # [first byte, last byte, bytes written]
+        return [[offset, min(offset + step, size) - 1, 0] for offset in range(0, size, step)]
+
+    def _preallocate(self, path, size):
+        mode = 'r+b' if os.path.exists(path) else 'wb'
+        with open(path, mode) as f:
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    # Reserve the blocks now: no fragmentation, and a full disk fails up front
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    f.truncate(size)
+            else:
+                f.truncate(size)
+
+    async def _fetch(self, url, headers, path, segment, job_slots, report, proxy=None, retries=None):
+        retries = retries or self.retries
+        for attempt in range(1, retries + 1):
+            first, last, done = segment
+            if first + done > last:
+                return
+            try:
+                async with job_slots, self._slots:
+                    range_headers = {**headers, 'Range': f'bytes={first + done}-{last}'}
+                    async with self.client.session().get(
+                        url, headers=range_headers, proxy=proxy, timeout=self.client.download_timeout
+                    ) as response:
+                        if response.status != 206:
+                            raise RangeNotSupported(f"HTTP {response.status}")
+                        async with aiofiles.open(path, 'r+b') as f:
+                            await f.seek(first + done)
+                            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                                await f.write(chunk)
+                                segment[2] += len(chunk)
+                                report(len(chunk))
+                if first + segment[2] <= last:
+                    raise aiohttp.ClientPayloadError("Segment ended early")
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.incr('segmented.retries')
+                if attempt == retries:
+                    raise
+                logging.warning(f"Segment {first}-{last} of {path} failed at {segment[2]} bytes (attempt {attempt}/{retries}): {e}")
+                await asyncio.sleep(attempt)
+
+    async def _single(self, url, path, headers, on_progress, size, proxy=None):
+        written = [0]
+
+        def report(count):
+            written[0] += count
+            if on_progress:
+                on_progress(written[0], size)
+
+        if not await self.client.download(url, path, headers=headers, on_chunk=report, proxy=proxy):
+            raise aiohttp.ClientError(f"Download of {url} failed")
+        return written[0]
+
+    # --- Resume state ---
+
+    @staticmethod
+    def _state_path(path):
+        return f"{path}.segments"
+
+    def _load_state(self, path, size):
+        try:
+            with open(self._state_path(path)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('size') != size or not os.path.exists(path):
+            return None
+        return state['segments']
+
+    def _save_state(self, path, size, segments):
+        tmp_path = f"{self._state_path(path)}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'size': size, 'segments': segments}, f)
+            os.replace(tmp_path, self._state_path(path))
+        except OSError as e:
+            logging.warning(f"Could not save segment state of {path}: {e}")
+
+    def _remove_state(self, path):
+        try:
+            os.remove(self._state_path(path))
+        except FileNotFoundError:
+            pass
+
+    async def _save_periodically(self, path, size, segments):
+        while True:
+            await asyncio.sleep(STATE_INTERVAL)
+            self._save_state(path, size, segments)
+
+
+class SegmentedFD(FileDownloader):
+    """
+    yt-dlp downloader that fetches a plain HTTP format with the
+    SegmentedDownloader. It runs on the download thread: through the bot's
+    event loop when one is attached, otherwise (worker processes) on a
+    private loop and connection pool. Progress goes to the usual progress
+    hooks, and an exception raised by a hook (a cancel) stops the download.
+    """
+
+    @classmethod
+    def suitable(cls, info_dict, params):
+        """
+        Only for formats known to be big enough to gain from it, and only
+        when none of yt-dlp's own HTTP settings would be bypassed: chunked
+        requests (YouTube's throttling workaround), rate limits, or a
+        proxy aiohttp can't use.
+        """
+        if not SEGMENTED_YTDL or info_dict.get('requested_formats') or info_dict.get('to_stdout'):
+            return False
+        # Fragmented formats (DASH/HLS) have their own concurrent fragment downloads
+        if determine_protocol(info_dict) not in ('http', 'https') or 'fragments' in info_dict:
+            return False
+        chunk_size = params.get('http_chunk_size') or (info_dict.get('downloader_options') or {}).get('http_chunk_size')
+        if chunk_size or params.get('ratelimit') or params.get('throttledratelimit'):
+            return False
+        proxy = params.get('proxy')
+        if proxy and not proxy.startswith(('http://', 'https://')):
+            return False
+        size = info_dict.get('filesize') or info_dict.get('filesize_approx')
+        return bool(size) and size >= segmented.min_size
+
+    def real_download(self, filename, info_dict):
+        self.report_destination(filename)
+        tmpfilename = self.temp_name(filename)
+        url = info_dict['url']
+        headers = dict(info_dict.get('http_headers') or {})
+        cookie_header = self.ydl.cookiejar.get_cookie_header(url)
+        if cookie_header:
+            headers['Cookie'] = cookie_header
+        proxy = self.params.get('proxy') or None
+        # yt-dlp's --retries as attempts per segment ("infinite" keeps our default)
+        retries = self.params.get('retries')
+        attempts = retries + 1 if isinstance(retries, int) else None
+
+        started = time.time()
+        latest = {}
+
+        def on_progress(downloaded, total):
+            latest.update(downloaded=downloaded, total=total)
+
+        def hook():
+            if not latest:
+                return
+            elapsed = time.time() - started
+            self._hook_progress({
+                'status': 'downloading',
+                'filename': filename,
+                'tmpfilename': tmpfilename,
+                'downloaded_bytes': latest['downloaded'],
+                'total_bytes': latest['total'],
+                'elapsed': elapsed,
+                'speed': latest['downloaded'] / elapsed if elapsed else None,
+                'eta': (latest['total'] - latest['downloaded']) / (latest['downloaded'] / elapsed)
+                if latest['total'] and latest['downloaded'] and elapsed else None,
+            }, info_dict)
+
+        try:
+            loop = segmented.loop
+            if loop is not None and loop.is_running():
+                future = asyncio.run_coroutine_threadsafe(
+                    segmented.download(url, tmpfilename, headers, on_progress, proxy=proxy, retries=attempts), loop
+                )
+                try:
+                    while not future.done():
+                        concurrent.futures.wait([future], timeout=0.5)
+                        hook()
+                    future.result()
+                finally:
+                    # A hook raised (cancel); stop the transfer on the loop
+                    future.cancel()
+            else:
+                asyncio.run(self._download_privately(url, tmpfilename, headers, on_progress, hook, proxy, attempts))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self.report_error(f"Segmented download failed: {e}")
+            return False
+
+        size = os.path.getsize(tmpfilename)
+        self.try_rename(tmpfilename, filename)
+        self._hook_progress({
+            'status': 'finished',
+            'filename': filename,
+            'downloaded_bytes': size,
+            'total_bytes': size,
+            'elapsed': time.time() - started,
+        }, info_dict)
+        return True
+
+    @staticmethod
+    async def _download_privately(url, path, headers, on_progress, hook, proxy, retries):
+        # Same limits, but a connection pool of our own (no shared loop in this process)
+        client = HttpClient(limit=segmented.per_job, limit_per_host=segmented.per_job)
+        downloader = SegmentedDownloader(
+            client, per_job=segmented.per_job, total=segmented.per_job,
+            min_size=segmented.min_size, min_segment=segmented.min_segment, retries=segmented.retries,
+        )
+        task = asyncio.ensure_future(downloader.download(url, path, headers, on_progress, proxy=proxy, retries=retries))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=0.5)
+                hook()
+            return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            await client.close()
+
+
+class SegmentedYoutubeDL(yt_dlp.YoutubeDL):
+    """
+    YoutubeDL that hands formats SegmentedFD is suitable for to it; every
+    other download goes through yt-dlp's own downloader choice.
+
+    Each download is announced to the progress hooks with status 'started'
+    before any request is made: yt-dlp's first 'downloading' event only
+    comes after a full block, so a connection that hangs on the headers or
+    the first bytes would otherwise not count as a running transfer.
+    """
+
+    def dl(self, name, info, subtitle=False, test=False):
+        if not test:
+            for hook in self.params.get('progress_hooks') or []:
+                hook({'status': 'started', 'filename': name, 'info_dict': info})
+        if subtitle or test or name == '-' or not SegmentedFD.suitable(info, self.params):
+            return super().dl(name, info, subtitle=subtitle, test=test)
+        fd = SegmentedFD(self, self.params)
+        for hook in self.params.get('progress_hooks') or []:
+            fd.add_progress_hook(hook)
+        self.write_debug(f'Invoking segmented downloader on "{info["url"]}"')
+        return fd.download(name, dict(info), subtitle)
+
+
+# Big plain-HTTP formats of yt-dlp downloads go through SegmentedFD (0 = never)
+SEGMENTED_YTDL = os.getenv("SEGMENTED_DOWNLOADS", "1") != "0"
+
+segmented = SegmentedDownloader(
+    http_client,
+    per_job=int(os.getenv("SEGMENTS_PER_JOB", "4")),
+    total=int(os.getenv("SEGMENTS_TOTAL", "16")),
+    min_size=int(os.getenv("SEGMENTED_MIN_SIZE", str(8 * 1024 * 1024))),
+)
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in a local SQLite file: survives restarts and can be
+    shared by several bot processes on the same machine.
+    Rows untouched for `ttl` seconds are dropped (0 keeps them forever).
+    """
+
+    def __init__(self, path, ttl=0):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_destiny=True)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL DEFAULT '{}',"
+            " updated_at REAL NOT NULL)"
+        )
+        if self.ttl:
+            with self._lock:
+                self._db.execute("DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def _key(self, key):
+        return self.key_builder.build(key)
+
+    def _get(self, key, column):
+        with self._lock:
+            row = self._db.execute(f"SELECT {column}, updated_at FROM fsm WHERE key = ?", (self._key(key),)).fetchone()
+        if not row or (self.ttl and row[1] < time.time() - self.ttl):
+            return None
+        return row[0]
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO fsm (key, state, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (self._key(key), state, time.time()),
+            )
+
+    async def get_state(self, key):
+        return self._get(key, "state")
+
+    async def set_data(self, key, data):
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO fsm (key, data, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (self._key(key), json.dumps(data), time.time()),
+            )
+
+    async def get_data(self, key):
+        data = self._get(key, "data")
+        return json.loads(data) if data else {}
+
+    async def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def create_storage():
+    """
+    FSM storage picked by FSM_STORAGE:
+      memory  - default, per process, lost on restart
+      sqlite  - FSM_SQLITE_PATH (default cache/fsm.db)
+      redis   - REDIS_URL, any Redis-protocol server; needs the redis package
+    FSM_TTL (seconds) expires idle states and data for sqlite and redis.
+    """
+    backend = os.getenv("FSM_STORAGE", "memory").lower()
+    ttl = int(os.getenv("FSM_TTL", "0")) or None
+
+    if backend == "redis":
+        # Optional dependency, only needed for this backend
+        from aiogram.fsm.storage.redis import RedisStorage
+        url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        logging.info(f"FSM storage: redis at {url}")
+        return RedisStorage.from_url(
+            url,
+            key_builder=DefaultKeyBuilder(with_destiny=True),
+            state_ttl=ttl,
+            data_ttl=ttl,
+        )
+    if backend == "sqlite":
+        path = os.getenv("FSM_SQLITE_PATH", os.path.join("cache", "fsm.db"))
+        logging.info(f"FSM storage: sqlite at {path}")
+        return SQLiteStorage(path, ttl=ttl or 0)
+    if backend != "memory":
+        logging.warning(f"Unknown FSM_STORAGE '{backend}', using memory")
+    return MemoryStorage()
@@ -0,0 +1,115 @@
+import os
+import re
+import asyncio
+import logging
+from services.ffmpeg import ffmpeg_pool
+from services.metrics import metrics
+from services.downloader import MediaType
+
+# Telegram ignores thumbnails that are not JPEG, wider/taller than 320 px or over 200 KB
+MAX_SIDE = 320
+MAX_BYTES = 200 * 1024
+# JPEG qualities (ffmpeg -q:v, lower is better) tried until the file fits
+QUALITIES = (3, 6, 10, 18, 31)
+
+UNSAFE_RE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class ThumbnailPipeline:
+    """
+    Turns whatever thumbnail yt-dlp wrote (often a large webp) into a
+    Telegram-compliant JPEG, or grabs a frame from the video when there is
+    none. Work runs on the ffmpeg pool; results are cached per media id in
+    cache_dir so repeat links and carousel re-sends skip it.
+    """
+
+    def __init__(self, pool, cache_dir, max_entries=2000):
+        self.pool = pool
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_entries = max_entries
+        self._running = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, media):
+        item_id = media.get('entry_id') or media.get('media_id')
+        if item_id and media.get('extractor'):
+            key = f"{media['extractor']}-{item_id}"
+        else:
+            # No stable id (fallback downloads): only valid for this job
+            key = f"{media['group_id']}-{os.path.basename(media['path'])}"
+        return UNSAFE_RE.sub('_', key)[:150]
+
+    async def prepare(self, media):
+        """
+        Returns the path of a compliant thumbnail for a video/audio item,
+        or None if there is nothing to show.
+        """
+        out_path = os.path.join(self.cache_dir, f"{self._key(media)}.jpg")
+        if os.path.exists(out_path):
+            metrics.incr('thumbs.cache_hits')
+            return out_path
+
+        task = self._running.get(out_path)
+        if task is None:
+            task = asyncio.ensure_future(self._make(media, out_path))
+            self._running[out_path] = task
+            task.add_done_callback(lambda t: self._running.pop(out_path, None))
+        try:
+            return await asyncio.shield(task)
+        except Exception as e:
+            logging.warning(f"Thumbnail for {media['path']} failed: {e}")
+            # A small JPEG may still be usable as it is
+            source = media.get('thumb')
+            if source and source.lower().endswith(('.jpg', '.jpeg')) and os.path.exists(source) and os.path.getsize(source) <= MAX_BYTES:
+                return source
+            return None
+
+    async def _make(self, media, out_path):
+        source = media.get('thumb')
+        scale = f"scale='min({MAX_SIDE},iw)':'min({MAX_SIDE},ih)':force_original_aspect_ratio=decrease"
+        if source and os.path.exists(source):
+            args = ["-i", source]
+            metrics.incr('thumbs.converted')
+        elif media['type'] == MediaType.VIDEO and os.path.exists(media['path']):
+            # No thumbnail: take a frame a little into the video (not the black first one)
+            offset = min(1.0, (media.get('duration') or 0) / 2)
+            args = ["-ss", f"{offset:.2f}", "-i", media['path']]
+            metrics.incr('thumbs.extracted')
+        else:
+            return None
+
+        # Scanning up to max_entries files blocks; keep it off the event loop
+        await asyncio.to_thread(self._prune)
+        tmp_path = f"{out_path}.tmp.jpg"
+        try:
+            for quality in QUALITIES:
+                await self.pool.run([*args, "-frames:v", "1", "-vf", scale, "-q:v", str(quality), "-y", tmp_path])
+                if os.path.exists(tmp_path) and os.path.getsize(tmp_path) <= MAX_BYTES:
+                    os.replace(tmp_path, out_path)
+                    return out_path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return None
+
+    def _prune(self):
+        # Oldest thumbnails go first once the cache is full
+        try:
+            entries = [e for e in os.scandir(self.cache_dir) if e.is_file()]
+        except OSError:
+            return
+        if len(entries) < self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries + 1]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+thumbnails = ThumbnailPipeline(
+    ffmpeg_pool,
+    os.getenv("THUMB_CACHE_DIR", os.path.join("cache", "thumbs")),
+    max_entries=int(os.getenv("THUMB_CACHE_SIZE", "2000")),
+)
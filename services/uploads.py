@@ -0,0 +1,91 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram.types import FSInputFile
+from services.memory import input_file
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramServerError
+from services.metrics import metrics
+from services.downloader import MediaType
+
+
+class PreUploader:
+    """
+    Uploads album items one by one to a storage chat to get their
+    Telegram file_ids, so albums can then be sent by id in one light
+    request instead of one multipart upload of up to 10 files.
+
+    Uploads run concurrently (at most `parallel` at a time) and each item
+    is retried on its own after network/server errors. An item that still
+    fails gets file_id None and is uploaded with the album as before.
+    The storage chat is subject to Telegram's per-chat limits like any other.
+    """
+
+    def __init__(self, chat_id=None, parallel=4, retries=3, backoff=2.0):
+        self.chat_id = chat_id
+        self.retries = retries
+        self.backoff = backoff
+        self._slots = asyncio.Semaphore(parallel)
+
+    @property
+    def enabled(self):
+        return bool(self.chat_id)
+
+    async def upload(self, bot, media):
+        """Returns the item with 'file_id' set (None if it could not be uploaded)."""
+        async with self._slots:
+            start = time.monotonic()
+            for attempt in range(1, self.retries + 1):
+                try:
+                    file_id = await self._send(bot, media)
+                    metrics.observe('preupload', time.monotonic() - start)
+                    return {**media, 'file_id': file_id}
+                except TelegramBadRequest as e:
+                    # Telegram rejected the file itself; retrying won't help
+                    logging.warning(f"Pre-upload of {media['path']} rejected: {e}")
+                    break
+                except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                    metrics.incr('preupload.retries')
+                    logging.warning(f"Pre-upload of {media['path']} failed (attempt {attempt}/{self.retries}): {e}")
+                    if attempt < self.retries:
+                        await asyncio.sleep(self.backoff * attempt)
+            metrics.incr('preupload.failed')
+            return {**media, 'file_id': None}
+
+    async def _send(self, bot, media):
+        if media['type'] == MediaType.VIDEO:
+            thumb = media.get('thumb')
+            sent_msg = await bot.send_video(
+                self.chat_id,
+                input_file(media),
+                duration=media.get('duration'),
+                width=media.get('width'),
+                height=media.get('height'),
+                thumbnail=FSInputFile(thumb) if thumb and os.path.exists(thumb) else None,
+                supports_streaming=True,
+                disable_notification=True,
+                request_timeout=300
+            )
+            # Telegram may store it as an animation/document; that id can't go in an album
+            return sent_msg.video.file_id if sent_msg.video else None
+        sent_msg = await bot.send_photo(
+            self.chat_id,
+            input_file(media),
+            disable_notification=True,
+            request_timeout=300
+        )
+        return sent_msg.photo[-1].file_id if sent_msg.photo else None
+
+
+def _chat_id(value):
+    # Numeric ids from the env are ints for the Bot API; @channel names stay strings
+    if value and value.lstrip('-').isdigit():
+        return int(value)
+    return value or None
+
+
+pre_uploader = PreUploader(
+    chat_id=_chat_id(os.getenv("STORAGE_CHAT_ID")),
+    parallel=int(os.getenv("UPLOAD_PARALLEL", "4")),
+    retries=int(os.getenv("UPLOAD_RETRIES", "3")),
+)
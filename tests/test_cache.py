@@ -0,0 +1,53 @@
+import sqlite3
+from services import cache as cache_module
+from services.cache import ResultCache
+
+PAYLOAD = {'items': [{'type': 'video', 'file_id': 'AAA'}]}
+
+
+def at(monkeypatch, now):
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now)
+
+
+def test_post_results_are_kept_for_the_ttl(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "results.db"), ttl=3600, volatile_ttl=60)
+    at(monkeypatch, 1000)
+    cache.put("https://www.instagram.com/p/abc/", PAYLOAD, extractor='Instagram', media_id='abc')
+
+    at(monkeypatch, 1000 + 600)
+    assert cache.get("https://instagram.com/p/abc") == PAYLOAD
+    assert cache.get_media('Instagram', 'abc') == PAYLOAD
+
+
+def test_story_results_expire_quickly_and_are_not_keyed_by_user(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "results.db"), ttl=3600, volatile_ttl=60)
+    url = "https://www.instagram.com/stories/someone/"
+    at(monkeypatch, 1000)
+    cache.put(url, PAYLOAD, extractor='InstagramStory', media_id='someone')
+
+    assert cache.get(url) == PAYLOAD
+    # Another story link of the same user must not get this set
+    assert cache.get_media('InstagramStory', 'someone') is None
+    at(monkeypatch, 1000 + 61)
+    assert cache.get(url) is None
+
+
+def test_volatile_results_are_not_cached_without_a_volatile_ttl(tmp_path):
+    cache = ResultCache(str(tmp_path / "results.db"), volatile_ttl=0)
+    url = "https://www.tiktok.com/@someone"
+    cache.put(url, PAYLOAD, extractor='TikTokUser', media_id='someone')
+    assert cache.get(url) is None
+
+
+def test_databases_without_the_ttl_column_are_upgraded(tmp_path):
+    path = str(tmp_path / "results.db")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE results (key TEXT PRIMARY KEY, payload TEXT NOT NULL,"
+        " created_at REAL NOT NULL, last_used REAL NOT NULL)"
+    )
+    db.close()
+
+    cache = ResultCache(path)
+    cache.put("https://example.com/v/1", PAYLOAD, extractor='Example', media_id='1')
+    assert cache.get("https://example.com/v/1") == PAYLOAD
@@ -0,0 +1,222 @@
+import os
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from yt_dlp.extractor.generic import GenericIE
+from services import downloader as downloader_module
+from services.cache import ResultCache
+from services.downloader import DownloaderService, MediaFeed, MediaType
+from services.http import http_client
+from services.info_cache import InfoCache
+from services.memory import memory_budget
+from services.progress import Progress
+
+MB = 1024 * 1024
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Serves a few bytes for any path and records which paths were requested."""
+
+    def __init__(self):
+        self.requested = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                self.requested.append(handler.path)
+                body = b'\0' * 1024
+                handler.send_response(200)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+
+    @property
+    def base(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+@pytest.fixture
+def server():
+    server = MediaServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    service = DownloaderService(download_path=str(tmp_path / "downloads"))
+    service.max_upload_bytes = 50 * MB
+    # A fresh, memory-only info cache per test
+    monkeypatch.setattr(downloader_module, 'info_cache', InfoCache(ttl=1800))
+    monkeypatch.setattr(downloader_module, 'result_cache', ResultCache(str(tmp_path / "results.db")))
+    return service
+
+
+def fake_extractor(monkeypatch, server):
+    """
+    Makes the generic extractor return a video with separate 1080p video
+    and audio streams (too big together) and a 720p progressive format
+    that fits the upload limit.
+    """
+    calls = []
+
+    def extract(ie, url):
+        calls.append(url)
+        return {
+            'id': 'clip',
+            'title': 'Clip',
+            'duration': 60,
+            'formats': [
+                {'format_id': 'p', 'url': f"{server.base}/p.mp4", 'ext': 'mp4', 'vcodec': 'avc1.4d401f',
+                 'acodec': 'mp4a.40.2', 'height': 720, 'filesize': 1024},
+                {'format_id': 'v', 'url': f"{server.base}/v.mp4", 'ext': 'mp4', 'vcodec': 'avc1.640028',
+                 'acodec': 'none', 'height': 1080, 'filesize': 40 * MB},
+                {'format_id': 'a', 'url': f"{server.base}/a.m4a", 'ext': 'm4a', 'vcodec': 'none',
+                 'acodec': 'mp4a.40.2', 'abr': 128, 'filesize': 20 * MB},
+            ],
+        }
+
+    monkeypatch.setattr(GenericIE, '_real_extract', extract)
+    return calls
+
+
+def opts(tmp_path):
+    return {
+        'outtmpl': str(tmp_path / '%(id)s.%(format_id)s.%(ext)s'),
+        'format': 'bestvideo+bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+    }
+
+
+def test_downloads_the_fitted_format(tmp_path, server, service, monkeypatch):
+    fake_extractor(monkeypatch, server)
+
+    info = service._download_sync(f"{server.base}/watch", opts(tmp_path))
+
+    # The template alone would pick v+a; the fitted format is the progressive one
+    assert service._fit_format(info, opts(tmp_path))['format'] == 'p'
+    assert server.requested == ['/p.mp4']
+    assert info['format_id'] == 'p'
+    assert 'requested_formats' not in info['requested_downloads'][0]
+
+
+def test_cached_info_downloads_the_fitted_format(tmp_path, server, service, monkeypatch):
+    calls = fake_extractor(monkeypatch, server)
+    url = f"{server.base}/watch"
+
+    service._download_sync(url, opts(tmp_path / "first"))
+    info = service._download_sync(url, opts(tmp_path / "second"))
+
+    # The second download starts from the cached info, which must not carry the first selection
+    assert len(calls) == 1
+    assert server.requested == ['/p.mp4', '/p.mp4']
+    assert info['format_id'] == 'p'
+
+
+def test_new_link_to_a_sent_post_is_not_downloaded(tmp_path, server, service, monkeypatch):
+    fake_extractor(monkeypatch, server)
+    # The same post, sent before under another link
+    payload = {'items': [{'type': 'video', 'file_id': 'AAA', 'title': 'Clip', 'duration': 60,
+                          'width': None, 'height': None, 'group_id': 'old'}]}
+    downloader_module.result_cache.put("https://example.com/share/xyz", payload, "video",
+                                       extractor='Generic', media_id='clip')
+
+    media = asyncio.run(service._download_media(f"{server.base}/watch", progress=Progress()))
+
+    assert server.requested == []
+    assert [(m['type'], m['file_id']) for m in media] == [(MediaType.VIDEO, 'AAA')]
+    assert len(service.jobs) == 0
+
+
+def test_small_sendable_file_is_fetched_into_memory(tmp_path, server, service, monkeypatch):
+    fake_extractor(monkeypatch, server)
+    monkeypatch.setattr(memory_budget, 'item_max', MB)
+    monkeypatch.setattr(memory_budget, 'used', 0)
+
+    async def download():
+        try:
+            return await service._download_media(f"{server.base}/watch", progress=Progress())
+        finally:
+            await http_client.close()
+
+    media = asyncio.run(download())
+
+    # The fitted progressive format, fetched once, kept off the downloads volume
+    assert server.requested == ['/p.mp4']
+    assert [m['type'] for m in media] == [MediaType.VIDEO]
+    assert media[0]['data'] == b'\0' * 1024
+    assert not os.path.exists(media[0]['path'])
+    assert memory_budget.used == 1024
+
+
+def photo(index, group_id='g'):
+    return {'type': MediaType.IMAGE, 'path': f"{index}.jpg", 'title': 'Post', 'group_id': group_id}
+
+
+def test_feed_readers_get_every_item_once():
+    async def main():
+        feed = MediaFeed()
+        feed.put(photo(0))
+        feed.put(photo(0))
+        early = []
+
+        async def read(into):
+            async for media in feed.read():
+                into.append(media['path'])
+
+        reader = asyncio.ensure_future(read(early))
+        await asyncio.sleep(0)
+        feed.put(photo(1))
+        feed.close()
+        # Closed: nothing more gets in
+        feed.put(photo(2))
+        await reader
+
+        # A reader joining afterwards still sees everything from the start
+        late = []
+        await read(late)
+        return early, late
+
+    assert asyncio.run(main()) == (['0.jpg', '1.jpg'], ['0.jpg', '1.jpg'])
+
+
+def test_requests_for_the_same_link_share_one_download(service, monkeypatch):
+    calls = []
+
+    async def stream(url):
+        return [media['path'] async for media in service.stream_media(url)]
+
+    async def main():
+        go = asyncio.Event()
+
+        async def download(url, force_audio=False, user_id=None, progress=None, feed=None, watchdog=None):
+            calls.append(url)
+            feed.put(photo(0))
+            await go.wait()
+            feed.put(photo(1))
+            return [photo(0), photo(1)]
+
+        monkeypatch.setattr(service, '_download_media', download)
+        first = asyncio.ensure_future(stream("https://www.example.com/post/1?utm_source=x"))
+        await asyncio.sleep(0)
+        # Joins while item 0 was already handed out
+        second = asyncio.ensure_future(stream("https://example.com/post/1"))
+        whole = asyncio.ensure_future(service.download_media("https://example.com/post/1"))
+        await asyncio.sleep(0)
+        go.set()
+        return await first, await second, [m['path'] for m in await whole]
+
+    first, second, whole = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert first == second == whole == ['0.jpg', '1.jpg']
+    assert service._inflight == {}
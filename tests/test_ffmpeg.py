@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from services import ffmpeg as ffmpeg_module
+from services.ffmpeg import FFmpegPool, FFmpegError, audio_codec_from_listing
+
+LISTING = """Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'video.mp4':
+  Metadata:
+    major_brand     : isom
+  Duration: 00:00:10.00, start: 0.000000, bitrate: 1205 kb/s
+  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p, 1280x720, 1070 kb/s, 30 fps
+  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s (default)
+At least one output file must be specified
+"""
+
+
+def test_listing_gives_the_first_audio_codec():
+    assert audio_codec_from_listing(LISTING) == 'aac'
+    assert audio_codec_from_listing(LISTING.replace("Audio: aac (LC)", "Audio: opus")) == 'opus'
+
+
+def test_listing_without_audio():
+    no_audio = "\n".join(line for line in LISTING.splitlines() if "Audio:" not in line)
+    assert audio_codec_from_listing(no_audio) is None
+
+
+def test_unreadable_input_raises():
+    with pytest.raises(FFmpegError, match="Invalid data"):
+        audio_codec_from_listing("video.mp4: Invalid data found when processing input\n")
+
+
+def test_audio_codec_without_ffprobe_reads_the_ffmpeg_listing(monkeypatch):
+    environment = SimpleNamespace(ffprobe=None, ffmpeg_cmd='/opt/bin/ffmpeg')
+    monkeypatch.setattr(ffmpeg_module, 'get_environment', lambda: environment)
+    pool = FFmpegPool(size=1)
+    commands = []
+
+    async def fake_exec(cmd, timeout=None, check=True):
+        commands.append((cmd, check))
+        return LISTING
+
+    monkeypatch.setattr(pool, '_exec', fake_exec)
+
+    assert asyncio.run(pool.audio_codec('video.mp4')) == 'aac'
+    assert commands == [(['/opt/bin/ffmpeg', '-hide_banner', '-i', 'video.mp4'], False)]
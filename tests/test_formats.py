@@ -0,0 +1,36 @@
+from services.formats import select_format
+
+MB = 1024 * 1024
+
+
+def video(format_id, height, vcodec, size):
+    return {'format_id': format_id, 'ext': 'mp4' if vcodec.startswith('avc') else 'webm',
+            'vcodec': vcodec, 'acodec': 'none', 'height': height, 'filesize': size}
+
+
+def audio(format_id, acodec, abr, size):
+    return {'format_id': format_id, 'ext': 'm4a' if acodec.startswith('mp4a') else 'webm',
+            'vcodec': 'none', 'acodec': acodec, 'abr': abr, 'filesize': size}
+
+
+AUDIOS = [audio('aac', 'mp4a.40.2', 128, 2 * MB), audio('opus', 'opus', 160, 2 * MB)]
+
+
+def test_streamable_720p_beats_vp9_1080p():
+    info = {'id': 'x', 'formats': [video('vp9', 1080, 'vp9', 30 * MB), video('avc', 720, 'avc1.64001f', 20 * MB), *AUDIOS]}
+    assert select_format(info, 50 * MB) == 'avc+aac'
+
+
+def test_streamable_1080p_beats_av1_4k():
+    info = {'id': 'x', 'formats': [video('av1', 2160, 'av01.0.12M.08', 45 * MB), video('avc', 1080, 'avc1.640028', 30 * MB), *AUDIOS]}
+    assert select_format(info, 50 * MB) == 'avc+aac'
+
+
+def test_low_streamable_format_does_not_beat_good_quality():
+    info = {'id': 'x', 'formats': [video('vp9', 1080, 'vp9', 30 * MB), video('avc', 240, 'avc1.42c015', 3 * MB), *AUDIOS]}
+    assert select_format(info, 50 * MB) == 'vp9+opus'
+
+
+def test_incompatible_format_when_nothing_compatible_fits():
+    info = {'id': 'x', 'formats': [video('vp9', 720, 'vp9', 20 * MB), video('avc', 720, 'avc1.64001f', 60 * MB), *AUDIOS]}
+    assert select_format(info, 50 * MB) == 'vp9+opus'
@@ -0,0 +1,48 @@
+import os
+import glob
+import pytest
+from bench_html_meta import run_new, run_old
+from services.html_meta import extract
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = sorted(glob.glob(os.path.join(ROOT, "fixtures", "facebook", "*.html")))
+
+# Markup the scanner has to read the way an HTML parser does
+PAGES = {
+    'attribute order': '<meta content="https://x.fbcdn.net/p.jpg" property="og:image">',
+    'single quotes': "<meta property='og:video' content='https://x.fbcdn.net/v.mp4?a=1&amp;b=2'>",
+    'uppercase tags': '<META PROPERTY="og:title" CONTENT="Title &amp; more"><IMG SRC="https://x.fbcdn.net/i.jpg">',
+    'first og wins': '<meta property="og:image" content="https://a/1.jpg"><meta property="og:image" content="https://a/2.jpg">',
+    'link image_src': '<link rel="image_src" href="https://x.fbcdn.net/l.jpg">',
+    'icons skipped': '<img src="https://static.xx.fbcdn.net/icon.png"><img src="https://x.fbcdn.net/emoji/1.png"><img src="https://x.fbcdn.net/real.png">',
+    'escaped json': '<script>{"uri":"https:\\/\\/x.fbcdn.net\\/v\\/t39.jpg?oh=1\\u0026oe=2"}</script>',
+    'mp4 href': '<a href="https://x.fbcdn.net/video.mp4?dl=1">Download</a>',
+    'nothing': '<html><body><p>Log in to continue</p></body></html>',
+}
+
+
+@pytest.mark.parametrize('path', FIXTURES, ids=os.path.basename)
+def test_fixture_pages_match_the_legacy_parser(path):
+    with open(path, encoding="utf-8") as f:
+        html = f.read()
+    assert run_new(html) == run_old(html)
+
+
+@pytest.mark.parametrize('html', PAGES.values(), ids=PAGES.keys())
+def test_markup_variants_match_the_legacy_parser(html):
+    assert run_new(html) == run_old(html)
+
+
+def test_extract_reads_each_value_once():
+    found = extract(
+        '<meta property="og:title" content="A &quot;post&quot;">'
+        '<meta property="og:description" content="Text">'
+        '<script>var u = "https://x.fbcdn.net/a.jpg"; var v = "https://x.fbcdn.net/b.mp4";</script>'
+        '<img src="https://x.fbcdn.net/c.jpg">'
+    )
+    assert found['title'] == 'A "post"'
+    assert found['description'] == 'Text'
+    assert found['jpg'] == 'https://x.fbcdn.net/a.jpg'
+    assert found['mp4'] == 'https://x.fbcdn.net/b.mp4'
+    assert found['img'] == 'https://x.fbcdn.net/c.jpg'
+    assert found['image'] is None and found['video'] is None
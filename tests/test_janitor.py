@@ -0,0 +1,54 @@
+import os
+import asyncio
+from collections import namedtuple
+from services import janitor as janitor_module
+from services.janitor import DiskJanitor
+from services.jobs import JobIndex
+
+MB = 1024 * 1024
+DiskUsage = namedtuple('DiskUsage', 'total used free')
+
+
+def make_job(jobs, group_id, size):
+    job = jobs.create(group_id)
+    with open(os.path.join(job.directory, 'video.mp4'), 'wb') as f:
+        f.write(b'\0' * size)
+    return job
+
+
+def test_eviction_stops_once_under_the_low_water_mark(tmp_path, monkeypatch):
+    # A nearly empty volume: only the downloads budget matters
+    monkeypatch.setattr(janitor_module.shutil, 'disk_usage', lambda path: DiskUsage(1000 * MB, 10 * MB, 990 * MB))
+    jobs = JobIndex(str(tmp_path))
+    janitor = DiskJanitor(jobs, max_bytes=10 * MB, high_water=0.8, low_water=0.5)
+    for i in range(4):
+        make_job(jobs, f"old{i}", 2 * MB)
+        janitor.retire(f"old{i}")
+    make_job(jobs, "active", 2 * MB)
+
+    usage = asyncio.run(janitor.enforce_budget())
+
+    # 10 MB used, 5 MB allowed after eviction: the three oldest lingering jobs go
+    assert sorted(job.group_id for job in jobs) == ['active', 'old3']
+    assert not os.path.exists(tmp_path / 'old0')
+    assert usage['downloads_bytes'] == 4 * MB
+    assert usage['lingering_bytes'] == 2 * MB
+    assert (usage['jobs'], usage['lingering_jobs']) == (2, 1)
+
+
+def test_lingering_jobs_are_measured_once(tmp_path, monkeypatch):
+    jobs = JobIndex(str(tmp_path))
+    janitor = DiskJanitor(jobs)
+    make_job(jobs, "a", MB)
+    janitor.retire("a")
+    measured = []
+    real_dir_size = janitor_module.dir_size
+    monkeypatch.setattr(janitor_module, 'dir_size', lambda path: measured.append(path) or real_dir_size(path))
+
+    async def twice():
+        return await janitor.usage(), await janitor.usage()
+
+    first, second = asyncio.run(twice())
+
+    assert first['lingering_bytes'] == second['lingering_bytes'] == MB
+    assert len(measured) == 1
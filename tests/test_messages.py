@@ -0,0 +1,115 @@
+import gc
+import asyncio
+from types import SimpleNamespace
+from handlers import messages
+from services.downloader import MediaType
+from services.execution import DownloadCancelled
+
+
+class FakeUploads:
+    """
+    Stands in for the thumbnail + storage-chat preparation of each item.
+    An upload only finishes once the test opens its gate, so nothing
+    depends on timing.
+    """
+
+    def __init__(self, fail=(), open=()):
+        self.fail = set(fail)
+        self.gates = {}
+        self._started = {}
+        self.started = []
+        self.finished = []
+        for path in open:
+            self.gate(path).set()
+
+    def gate(self, path):
+        return self.gates.setdefault(path, asyncio.Event())
+
+    async def wait_started(self, path):
+        await self._started.setdefault(path, asyncio.Event()).wait()
+
+    async def prepare(self, bot, media):
+        self.started.append(media['path'])
+        self._started.setdefault(media['path'], asyncio.Event()).set()
+        if media['path'] in self.fail:
+            raise RuntimeError(f"upload of {media['path']} failed")
+        await self.gate(media['path']).wait()
+        self.finished.append(media['path'])
+        return {**media, 'file_id': f"id-{media['path']}"}
+
+
+def photo(index):
+    return {'type': MediaType.IMAGE, 'path': f"{index}.jpg", 'title': 'Post', 'group_id': 'g'}
+
+
+def message():
+    async def answer_media_group(media, **kwargs):
+        return [SimpleNamespace(photo=[SimpleNamespace(file_id='sent')], video=None) for _ in media]
+
+    async def answer(*args, **kwargs):
+        return None
+
+    return SimpleNamespace(bot=None, answer_media_group=answer_media_group, answer=answer)
+
+
+def run(coro):
+    """Runs coro and returns (its outcome, tasks left running, unretrieved task errors)."""
+    errors = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        try:
+            outcome = await coro
+        except Exception as e:
+            outcome = e
+        left = [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and not t.done()]
+        # Give the loop a few turns so lost exceptions would be reported
+        for _ in range(5):
+            await asyncio.sleep(0)
+        return outcome, left
+
+    outcome, left = asyncio.run(main())
+    gc.collect()
+    return outcome, left, errors
+
+
+def test_failed_stream_stops_preparing_items(monkeypatch):
+    uploads = FakeUploads()
+    monkeypatch.setattr(messages, '_prepare', uploads.prepare)
+
+    async def items():
+        for index in range(3):
+            yield photo(index)
+            # The next item arrives while this one is uploading
+            await uploads.wait_started(f"{index}.jpg")
+        raise DownloadCancelled('timeout')
+
+    outcome, left, errors = run(messages.send_media(message(), items()))
+
+    assert isinstance(outcome, DownloadCancelled)
+    assert uploads.started == ['0.jpg', '1.jpg', '2.jpg']
+    # Nothing kept uploading after the stream failed
+    assert uploads.finished == []
+    assert left == []
+    assert errors == []
+
+
+def test_failed_album_item_stops_the_other_pre_uploads(monkeypatch):
+    # Item 0 uploads, item 1 fails, the others would upload forever
+    uploads = FakeUploads(fail={'1.jpg'}, open={'0.jpg'})
+    monkeypatch.setattr(messages, '_prepare', uploads.prepare)
+
+    async def items():
+        for index in range(10):
+            yield photo(index)
+            await uploads.wait_started(f"{index}.jpg")
+
+    outcome, left, errors = run(messages.send_media(message(), items()))
+
+    assert isinstance(outcome, RuntimeError)
+    # The last item may be cancelled before it even started
+    assert uploads.started[:9] == [f"{i}.jpg" for i in range(9)]
+    # Item 0 was awaited first; once item 1 failed the rest stopped uploading
+    assert uploads.finished == ['0.jpg']
+    assert left == []
+    assert errors == []
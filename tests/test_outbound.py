@@ -0,0 +1,94 @@
+import asyncio
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, GetUpdates, SendMessage, SendVideo
+from services.outbound import OutboundScheduler
+
+CHAT = 1
+
+
+class FakeApi:
+    """Records what reached the Bot API; retry_after lists methods to refuse once."""
+
+    def __init__(self, retry_after=()):
+        self.sent = []
+        self.retry_after = list(retry_after)
+
+    async def __call__(self, bot, method):
+        if method in self.retry_after:
+            self.retry_after.remove(method)
+            raise TelegramRetryAfter(method, "Too Many Requests", 0)
+        self.sent.append(method)
+        return method
+
+
+def edit(text, message_id=10):
+    return EditMessageText(chat_id=CHAT, message_id=message_id, text=text)
+
+
+def scheduler():
+    # The chat's bucket starts empty: requests queue up for a token
+    outbound = OutboundScheduler(global_rate=100, chat_rate=20)
+    outbound._bucket(CHAT).tokens = 0
+    return outbound
+
+
+def run(outbound, api, methods):
+    async def main():
+        try:
+            return await asyncio.gather(*(outbound(api, None, method) for method in methods))
+        finally:
+            outbound._dispatcher.cancel()
+    return asyncio.run(main())
+
+
+def test_queued_edits_of_a_message_collapse_into_the_newest():
+    api = FakeApi()
+    edits = [edit("10%"), edit("50%"), edit("90%")]
+
+    results = run(scheduler(), api, edits)
+
+    assert api.sent == [edits[-1]]
+    # The superseded edits count as done for their callers
+    assert results == [True, True, edits[-1]]
+
+
+def test_edits_of_different_messages_are_all_sent():
+    api = FakeApi()
+    edits = [edit("a", message_id=10), edit("b", message_id=11)]
+
+    run(scheduler(), api, edits)
+
+    assert api.sent == edits
+
+
+def test_uploads_go_before_messages_and_status_edits():
+    api = FakeApi()
+    status = edit("50%")
+    text = SendMessage(chat_id=CHAT, text="hello")
+    video = SendVideo(chat_id=CHAT, video="file-id")
+
+    run(scheduler(), api, [status, text, video])
+
+    assert api.sent == [video, text, status]
+
+
+def test_flood_control_retries_the_request():
+    video = SendVideo(chat_id=CHAT, video="file-id")
+    api = FakeApi(retry_after=[video])
+
+    results = run(scheduler(), api, [video])
+
+    assert results == [video]
+    assert api.sent == [video]
+
+
+def test_requests_without_a_chat_are_not_queued():
+    api = FakeApi()
+    outbound = scheduler()
+    updates = GetUpdates()
+
+    async def main():
+        return await outbound(api, None, updates)
+
+    assert asyncio.run(main()) is updates
+    assert outbound._dispatcher is None
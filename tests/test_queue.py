@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+from services import queue as queue_module
+from services.queue import JobQueue, JobFailedError, RUNNING, FAILED
+from services.execution import DownloadCancelled
+from services.formats import MediaTooLargeError
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(queue_module.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return JobQueue(str(tmp_path / "jobs.db"), lease=60, max_queue=5, max_attempts=2)
+
+
+def test_claim_returns_the_claimed_row(queue):
+    job_id = queue.enqueue("https://example.com/v/1")
+    job = queue.claim("w1")
+    assert (job['id'], job['status'], job['worker'], job['attempts']) == (job_id, RUNNING, "w1", 1)
+    assert queue.claim("w2") is None
+
+
+def test_expired_lease_goes_to_the_next_worker(queue, clock):
+    job_id = queue.enqueue("https://example.com/v/1")
+    queue.claim("w1")
+
+    clock.now += 30
+    assert queue.heartbeat(job_id, "w1")
+    clock.now += 59
+    # Renewed 59 s ago: still w1's
+    assert queue.claim("w2") is None
+
+    clock.now += 2
+    job = queue.claim("w2")
+    assert (job['id'], job['worker'], job['attempts']) == (job_id, "w2", 2)
+    # The first worker finds out on its next heartbeat and can't publish
+    assert not queue.heartbeat(job_id, "w1")
+    assert not queue.complete(job_id, "w1", [])
+    assert queue.complete(job_id, "w2", [{'path': 'a.mp4'}])
+
+
+def test_job_that_keeps_losing_its_worker_fails(queue, clock):
+    job_id = queue.enqueue("https://example.com/v/1")
+    queue.claim("w1")
+    clock.now += 61
+    queue.claim("w2")
+    clock.now += 61
+
+    # max_attempts=2 used up: failed instead of handed out again
+    assert queue.claim("w3") is None
+    job = queue.get(job_id)
+    assert (job['status'], job['error']) == (FAILED, 'Worker lost')
+
+
+def test_wait_returns_the_result_and_removes_the_row(queue):
+    job_id = queue.enqueue("https://example.com/v/1")
+    queue.claim("w1")
+    queue.complete(job_id, "w1", [{'path': 'a.mp4'}])
+
+    assert asyncio.run(queue.wait(job_id, poll_interval=0)) == [{'path': 'a.mp4'}]
+    assert queue.get(job_id) is None
+
+
+def test_wait_raises_the_workers_error(queue):
+    job_id = queue.enqueue("https://example.com/v/1")
+    queue.claim("w1")
+    queue.fail(job_id, "w1", 'too_large', "Smallest format is 80 MB")
+
+    with pytest.raises(MediaTooLargeError, match="80 MB"):
+        asyncio.run(queue.wait(job_id, poll_interval=0))
+
+
+def test_stopped_wait_deletes_the_job(queue):
+    job_id = queue.enqueue("https://example.com/v/1")
+    queue.claim("w1")
+
+    with pytest.raises(DownloadCancelled):
+        asyncio.run(queue.wait(job_id, poll_interval=0, stop=lambda: 'cancelled'))
+    # The worker loses the job on its next heartbeat
+    assert not queue.heartbeat(job_id, "w1")
+
+
+def test_vanished_job_fails_the_wait(queue):
+    job_id = queue.enqueue("https://example.com/v/1")
+    queue.remove(job_id)
+    with pytest.raises(JobFailedError):
+        asyncio.run(queue.wait(job_id, poll_interval=0))
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import pytest
+from services.scheduler import DownloadScheduler, QueueFullError, platform_of
+
+
+class Blocking:
+    """Work functions that run until the test releases them."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = []
+
+    def work(self, name):
+        def fn():
+            self.started.append(name)
+            self.release.wait(5)
+            return name
+        return fn
+
+
+async def settle():
+    # Lets queued jobs reach the worker threads
+    for _ in range(20):
+        await asyncio.sleep(0.01)
+
+
+def test_platform_of():
+    assert platform_of("https://vm.tiktok.com/abc") == "tiktok"
+    assert platform_of("https://www.youtube.com:443/watch?v=1") == "youtube"
+    assert platform_of("ytsearch1:song") == "youtube"
+
+
+def test_user_cap_does_not_hold_back_other_users():
+    scheduler = DownloadScheduler(workers=4, per_user=1, per_platform=4)
+    blocking = Blocking()
+
+    async def main():
+        tasks = [
+            asyncio.ensure_future(scheduler.run(blocking.work(name), user_id=user))
+            for name, user in (('a1', 'a'), ('a2', 'a'), ('b1', 'b'))
+        ]
+        await settle()
+        started = sorted(blocking.started)
+        queued = scheduler.queued
+        blocking.release.set()
+        return started, queued, await asyncio.gather(*tasks)
+
+    started, queued, results = asyncio.run(main())
+
+    # a2 waits for a1; b1 goes past it
+    assert started == ['a1', 'b1']
+    assert queued == 1
+    assert results == ['a1', 'a2', 'b1']
+    assert scheduler.running == 0
+
+
+def test_waiting_jobs_hear_their_position():
+    scheduler = DownloadScheduler(workers=1, per_user=5, per_platform=5)
+    blocking = Blocking()
+    positions = {'b': [], 'c': []}
+
+    async def main():
+        first = asyncio.ensure_future(scheduler.run(blocking.work('a')))
+        await settle()
+        others = [
+            asyncio.ensure_future(scheduler.run(blocking.work(name), on_queued=positions[name].append))
+            for name in ('b', 'c')
+        ]
+        await settle()
+        blocking.release.set()
+        await asyncio.gather(first, *others)
+
+    asyncio.run(main())
+
+    # 0 once a job that had to wait is started
+    assert positions == {'b': [1, 0], 'c': [2, 1, 0]}
+
+
+def test_full_queue_refuses_and_cancelled_jobs_leave_it():
+    scheduler = DownloadScheduler(workers=1, max_queue=1)
+    blocking = Blocking()
+
+    async def main():
+        running = asyncio.ensure_future(scheduler.run(blocking.work('a')))
+        await settle()
+        waiting = asyncio.ensure_future(scheduler.run(blocking.work('b')))
+        await settle()
+        with pytest.raises(QueueFullError):
+            await scheduler.run(blocking.work('c'))
+
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.queued == 0
+        third = asyncio.ensure_future(scheduler.run(blocking.work('c')))
+        await settle()
+        blocking.release.set()
+        return await asyncio.gather(running, third)
+
+    assert asyncio.run(main()) == ['a', 'c']
+    assert scheduler.running == 0
@@ -0,0 +1,182 @@
+import os
+import re
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import aiohttp
+import pytest
+from services.http import HttpClient
+from services.segmented import SegmentedDownloader
+
+KB = 1024
+BODY = bytes(range(256)) * 256  # 64 KB
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d+)')
+
+
+class RangeServer(ThreadingHTTPServer):
+    """
+    Serves BODY with Range support and records the ranges asked for.
+    Requests listed in cut_after (by order of arrival) stop after that
+    many bytes, like a dropped connection.
+    """
+
+    def __init__(self, ranges=True):
+        self.ranges = ranges
+        self.requested = []
+        self.cut_after = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.release.set()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(handler):
+                match = RANGE_RE.fullmatch(handler.headers.get('Range', ''))
+                with self.lock:
+                    index = len(self.requested)
+                    self.requested.append((int(match[1]), int(match[2])) if match else None)
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    # Probes answer right away; segments wait until the test lets them go
+                    if match and match[2] != '0':
+                        self.release.wait(5)
+                    if match and self.ranges:
+                        first, last = int(match[1]), int(match[2])
+                        body = BODY[first:last + 1]
+                        handler.send_response(206)
+                        handler.send_header('Content-Range', f"bytes {first}-{first + len(body) - 1}/{len(BODY)}")
+                    else:
+                        body = BODY
+                        handler.send_response(200)
+                    handler.send_header('Content-Length', str(len(body)))
+                    handler.end_headers()
+                    cut = self.cut_after.get(index)
+                    if cut is None:
+                        handler.wfile.write(body)
+                    else:
+                        handler.wfile.write(body[:cut])
+                        handler.wfile.flush()
+                        # aiohttp drops what it buffered when the body ends short:
+                        # let the client read the bytes before the connection goes
+                        time.sleep(0.3)
+                        handler.close_connection = True
+                finally:
+                    with self.lock:
+                        self.in_flight -= 1
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/file.bin"
+
+    def segments(self):
+        return sorted(r for r in self.requested if r and r[1] != 0)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**kwargs):
+        server = RangeServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.release.set()
+        server.shutdown()
+        server.server_close()
+
+
+def run(downloader, *args, **kwargs):
+    async def main():
+        try:
+            return await downloader.download(*args, **kwargs)
+        finally:
+            await downloader.client.close()
+    return asyncio.run(main())
+
+
+def segmented(**kwargs):
+    options = dict(per_job=4, total=16, min_size=32 * KB, min_segment=8 * KB, retries=1)
+    options.update(kwargs)
+    return SegmentedDownloader(HttpClient(), **options)
+
+
+def test_downloads_in_segments(tmp_path, serve):
+    server = serve()
+    path = str(tmp_path / "file.bin")
+
+    assert run(segmented(), server.url, path) == len(BODY)
+
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+    assert server.segments() == [(0, 16383), (16384, 32767), (32768, 49151), (49152, 65535)]
+    assert not os.path.exists(f"{path}.segments")
+
+
+def test_segments_stay_within_the_shared_slots(tmp_path, serve):
+    server = serve()
+    server.release.clear()
+    # Let the segments through once they had the chance to pile up
+    threading.Timer(0.5, server.release.set).start()
+
+    run(segmented(per_job=4, total=2), server.url, str(tmp_path / "file.bin"))
+
+    # The probe is done before the segments start
+    assert server.max_in_flight == 2
+    assert len(server.segments()) == 4
+
+
+def test_small_file_is_one_stream(tmp_path, serve):
+    server = serve()
+    path = str(tmp_path / "file.bin")
+
+    run(segmented(min_size=128 * KB), server.url, path)
+
+    assert server.segments() == []
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+
+
+def test_server_without_ranges_gets_one_stream(tmp_path, serve):
+    server = serve(ranges=False)
+    path = str(tmp_path / "file.bin")
+
+    run(segmented(), server.url, path)
+
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+    assert len(server.requested) == 2
+
+
+def test_failed_download_resumes_where_segments_stopped(tmp_path, serve):
+    server = serve()
+    path = str(tmp_path / "file.bin")
+    # Two segments, each dropped half way through
+    server.cut_after = {1: 8 * KB, 2: 8 * KB}
+
+    with pytest.raises(aiohttp.ClientError):
+        run(segmented(per_job=2, min_segment=32 * KB), server.url, path)
+    assert os.path.exists(f"{path}.segments")
+
+    server.requested.clear()
+    server.cut_after = {}
+    run(segmented(per_job=2, min_segment=32 * KB), server.url, path)
+
+    # Only the missing halves were asked for again
+    assert server.segments() == [(8 * KB, 32 * KB - 1), (40 * KB, 64 * KB - 1)]
+    with open(path, 'rb') as f:
+        assert f.read() == BODY
+    assert not os.path.exists(f"{path}.segments")
@@ -0,0 +1,143 @@
+import os
+import sys
+import socket
+import asyncio
+import logging
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+# How often a running job reports progress, and how often it is polled for when idle
+HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT", "1"))
+POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+
+async def heartbeat(queue, job_id, worker_id, progress, on_lost=None):
+    # Progress goes out when it changes; the lease is renewed at least every third of it
+    last_key = None
+    last_beat = 0
+    loop = asyncio.get_running_loop()
+    while True:
+        key = progress.key()
+        if key != last_key or loop.time() - last_beat > queue.lease / 3:
+            if not await asyncio.to_thread(queue.heartbeat, job_id, worker_id, progress.snapshot()):
+                logging.warning(f"Lost the lease on job {job_id}")
+                if on_lost:
+                    # Cancelled by the front-end or handed to another worker
+                    on_lost()
+            last_key = key
+            last_beat = loop.time()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def run_job(queue, job, worker_id):
+    from services.downloader import downloader, media_to_json
+    from services.progress import Progress
+    from services.scheduler import QueueFullError
+    from services.formats import MediaTooLargeError
+    from services.execution import DownloadCancelled
+
+    job_id = job['id']
+    logging.info(f"Job {job_id}: {job['url']} (attempt {job['attempts']})")
+    progress = Progress()
+    cancel_id = f"job:{job_id}"
+    beat = asyncio.create_task(heartbeat(
+        queue, job_id, worker_id, progress,
+        on_lost=lambda: downloader.cancel(cancel_id)
+    ))
+    try:
+        media_list = await downloader.download_media(
+            job['url'],
+            force_audio=bool(job['force_audio']),
+            user_id=job['user_id'],
+            progress=progress,
+            cancel_id=cancel_id
+        )
+    except MediaTooLargeError as e:
+        await asyncio.to_thread(queue.fail, job_id, worker_id, 'too_large', str(e))
+        return
+    except DownloadCancelled as e:
+        logging.warning(f"Job {job_id} stopped: {e.reason}")
+        await asyncio.to_thread(queue.fail, job_id, worker_id, 'cancelled', e.reason)
+        return
+    except QueueFullError as e:
+        await asyncio.to_thread(queue.fail, job_id, worker_id, 'busy', str(e))
+        return
+    except Exception as e:
+        logging.error(f"Job {job_id} failed: {e}")
+        await asyncio.to_thread(queue.fail, job_id, worker_id, 'error', str(e))
+        return
+    finally:
+        beat.cancel()
+
+    group_ids = {media['group_id'] for media in media_list}
+    result = [media_to_json(media) for media in media_list]
+    if await asyncio.to_thread(queue.complete, job_id, worker_id, result):
+        logging.info(f"Job {job_id} done: {len(media_list)} item(s)")
+    else:
+        # Lease expired or the front-end gave up; nobody will pick these files up
+        logging.warning(f"Job {job_id} finished without its lease, discarding the result")
+        for group_id in group_ids:
+            downloader.jobs.remove(group_id)
+    for group_id in group_ids:
+        downloader.hand_off(group_id)
+
+
+async def main():
+    # Resolve ffmpeg and build yt-dlp option templates once, before any download
+    from services.environment import get_environment
+    get_environment()
+
+    from services.downloader import downloader
+    from services.scheduler import scheduler
+    from services.queue import get_job_queue
+    from services.http import http_client
+    from services.segmented import segmented
+    from services.metrics import metrics
+    from services.memory import memory_budget
+
+    # This process is the one doing the downloads
+    downloader.backend = "inline"
+    # The front-end uploads from the files; memory buffers can't be handed over
+    memory_budget.item_max = 0
+    segmented.attach(asyncio.get_running_loop())
+    # This process's own counters (formats, transcodes...) go to its log
+    metrics.start()
+    queue = get_job_queue()
+    queue.purge()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    # One job per download slot of this process
+    slots = asyncio.Semaphore(scheduler.workers)
+    running = set()
+
+    async def run(job):
+        try:
+            await run_job(queue, job, worker_id)
+        finally:
+            slots.release()
+
+    logging.info(f"Worker {worker_id} started with {scheduler.workers} slot(s), queue {queue.path}")
+    try:
+        while True:
+            await slots.acquire()
+            job = await asyncio.to_thread(queue.claim, worker_id)
+            if job is None:
+                slots.release()
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(run(job))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        await http_client.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info("Worker stopped!")